@@ -14,6 +14,25 @@ bot_master.py v4.96
   • Для каждого кабинета и каждого файла — своё время выгрузки (fileSchedules)
   • Глобальное расписание выгрузки убрано — всё управляется через портал
   • Многоуровневый failover прокси для Telegram (WG+3proxy → WG+Dante → SSH → HTTP → direct)
+  • Потоковый режим BOT_STREAM_CSV=1: CSV разбирается прямо из iter_download, без диска
+  • Режим слушателя --listen: CSV обрабатываются в момент публикации (NewMessage)
+  • VK Ads — асинхронный клиент vk_ads.py (aiohttp, keep-alive, паузы без блокировки loop)
+  • VK fan-out: все кабинеты параллельно, ведро запросов на токен + общий потолок (VK_TOKEN_RPS, VK_MAX_CONCURRENCY)
+  • Повторная выгрузка того же TXT в тот же кабинет пропускается (кэш vk_upload_cache.json)
+  • Суточный лимит загрузок на кабинет — в SQLite (vk_quota.sqlite3), план выгрузки строится под остаток
+  • Планировщик VK на куче сроков: правки cabinets.json применяются на лету, одновременные задания — одним fan-out
+  • VK: circuit breaker на эндпоинт и на кабинет, повторы с decorrelated jitter и Retry-After
+  • Конвейер в кабинете: сегмент списка N создаётся, пока грузится список N+1
+  • Multipart-тело файла собирается один раз на fan-out и переиспользуется всеми кабинетами
+  • BOT_VK_DELTA=1: в кабинет грузятся только новые номера базы, сегмент — на цепочку списков
+  • Список больше VK_LIST_MAX_BYTES / VK_LIST_MAX_ROWS режется на шарды, сегмент — на все шарды
+  • Индекс «база → кабинеты» (CabinetRouting) на прогон: план выгрузки без перебора кабинетов на каждый файл
+  • Неудавшиеся выгрузки — в очередь повтора vk_dead_letter.json, повтор в тот же день с backoff
+  • Фоновый монитор прокси (TG_PROXY_MONITOR_SEC): все уровни проверяются параллельно, ensure_proxy — по оценкам
+  • select_proxy — асинхронная гонка уровней: берётся самый приоритетный из ответивших, выбор ≤ одного таймаута пробы
+  • Пул прокси (TG_PROXY_POOL): соединения Telethon и отправка файлов раздаются по здоровым SOCKS5-уровням с весом по скорости и задержке
+  • SSH-туннель под asyncio-супервизором: проверка насквозь, watchdog, перезапуск с backoff, переезд клиентов при падении
+  • Bot API (ошибки, файлы, max_checker) — общие keep-alive сессии на маршрут прокси (http_sessions.py)
 """
 
 import os
@@ -21,17 +40,29 @@ import asyncio
 import logging
 import random
 import pandas as pd
+import numpy as np
 import requests
 import boto3
 import aiohttp
 import time
 import json
-from typing import Any, Dict, Optional, List
+import hashlib
+import heapq
+import csv
+import codecs
+import fcntl
+import io
+import threading
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional, List, Tuple
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
 from telethon import TelegramClient
 from collections import defaultdict
 
+import http_sessions
+import vk_ads
+
 # ── Импорт max_checker (опционально) ─────────────────────────────────────────
 try:
     from max_checker import start_checker_task
@@ -56,6 +87,18 @@ MANUAL_VK          = os.getenv("BOT_DO_VK_UPLOAD",      "1") == "1"
 MANUAL_MAX_CHECKER = os.getenv("BOT_DO_MAX_CHECKER",    "0") == "1"
 MANUAL_CABINETS    = [c.strip() for c in os.getenv("BOT_SELECTED_CABINETS", "").split(",") if c.strip()]
 
+# Режим слушателя: CSV обрабатываются в момент публикации (events.NewMessage),
+# без фиксированных окон. Запуск: python bot_master.py --listen ИЛИ BOT_LISTEN_MODE=1
+LISTEN_MODE = "--listen" in sys.argv or os.getenv("BOT_LISTEN_MODE", "0") == "1"
+
+# Догрузка истории через takeout-сессию:
+#   python bot_master.py --backfill 2026-04-01:2026-04-05   (или одна дата)
+BACKFILL_RANGE = ""
+if "--backfill" in sys.argv:
+    _idx = sys.argv.index("--backfill")
+    BACKFILL_RANGE = sys.argv[_idx + 1] if _idx + 1 < len(sys.argv) else ""
+BACKFILL_RANGE = BACKFILL_RANGE or os.getenv("BOT_BACKFILL_RANGE", "")
+
 if TEST_MODE:
     print("🧪 ТЕСТ-РЕЖИМ: скачиваем 1 файл → test.txt → загружаем в 1 кабинет")
 
@@ -73,9 +116,7 @@ if TEST_MODE:
 # Все прокси слушают на WireGuard-интерфейсе relay-сервера — снаружи закрыты.
 # ══════════════════════════════════════════════════════════════════════════════
 
-import subprocess
-import socket
-import threading
+import weakref
 
 # ── Прокси 1: WireGuard + 3proxy (основной) ──────────────────────────────────
 TG_SOCKS5_HOST  = os.getenv("TG_SOCKS5_HOST", "")        # 10.99.0.1
@@ -95,175 +136,474 @@ TG_SSH_HOST         = os.getenv("RELAY_HOST", "")         # 94.103.178.200
 TG_SSH_PORT         = int(os.getenv("RELAY_SSH_PORT", "22222"))
 TG_SSH_KEY_PATH     = os.getenv("TG_SSH_KEY_PATH", "/root/.ssh/relay_key")
 TG_SSH_TUNNEL_PORT  = int(os.getenv("TG_SSH_TUNNEL_LOCAL_PORT", "9050"))
+TG_SSH_START_TIMEOUT = float(os.getenv("TG_SSH_START_TIMEOUT", "10"))   # ожидание рабочего SOCKS после запуска
+TG_SSH_WATCHDOG_SEC  = int(os.getenv("TG_SSH_WATCHDOG_SEC", "30"))      # проверка туннеля насквозь
+TG_SSH_RESTART_MIN   = float(os.getenv("TG_SSH_RESTART_MIN", "5"))      # backoff перезапуска, сек
+TG_SSH_RESTART_MAX   = float(os.getenv("TG_SSH_RESTART_MAX", "300"))
 
 # ── Прокси 4: HTTP прокси (legacy/опциональный) ───────────────────────────────
 TG_PROXY_URL    = os.getenv("TG_PROXY_URL", "").rstrip("/")
 TG_PROXY_SECRET = os.getenv("TG_PROXY_SECRET", "")
 
+# ── Фоновый монитор уровней прокси ───────────────────────────────────────────
+# Каждые TG_PROXY_MONITOR_SEC все уровни проверяются параллельно (без блокировки
+# loop), ensure_proxy() отвечает по накопленным оценкам. 0 — монитор выключен.
+PROXY_MONITOR_SEC   = int(os.getenv("TG_PROXY_MONITOR_SEC", "30"))
+PROXY_PROBE_TIMEOUT = float(os.getenv("TG_PROXY_PROBE_TIMEOUT", "5"))
+PROXY_HEALTH_ALPHA  = 0.3     # вес нового замера в скользящих оценках (EWMA)
+PROXY_HEALTH_MIN    = 0.5     # ниже этой доли успешных проб уровень считается нездоровым
+
+# Пул прокси: соединения Telethon (аккаунты пула, доп. соединения диапазонов)
+# и отправка файлов через aiohttp раздаются по всем здоровым SOCKS5-уровням
+# с весом по измеренной скорости скачивания и задержке. 0 — только активный прокси.
+PROXY_POOL_ENABLED  = os.getenv("TG_PROXY_POOL", "1") == "1"
+PROXY_RATE_WINDOW   = 1.0     # сек между замерами скорости в progress-callback
+
 # ── Глобальный активный прокси (выбирается при старте) ───────────────────────
 _active_proxy: Optional[dict] = None   # {'type': 'socks5'|'ssh'|'http'|'direct', ...}
-_ssh_tunnel_proc: Optional[subprocess.Popen] = None
-_proxy_lock = threading.Lock()
+_proxy_lock = asyncio.Lock()        # один выбор прокси за раз
 
 
-def _is_port_open(host: str, port: int, timeout: float = 3.0) -> bool:
-    """Проверяет что TCP-порт открыт."""
-    try:
-        with socket.create_connection((host, port), timeout=timeout):
-            return True
-    except OSError:
-        return False
+class SshTunnelSupervisor:
+    """
+    SSH dynamic SOCKS5 туннель к relay-серверу (ssh -D) как asyncio-подпроцесс.
 
+    Запуск не блокирует loop; туннель считается поднятым, только когда через
+    него проходит CONNECT к api.telegram.org. Watchdog проверяет его каждые
+    TG_SSH_WATCHDOG_SEC и вместе с выходом ssh приводит к перезапуску
+    с экспоненциальным backoff. Подъём и падение сообщаются слою прокси
+    (_notify_proxy_change) — клиенты на туннеле переезжают на другие уровни.
+    """
 
-def _test_socks5(host: str, port: int, user: str = "", password: str = "") -> bool:
-    """Быстро проверяет что SOCKS5-прокси работает (подключение к api.telegram.org)."""
-    try:
-        import socks
-        s = socks.socksocket()
-        s.set_proxy(socks.SOCKS5, host, port, True,
-                    user or None, password or None)
-        s.settimeout(5)
-        s.connect(("api.telegram.org", 443))
-        s.close()
+    LABEL = "SSH-tunnel"
+
+    def __init__(self):
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.task: Optional[asyncio.Task] = None
+        self.ready: Optional[asyncio.Event] = None
+        self.restarts = 0
+
+    @staticmethod
+    def configured() -> bool:
+        return bool(TG_SSH_HOST) and os.path.exists(TG_SSH_KEY_PATH)
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    @property
+    def up(self) -> bool:
+        return self.ready is not None and self.ready.is_set()
+
+    async def start(self) -> bool:
+        """Запускает супервизор (если не запущен) и ждёт рабочего туннеля."""
+        if not self.configured():
+            return False
+        if not self.running:
+            self.ready = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self._supervise())
+        await self.ready.wait()
         return True
-    except Exception:
-        return False
+
+    async def stop(self):
+        """Останавливает супервизор и завершает ssh."""
+        task, self.task = self.task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self._kill()
+        if self.ready is not None:
+            self.ready.clear()
+
+    def _cmd(self) -> List[str]:
+        return [
+            "ssh",
+            "-D", f"127.0.0.1:{TG_SSH_TUNNEL_PORT}",
+            "-N",                                     # не выполнять команды
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "ServerAliveInterval=30",
+            "-o", "ServerAliveCountMax=3",
+            "-o", "ConnectTimeout=10",
+            "-o", "ExitOnForwardFailure=yes",
+            "-i", TG_SSH_KEY_PATH,
+            "-p", str(TG_SSH_PORT),
+            f"{TG_SSH_USER}@{TG_SSH_HOST}",
+        ]
+
+    async def _probe(self) -> Optional[float]:
+        return await _probe_socks5("127.0.0.1", TG_SSH_TUNNEL_PORT)
+
+    async def _spawn(self) -> Optional[float]:
+        """Запускает ssh и ждёт, пока SOCKS-порт заработает насквозь. Возвращает задержку или None."""
+        try:
+            self.proc = await asyncio.create_subprocess_exec(
+                *self._cmd(),
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        except OSError as e:
+            logging.warning("SSH tunnel error: %s", e)
+            return None
+        deadline = time.monotonic() + TG_SSH_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.proc.returncode is not None:
+                return None   # процесс завершился с ошибкой
+            latency = await self._probe()
+            if latency is not None:
+                return latency
+            await asyncio.sleep(0.5)
+        return None
+
+    async def _watch(self) -> str:
+        """Ждёт выхода ssh или двух подряд неудачных проверок насквозь; возвращает причину."""
+        failures = 0
+        while True:
+            try:
+                await asyncio.wait_for(self.proc.wait(), TG_SSH_WATCHDOG_SEC)
+                return f"ssh завершился с кодом {self.proc.returncode}"
+            except asyncio.TimeoutError:
+                pass
+            latency = await self._probe()
+            _proxy_health.setdefault(self.LABEL, ProxyHealth(self.tier())).update(latency)
+            failures = 0 if latency is not None else failures + 1
+            if failures >= 2:
+                return "SOCKS-порт не пропускает к api.telegram.org"
+
+    def tier(self) -> dict:
+        return {"type": "socks5", "host": "127.0.0.1", "port": TG_SSH_TUNNEL_PORT,
+                "user": "", "pass": "", "label": self.LABEL}
+
+    async def _kill(self):
+        proc, self.proc = self.proc, None
+        if proc is None or proc.returncode is not None:
+            return
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), 5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+    async def _supervise(self):
+        delay = TG_SSH_RESTART_MIN
+        try:
+            while True:
+                logging.info("🟡 SSH туннель: запуск к %s:%d...", TG_SSH_HOST, TG_SSH_PORT)
+                latency = await self._spawn()
+                health = _proxy_health.setdefault(self.LABEL, ProxyHealth(self.tier()))
+                health.update(latency)
+                if latency is not None:
+                    logging.info("🟢 SSH туннель поднят (127.0.0.1:%d, %.0f мс)",
+                                 TG_SSH_TUNNEL_PORT, latency * 1000)
+                    delay = TG_SSH_RESTART_MIN
+                    self.ready.set()
+                    _notify_proxy_change(self.LABEL, True)
+                    reason = await self._watch()
+                    logging.warning("🔴 SSH туннель упал: %s", reason)
+                    self.ready.clear()
+                    health.update(None)
+                    _notify_proxy_change(self.LABEL, False)
+                else:
+                    logging.warning("🔴 SSH туннель не поднялся")
+                await self._kill()
+                self.restarts += 1
+                wait = delay * random.uniform(0.5, 1.0)
+                logging.info("SSH туннель: перезапуск через %.1f с", wait)
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, TG_SSH_RESTART_MAX)
+        finally:
+            await self._kill()
 
 
-def _start_ssh_tunnel() -> bool:
+SSH_TUNNEL = SshTunnelSupervisor()
+
+
+# ── Подписчики на смену состояния уровней прокси ─────────────────────────────
+# callback(label, up) вызывается, когда уровень поднялся или упал (монитор,
+# супервизор SSH). По умолчанию подписан _on_proxy_change — переезд клиентов.
+_proxy_listeners: List[Callable[[str, bool], None]] = []
+
+
+def add_proxy_listener(callback: Callable[[str, bool], None]):
+    _proxy_listeners.append(callback)
+
+
+def _notify_proxy_change(label: str, up: bool):
+    for callback in list(_proxy_listeners):
+        try:
+            callback(label, up)
+        except Exception:
+            logging.exception("Ошибка подписчика прокси (%s)", label)
+
+
+def _proxy_tiers() -> List[dict]:
+    """Настроенные уровни прокси в порядке приоритета (без direct)."""
+    tiers = []
+    if TG_SOCKS5_HOST:
+        tiers.append({
+            "type": "socks5",
+            "host": TG_SOCKS5_HOST, "port": TG_SOCKS5_PORT,
+            "user": TG_SOCKS5_USER, "pass": TG_SOCKS5_PASS,
+            "label": "3proxy/WireGuard",
+        })
+    if TG_FALLBACK_SOCKS5_HOST:
+        tiers.append({
+            "type": "socks5",
+            "host": TG_FALLBACK_SOCKS5_HOST, "port": TG_FALLBACK_SOCKS5_PORT,
+            "user": TG_FALLBACK_SOCKS5_USER, "pass": TG_FALLBACK_SOCKS5_PASS,
+            "label": "Dante/WireGuard",
+        })
+    if SshTunnelSupervisor.configured():
+        tiers.append(SSH_TUNNEL.tier())
+    if TG_PROXY_URL:
+        tiers.append({"type": "http", "url": TG_PROXY_URL, "label": "HTTP"})
+    return tiers
+
+
+async def _probe_socks5(host: str, port: int, user: str = "", password: str = "",
+                        timeout: float = PROXY_PROBE_TIMEOUT) -> Optional[float]:
     """
-    Поднимает SSH dynamic SOCKS5 туннель к relay-серверу.
-    ssh -D 127.0.0.1:TG_SSH_TUNNEL_PORT -N -o StrictHostKeyChecking=no ...
-    Возвращает True если туннель поднялся.
+    Проба SOCKS5 без блокировки loop: handshake (с логином, если задан)
+    и CONNECT к api.telegram.org:443. Возвращает задержку в секундах или None.
     """
-    global _ssh_tunnel_proc
+    started = time.monotonic()
+    writer = None
+
+    async def _handshake() -> bool:
+        nonlocal writer
+        reader, writer = await asyncio.open_connection(host, port)
+        methods = b"\x00\x02" if user else b"\x00"
+        writer.write(b"\x05" + bytes([len(methods)]) + methods)
+        _, method = await reader.readexactly(2)
+        if method == 0x02:
+            u, p = user.encode(), password.encode()
+            writer.write(b"\x01" + bytes([len(u)]) + u + bytes([len(p)]) + p)
+            if (await reader.readexactly(2))[1] != 0x00:
+                return False
+        elif method != 0x00:
+            return False
+        target = b"api.telegram.org"
+        writer.write(b"\x05\x01\x00\x03" + bytes([len(target)]) + target + (443).to_bytes(2, "big"))
+        reply = await reader.readexactly(4)     # VER REP RSV ATYP
+        return reply[1] == 0x00
 
-    if not TG_SSH_HOST or not os.path.exists(TG_SSH_KEY_PATH):
-        return False
+    try:
+        ok = await asyncio.wait_for(_handshake(), timeout)
+    except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        ok = False
+    finally:
+        if writer is not None:
+            writer.close()
+    return time.monotonic() - started if ok else None
 
-    # Завершаем старый процесс если есть
-    if _ssh_tunnel_proc and _ssh_tunnel_proc.poll() is None:
-        _ssh_tunnel_proc.terminate()
-
-    cmd = [
-        "ssh",
-        "-D", f"127.0.0.1:{TG_SSH_TUNNEL_PORT}",
-        "-N",                                     # не выполнять команды
-        "-o", "StrictHostKeyChecking=no",
-        "-o", "ServerAliveInterval=30",
-        "-o", "ServerAliveCountMax=3",
-        "-o", "ConnectTimeout=10",
-        "-o", "ExitOnForwardFailure=yes",
-        "-i", TG_SSH_KEY_PATH,
-        "-p", str(TG_SSH_PORT),
-        f"{TG_SSH_USER}@{TG_SSH_HOST}",
-    ]
 
+async def _probe_http_relay(url: str, timeout: float = PROXY_PROBE_TIMEOUT) -> Optional[float]:
+    """GET {url}/health у tg_proxy_server.py. Возвращает задержку в секундах или None."""
+    started = time.monotonic()
     try:
-        _ssh_tunnel_proc = subprocess.Popen(
-            cmd,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        # Даём туннелю 3 секунды на поднятие
-        import time as _time
-        for _ in range(6):
-            _time.sleep(0.5)
-            if _ssh_tunnel_proc.poll() is not None:
-                return False  # процесс завершился с ошибкой
-            if _is_port_open("127.0.0.1", TG_SSH_TUNNEL_PORT, timeout=1):
-                return True
-        return _is_port_open("127.0.0.1", TG_SSH_TUNNEL_PORT)
-    except Exception as e:
-        logging.warning("SSH tunnel error: %s", e)
-        return False
+        session = await http_sessions.get_session(None)
+        async with session.get(f"{url}/health", headers=_proxy_headers(),
+                               timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            if resp.status != 200:
+                return None
+            await resp.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+        return None
+    return time.monotonic() - started
+
+
+async def _probe_tier(tier: dict) -> Optional[float]:
+    if tier["type"] == "socks5":
+        return await _probe_socks5(tier["host"], tier["port"], tier.get("user", ""), tier.get("pass", ""))
+    if tier["type"] == "http":
+        return await _probe_http_relay(tier["url"])
+    return None
+
+
+class ProxyHealth:
+    """Скользящие оценки уровня прокси: доля успешных проб и задержка (EWMA)."""
+
+    def __init__(self, tier: dict):
+        self.tier = tier
+        self.ok = False
+        self.success = 0.0                      # EWMA успешности проб, 0..1
+        self.latency: Optional[float] = None    # EWMA задержки успешных проб, сек
+        self.failures = 0                       # неудачных проб подряд
+        self.samples = 0
+        self.checked_at = 0.0
+
+    def update(self, latency: Optional[float]):
+        self.checked_at = time.monotonic()
+        ok = float(latency is not None)
+        # первый замер берётся как есть — без разгона EWMA с нуля
+        self.success = ok if not self.samples else self.success + PROXY_HEALTH_ALPHA * (ok - self.success)
+        self.samples += 1
+        if latency is None:
+            self.failures += 1
+            self.ok = False
+            return
+        self.failures = 0
+        self.latency = latency if self.latency is None else \
+            self.latency + PROXY_HEALTH_ALPHA * (latency - self.latency)
+        self.ok = self.success >= PROXY_HEALTH_MIN
+
+    @property
+    def fresh(self) -> bool:
+        return time.monotonic() - self.checked_at < max(PROXY_MONITOR_SEC, 1) * 3
+
+    @property
+    def score(self) -> float:
+        """Больше — лучше: успешность на единицу задержки, 0 — уровень недоступен."""
+        if not self.ok:
+            return 0.0
+        return self.success / max(self.latency or PROXY_PROBE_TIMEOUT, 0.01)
+
+
+_proxy_health: Dict[str, ProxyHealth] = {}       # label уровня → оценки
+_proxy_monitor_task: Optional[asyncio.Task] = None
+
+
+async def probe_proxy_tiers() -> Dict[str, ProxyHealth]:
+    """Одна параллельная проверка всех уровней; обновляет _proxy_health."""
+    tiers = _proxy_tiers()
+    results = await asyncio.gather(*(_probe_tier(t) for t in tiers))
+    for tier, latency in zip(tiers, results):
+        health = _proxy_health.get(tier["label"])
+        if health is None:
+            health = _proxy_health[tier["label"]] = ProxyHealth(tier)
+        was_ok = health.ok
+        health.tier = tier
+        health.update(latency)
+        if was_ok and not health.ok:
+            logging.warning("🔴 Монитор прокси: %s недоступен", tier["label"])
+            _notify_proxy_change(tier["label"], False)
+        elif health.ok and not was_ok:
+            logging.info("🟢 Монитор прокси: %s доступен (%.0f мс)", tier["label"], health.latency * 1000)
+            _notify_proxy_change(tier["label"], True)
+    return _proxy_health
+
+
+async def proxy_health_monitor():
+    """Фоновая задача: проверка уровней каждые PROXY_MONITOR_SEC."""
+    while True:
+        try:
+            await probe_proxy_tiers()
+        except Exception:
+            logging.exception("Ошибка монитора прокси")
+        await asyncio.sleep(PROXY_MONITOR_SEC)
+
+
+def start_proxy_monitor():
+    """Запускает монитор в текущем loop (повторный вызов ничего не делает)."""
+    global _proxy_monitor_task
+    if PROXY_MONITOR_SEC <= 0 or not _proxy_tiers():
+        return
+    if _proxy_monitor_task is not None and not _proxy_monitor_task.done():
+        return
+    _proxy_monitor_task = asyncio.get_running_loop().create_task(proxy_health_monitor())
+
+
+def _best_healthy_tier() -> Optional[dict]:
+    """Самый приоритетный уровень, который монитор сейчас считает здоровым."""
+    for tier in _proxy_tiers():
+        health = _proxy_health.get(tier["label"])
+        if health is not None and health.fresh and health.ok:
+            return tier
+    return None
 
 
-def _stop_ssh_tunnel():
-    """Завершает SSH-туннель."""
-    global _ssh_tunnel_proc
-    if _ssh_tunnel_proc and _ssh_tunnel_proc.poll() is None:
-        _ssh_tunnel_proc.terminate()
-        _ssh_tunnel_proc = None
+async def _start_ssh_for_selection() -> Optional[float]:
+    """
+    Поднимает SSH-туннель для select_proxy со своим бюджетом времени
+    (TG_SSH_START_TIMEOUT + проба), а не PROXY_PROBE_TIMEOUT остальных уровней.
+    Не поднялся — супервизор продолжает попытки с backoff в фоне.
+    """
+    try:
+        if not await asyncio.wait_for(SSH_TUNNEL.start(), TG_SSH_START_TIMEOUT + PROXY_PROBE_TIMEOUT):
+            return None
+    except asyncio.TimeoutError:
+        return None
+    return await _probe_tier(SSH_TUNNEL.tier())
 
 
-def select_proxy() -> dict:
+async def select_proxy() -> dict:
     """
-    Определяет рабочий прокси, пробуя каждый уровень по очереди.
-    Возвращает dict с описанием активного прокси.
+    Определяет рабочий прокси: уровни проверяются одновременно,
+    из ответивших берётся самый приоритетный. Ответ уровня 1 принимается
+    сразу, не дожидаясь остальных; без SSH выбор занимает не больше
+    одного PROXY_PROBE_TIMEOUT, а не сумму таймаутов всех уровней.
+    SSH-туннель (если ещё не поднят) запускается только после отказа
+    уровней 1–2 — со своим бюджетом на старт; HTTP relay тем временем
+    проверяется параллельно.
     Кэширует результат в _active_proxy.
     """
     global _active_proxy
 
-    with _proxy_lock:
-        # ── Уровень 1: WireGuard + 3proxy ────────────────────────────────────
-        if TG_SOCKS5_HOST:
-            if _test_socks5(TG_SOCKS5_HOST, TG_SOCKS5_PORT,
-                            TG_SOCKS5_USER, TG_SOCKS5_PASS):
-                logging.info("🟢 Прокси: 3proxy SOCKS5 (%s:%d)",
-                             TG_SOCKS5_HOST, TG_SOCKS5_PORT)
-                _active_proxy = {
-                    "type": "socks5",
-                    "host": TG_SOCKS5_HOST, "port": TG_SOCKS5_PORT,
-                    "user": TG_SOCKS5_USER, "pass": TG_SOCKS5_PASS,
-                    "label": "3proxy/WireGuard",
-                }
-                return _active_proxy
-            else:
-                logging.warning("🔴 3proxy SOCKS5 недоступен (%s:%d)",
-                                TG_SOCKS5_HOST, TG_SOCKS5_PORT)
-
-        # ── Уровень 2: WireGuard + Dante ─────────────────────────────────────
-        if TG_FALLBACK_SOCKS5_HOST:
-            if _test_socks5(TG_FALLBACK_SOCKS5_HOST, TG_FALLBACK_SOCKS5_PORT,
-                            TG_FALLBACK_SOCKS5_USER, TG_FALLBACK_SOCKS5_PASS):
-                logging.info("🟡 Прокси: Dante SOCKS5 (%s:%d)",
-                             TG_FALLBACK_SOCKS5_HOST, TG_FALLBACK_SOCKS5_PORT)
-                _active_proxy = {
-                    "type": "socks5",
-                    "host": TG_FALLBACK_SOCKS5_HOST,
-                    "port": TG_FALLBACK_SOCKS5_PORT,
-                    "user": TG_FALLBACK_SOCKS5_USER,
-                    "pass": TG_FALLBACK_SOCKS5_PASS,
-                    "label": "Dante/WireGuard",
-                }
+    if _proxy_lock.locked():
+        # Выбор уже идёт в другой корутине — берём его результат
+        async with _proxy_lock:
+            if _active_proxy is not None:
                 return _active_proxy
-            else:
-                logging.warning("🔴 Dante SOCKS5 недоступен (%s:%d)",
-                                TG_FALLBACK_SOCKS5_HOST, TG_FALLBACK_SOCKS5_PORT)
-
-        # ── Уровень 3: SSH dynamic SOCKS5 ────────────────────────────────────
-        if TG_SSH_HOST and os.path.exists(TG_SSH_KEY_PATH):
-            logging.info("🟡 Пробуем SSH туннель к %s:%d...", TG_SSH_HOST, TG_SSH_PORT)
-            if _start_ssh_tunnel():
-                logging.info("🟡 Прокси: SSH dynamic SOCKS5 (127.0.0.1:%d)",
-                             TG_SSH_TUNNEL_PORT)
-                _active_proxy = {
-                    "type": "socks5",
-                    "host": "127.0.0.1",
-                    "port": TG_SSH_TUNNEL_PORT,
-                    "user": "", "pass": "",
-                    "label": "SSH-tunnel",
-                }
-                return _active_proxy
-            else:
-                logging.warning("🔴 SSH туннель не поднялся")
 
-        # ── Уровень 4: HTTP прокси ────────────────────────────────────────────
-        if TG_PROXY_URL:
-            logging.info("🟡 Прокси: HTTP (%s)", TG_PROXY_URL)
-            _active_proxy = {"type": "http", "url": TG_PROXY_URL, "label": "HTTP"}
-            return _active_proxy
-
-        # ── Уровень 5: прямое подключение ────────────────────────────────────
-        logging.warning("⚠️  Все прокси недоступны — прямое подключение")
-        _active_proxy = {"type": "direct", "label": "direct"}
+    async with _proxy_lock:
+        tiers = _proxy_tiers()
+        # Не поднятый SSH-туннель не пробуем заранее (task None) — ssh -D к relay
+        # запускается, только если до него дошла очередь
+        tasks = [
+            None if t["label"] == SSH_TUNNEL.LABEL and not SSH_TUNNEL.up
+            else asyncio.create_task(asyncio.wait_for(_probe_tier(t), PROXY_PROBE_TIMEOUT))
+            for t in tiers
+        ]
+        chosen = None
+        try:
+            # Ждём по порядку приоритета — остальные пробы идут параллельно
+            for tier, task in zip(tiers, tasks):
+                try:
+                    latency = await (task if task is not None else _start_ssh_for_selection())
+                except Exception:
+                    latency = None
+                health = _proxy_health.setdefault(tier["label"], ProxyHealth(tier))
+                health.update(latency)
+                if latency is not None:
+                    chosen = tier
+                    break
+                if tier["type"] == "http":
+                    logging.warning("🔴 HTTP прокси %s не ответил на /health", tier["url"])
+                elif tier["label"] == SSH_TUNNEL.LABEL:
+                    logging.warning("🔴 SSH туннель не поднялся")
+                else:
+                    logging.warning("🔴 %s SOCKS5 недоступен (%s:%d)",
+                                    tier["label"].split("/")[0], tier["host"], tier["port"])
+        finally:
+            for task in tasks:
+                if task is not None:
+                    task.cancel()
+
+        if chosen is None and TG_PROXY_URL:
+            # Как и раньше: HTTP relay берётся и без ответа /health
+            chosen = {"type": "http", "url": TG_PROXY_URL, "label": "HTTP"}
+
+        if chosen is None:
+            logging.warning("⚠️  Все прокси недоступны — прямое подключение")
+            _active_proxy = {"type": "direct", "label": "direct"}
+        elif chosen["type"] == "http":
+            logging.info("🟡 Прокси: HTTP (%s)", chosen["url"])
+            _active_proxy = dict(chosen)
+        else:
+            logging.info("%s Прокси: %s SOCKS5 (%s:%d)",
+                         "🟢" if chosen is tiers[0] else "🟡",
+                         chosen["label"], chosen["host"], chosen["port"])
+            _active_proxy = dict(chosen)
         return _active_proxy
 
 
-def _bot_api_url(token: str, method: str) -> str:
-    """URL для Bot API с учётом активного прокси."""
-    proxy = _active_proxy or {}
+def _bot_api_url(token: str, method: str, proxy: Optional[dict] = None) -> str:
+    """URL для Bot API с учётом прокси (по умолчанию — активного)."""
+    proxy = proxy or _active_proxy or {}
     if proxy.get("type") == "http" and proxy.get("url"):
         return f"{proxy['url']}/bot{token}/{method}"
     return f"https://api.telegram.org/bot{token}/{method}"
@@ -275,39 +615,9 @@ def _proxy_headers() -> dict:
     return {}
 
 
-def _aiohttp_connector():
-    """
-    Возвращает aiohttp-коннектор с поддержкой SOCKS5.
-    Требует aiohttp-socks: pip install aiohttp-socks
-    """
-    proxy = _active_proxy or {}
-    if proxy.get("type") == "socks5":
-        try:
-            from aiohttp_socks import ProxyConnector, ProxyType
-            user = proxy.get("user") or None
-            password = proxy.get("pass") or None
-            if user:
-                conn = ProxyConnector(
-                    proxy_type=ProxyType.SOCKS5,
-                    host=proxy["host"], port=proxy["port"],
-                    username=user, password=password,
-                    rdns=True,
-                )
-            else:
-                conn = ProxyConnector(
-                    proxy_type=ProxyType.SOCKS5,
-                    host=proxy["host"], port=proxy["port"],
-                    rdns=True,
-                )
-            return conn
-        except ImportError:
-            logging.warning("aiohttp-socks не установлен, HTTP прокси не работает для aiohttp")
-    return None
-
-
-def _telethon_proxy() -> Optional[dict]:
-    """Возвращает kwargs для TelegramClient."""
-    proxy = _active_proxy or {}
+def _telethon_proxy(proxy: Optional[dict] = None) -> Optional[dict]:
+    """Возвращает kwargs для TelegramClient (по умолчанию — через активный прокси)."""
+    proxy = proxy or _active_proxy or {}
     if proxy.get("type") != "socks5":
         return None
     try:
@@ -327,30 +637,187 @@ def _telethon_proxy() -> Optional[dict]:
 async def ensure_proxy():
     """
     Вызывается перед каждым обращением к Telegram.
-    Если активный прокси не работает — переключается на следующий.
+    Отвечает по оценкам фонового монитора (без сетевых проверок на месте):
+    если активный прокси нездоров — переключается на лучший здоровый уровень.
+    Без монитора (TG_PROXY_MONITOR_SEC=0) активный прокси проверяется пробой, как раньше.
     """
     global _active_proxy
 
+    start_proxy_monitor()
     current = _active_proxy
     if current is None:
-        select_proxy()
+        await select_proxy()
         return
 
-    # Быстрая проверка текущего прокси
-    if current.get("type") == "socks5":
-        ok = _test_socks5(
-            current["host"], current["port"],
-            current.get("user", ""), current.get("pass", "")
-        )
-        if not ok:
-            logging.warning("Прокси %s перестал работать, переключаемся...",
-                            current.get("label"))
+    if current.get("type") == "direct":
+        # Был direct — переходим на прокси, как только монитор увидит живой уровень
+        best = _best_healthy_tier()
+        if best is not None:
+            logging.info("🟢 Прокси снова доступен: %s", best["label"])
+            _active_proxy = dict(best)
+        elif _proxy_monitor_task is None:
             _active_proxy = None
-            select_proxy()
-    elif current.get("type") == "direct":
-        # Если был direct — пробуем снова поднять прокси
+            await select_proxy()
+        return
+
+    if _proxy_monitor_task is None:
+        # Монитор выключен (TG_PROXY_MONITOR_SEC=0) — оценок нет, проверяем прокси на месте
+        if await _probe_tier(current) is not None:
+            return
+        logging.warning("Прокси %s перестал работать, переключаемся...", current.get("label"))
+        _active_proxy = None
+        await select_proxy()
+        return
+
+    health = _proxy_health.get(current.get("label"))
+    if health is None or not health.fresh or health.ok:
+        return      # монитор ещё не мерил или прокси здоров
+
+    logging.warning("Прокси %s перестал работать, переключаемся...", current.get("label"))
+    best = _best_healthy_tier()
+    if best is not None:
+        logging.info("🟡 Прокси: %s (по данным монитора)", best["label"])
+        _active_proxy = dict(best)
+    else:
         _active_proxy = None
-        select_proxy()
+        await select_proxy()
+
+
+class ProxyPool:
+    """
+    Раздача соединений по здоровым SOCKS5-уровням.
+
+    Нагрузка уровня — живые Telethon-клиенты на нём плюс идущие через него
+    HTTP-запросы. Новое соединение получает уровень с наименьшим
+    (нагрузка + 1) / вес, где вес — скорость скачивания на соединение
+    (EWMA по progress-callback) с поправкой на успешность проб; для уровня
+    без замеров скорость оценивается по остальным с учётом задержки.
+    Так число соединений на уровне растёт пропорционально его пропускной способности.
+    """
+
+    def __init__(self):
+        self.throughput: Dict[str, float] = {}          # label → байт/с на соединение (EWMA)
+        self.inflight: Dict[str, int] = defaultdict(int)
+        self._clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()   # клиент → label
+
+    def healthy(self) -> List[dict]:
+        tiers = []
+        for tier in _proxy_tiers():
+            health = _proxy_health.get(tier["label"])
+            if tier["type"] == "socks5" and health is not None and health.fresh and health.ok:
+                tiers.append(tier)
+        return tiers
+
+    def load(self, label: str) -> int:
+        clients = sum(1 for c, lb in list(self._clients.items()) if lb == label and c.is_connected())
+        return clients + self.inflight[label]
+
+    def weight(self, tier: dict, tiers: List[dict]) -> float:
+        health = _proxy_health[tier["label"]]
+        rate = self.throughput.get(tier["label"])
+        if rate is None:
+            known = [self.throughput[t["label"]] for t in tiers if t["label"] in self.throughput]
+            best_latency = min(_proxy_health[t["label"]].latency or PROXY_PROBE_TIMEOUT for t in tiers)
+            rate = (sum(known) / len(known) if known else 1.0) * \
+                best_latency / max(health.latency or PROXY_PROBE_TIMEOUT, 1e-3)
+        return max(rate * health.success, 1e-9)
+
+    def pick(self, exclude: Tuple[str, ...] = ()) -> Optional[dict]:
+        """Уровень для нового соединения; None — работать через активный прокси как раньше."""
+        if not PROXY_POOL_ENABLED:
+            return None
+        tiers = [t for t in self.healthy() if t["label"] not in exclude]
+        if not tiers:
+            return None
+        # При равенстве min берёт первый — т.е. более приоритетный уровень
+        return min(tiers, key=lambda t: (self.load(t["label"]) + 1) / self.weight(t, tiers))
+
+    def assign(self, client, tier: Optional[dict]):
+        """Запоминает уровень клиента (None — клиент на активном прокси)."""
+        label = (tier or _active_proxy or {}).get("label")
+        if label:
+            self._clients[client] = label
+        else:
+            self._clients.pop(client, None)
+
+    def tier_of(self, client) -> Optional[str]:
+        return self._clients.get(client)
+
+    def note_failure(self, label: Optional[str]):
+        """Обрыв соединения через уровень — учитываем как неудачную пробу."""
+        health = _proxy_health.get(label) if label else None
+        if health is not None:
+            health.update(None)
+
+    def migrate(self, label: str) -> int:
+        """Переводит клиентов с упавшего уровня на другие (set_proxy — при переподключении)."""
+        moved = 0
+        for client, client_label in list(self._clients.items()):
+            if client_label != label:
+                continue
+            tier = self.pick(exclude=(label,))
+            client.set_proxy((_telethon_proxy(tier) or {}).get("proxy"))
+            self.assign(client, tier)
+            moved += 1
+        return moved
+
+    def note_transfer(self, label: str, nbytes: int, seconds: float):
+        if seconds <= 0 or nbytes <= 0:
+            return
+        rate = nbytes / seconds
+        prev = self.throughput.get(label)
+        self.throughput[label] = rate if prev is None else prev + PROXY_HEALTH_ALPHA * (rate - prev)
+
+    def progress_callback(self, client) -> Callable[[int, int], None]:
+        """progress_callback(current, total) для download_media / ручных циклов iter_download."""
+        label = self.tier_of(client)
+        state = {"t": time.monotonic(), "bytes": 0}
+
+        def _callback(current: int, total: int):
+            now = time.monotonic()
+            if label and now - state["t"] >= PROXY_RATE_WINDOW:
+                self.note_transfer(label, current - state["bytes"], now - state["t"])
+                state["t"], state["bytes"] = now, current
+        return _callback
+
+    @contextmanager
+    def http(self, tier: Optional[dict]):
+        """HTTP-запрос через уровень — учитывается в его нагрузке."""
+        label = (tier or {}).get("label")
+        if label:
+            self.inflight[label] += 1
+        try:
+            yield
+        finally:
+            if label:
+                self.inflight[label] -= 1
+
+
+PROXY_POOL = ProxyPool()
+
+
+def _on_proxy_change(label: str, up: bool):
+    """Уровень упал: активный прокси и клиенты на нём уходят на другие уровни."""
+    global _active_proxy
+    if up:
+        return
+    if (_active_proxy or {}).get("label") == label:
+        best = _best_healthy_tier()
+        _active_proxy = dict(best) if best is not None else None   # None — ensure_proxy выберет заново
+        logging.warning("Прокси %s упал, активный: %s", label,
+                        (best or {}).get("label", "выбор при следующем обращении"))
+    moved = PROXY_POOL.migrate(label)
+    if moved:
+        logging.info("↪️  %d соединений Telegram переведено с %s", moved, label)
+    # Keep-alive соединения HTTP-сессии упавшего уровня больше не нужны
+    for tier in _proxy_tiers():
+        if tier["label"] == label and tier["type"] == "socks5":
+            task = asyncio.get_running_loop().create_task(http_sessions.drop_session(tier))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+
+
+add_proxy_listener(_on_proxy_change)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -366,6 +833,11 @@ API_ID        = os.getenv("API_ID")
 API_HASH      = os.getenv("API_HASH")
 PHONE         = os.getenv("PHONE")
 
+# Дополнительные Telethon-аккаунты для параллельного скачивания (опционально):
+# JSON-список [{"api_id": ..., "api_hash": "...", "phone": "...", "session": "session_2"}, ...]
+# Основной аккаунт (API_ID/API_HASH/PHONE, session_master) всегда первый в пуле.
+TG_ACCOUNTS_JSON = os.getenv("TG_ACCOUNTS_JSON", "/opt/bot/tg_accounts.json")
+
 # Канал 1 — основной (скачиваем все CSV кроме 389/390)
 CHANNEL_NAME  = os.getenv("CHANNEL_NAME")
 
@@ -390,6 +862,8 @@ ERROR_CHAT_ID   = os.getenv("ERROR_CHAT_ID")
 
 # Путь к cabinets.json портала
 CABINETS_JSON = os.getenv("CABINETS_JSON", "/opt/base-portal/backend/data/cabinets.json")
+# Как часто планировщик VK проверяет mtime cabinets.json (правки из портала подхватываются на лету)
+CABINETS_POLL_SEC = int(os.getenv("BOT_CABINETS_POLL_SEC", "15"))
 
 # Путь к list_base.json портала — прямая перезапись файла (без HTTP и токенов)
 # Портал и bot_master работают на одном сервере, файл читается при каждом запросе
@@ -408,6 +882,34 @@ CHANNEL1_WINDOW_END   = (3, 6)
 CHANNEL2_WINDOW_START = (5, 2)
 CHANNEL2_WINDOW_END   = (5, 6)
 
+# За сколько секунд до окна поднимать прокси/SSH, Telethon-сессию и резолвить
+# каналы (0 — без прогрева). Таймер канала 1 можно ставить на окно минус это время.
+PREWARM_SECONDS = int(os.getenv("BOT_PREWARM_SEC", "60"))
+
+# run_test: сколько КБ наименьшего CSV канала 1 читать для выборки
+TEST_SAMPLE_KB = int(os.getenv("TEST_SAMPLE_KB", "64"))
+
+# Канал 2: берём только последние N CSV
+CHANNEL2_LAST_N = 2
+
+# Режим слушателя: до какого времени (UTC) ждать файлы и сколько секунд тишины
+# после последнего CSV канала 1 считать признаком «все файлы пришли»
+LISTEN_DEADLINE   = tuple(int(x) for x in os.getenv("BOT_LISTEN_DEADLINE_UTC", "05:30").split(":"))
+LISTEN_SETTLE_SEC = int(os.getenv("BOT_LISTEN_SETTLE_SEC", "300"))
+
+# Потоковый режим: CSV разбирается по мере скачивания, без /opt/bot/csv
+STREAM_CSV          = os.getenv("BOT_STREAM_CSV", "0") == "1"
+STREAM_DEBUG_DIR    = os.getenv("BOT_STREAM_DEBUG_DIR", "")   # копия CSV на диск (отладка)
+STREAM_REQUEST_SIZE = 512 * 1024                             # байт на запрос iter_download
+STREAM_QUEUE_CHUNKS = 8                                      # чанков в очереди скачивание → разбор
+
+# Параллельное скачивание больших CSV по диапазонам (broker, 6_web — сотни MB)
+RANGED_MIN_SIZE     = int(os.getenv("TG_RANGED_MIN_MB", "50")) * 1024 * 1024
+RANGED_WORKERS      = int(os.getenv("TG_RANGED_WORKERS", "4"))   # соединений на файл
+RANGED_PART_SIZE    = 8 * 1024 * 1024                           # байт на диапазон
+RANGED_REQUEST_SIZE = 512 * 1024                                # байт на запрос GetFile
+RANGED_MAX_ROUNDS   = 3                                         # докачек после обрыва
+
 # ══════════════════════════════════════════════════════════════════════════════
 # === ЛОГИРОВАНИЕ ==============================================================
 # ══════════════════════════════════════════════════════════════════════════════
@@ -446,51 +948,29 @@ s3 = boto3.client(
 # ══════════════════════════════════════════════════════════════════════════════
 # === VK API ===================================================================
 # ══════════════════════════════════════════════════════════════════════════════
-BASE_URL_V3 = "https://ads.vk.com/api/v3"
-BASE_URL_V2 = "https://ads.vk.com/api/v2"
+# Сегмент создаётся отдельным этапом и повторяется без повторной загрузки списка
+VK_SEGMENT_RETRIES   = int(os.getenv("VK_SEGMENT_RETRIES", "3"))
+VK_SEGMENT_RETRY_SEC = 10
 
-MAX_UPLOADS_PER_TOKEN = 20
-VK_UPLOAD_COUNTERS: Dict[str, int] = {}
+# Дельта-режим (BOT_VK_DELTA=1): в кабинет грузятся только новые номера базы относительно
+# прошлой выгрузки, сегмент ссылается на всю цепочку списков. После VK_DELTA_MAX_CHAIN
+# дельт — снова полный список (номера, ушедшие из базы, из сегмента пропадают только тогда).
+VK_DELTA_MODE      = os.getenv("BOT_VK_DELTA", "0") == "1"
+VK_DELTA_DIR       = os.getenv("BOT_VK_DELTA_DIR", "/opt/bot/vk_delta")
+VK_DELTA_MAX_CHAIN = int(os.getenv("BOT_VK_DELTA_MAX_CHAIN", "7"))
 
-RETRY_COUNT    = 3
-RETRY_BACKOFF  = 2
-RATE_LIMIT_SLEEP = (10, 30)
+# Очередь неудавшихся выгрузок (кабинет, файл): повтор в тот же день (UTC+4) с удвоением паузы.
+# main() ждёт опустения очереди в самом конце (после max_checker и очистки): при
+# BASE_SEC=600 и 5 попытках это до ~2.5 ч, но не позже конца суток UTC+4.
+VK_DLQ_PATH         = os.getenv("BOT_VK_DLQ", "/opt/bot/vk_dead_letter.json")
+VK_DLQ_BASE_SEC     = int(os.getenv("BOT_VK_DLQ_BASE_SEC", "600"))
+VK_DLQ_MAX_SEC      = 2 * 3600
+VK_DLQ_MAX_ATTEMPTS = int(os.getenv("BOT_VK_DLQ_MAX_ATTEMPTS", "5"))
 
+# Лимит загрузок на кабинет в сутки — vk_ads.QuotaLedger (SQLite, общий для всех процессов)
 
-def req_with_retry(
-    method: str, url: str, headers: Dict[str, str],
-    params=None, json_body=None, files=None, data=None, timeout=60
-) -> requests.Response:
-    last_exc = None
-    for attempt in range(1, RETRY_COUNT + 1):
-        try:
-            resp = requests.request(
-                method, url, headers=headers, params=params,
-                json=json_body, data=data, files=files, timeout=timeout
-            )
-            if resp.status_code == 429:
-                retry_after = int(resp.headers.get("Retry-After", "5"))
-                logger.warning(f"VK rate limit 429, пауза {retry_after}s")
-                time.sleep(retry_after)
-                continue
-            try:
-                vk_err = resp.json().get("error", {})
-                if isinstance(vk_err, dict) and vk_err.get("error_code") in (9, 29):
-                    sf = random.uniform(*RATE_LIMIT_SLEEP)
-                    logger.warning(f"VK flood {vk_err.get('error_code')}, пауза {sf:.1f}s")
-                    time.sleep(sf)
-                    continue
-            except Exception:
-                pass
-            if resp.status_code >= 500:
-                raise requests.HTTPError(f"{resp.status_code} {resp.text}")
-            return resp
-        except Exception as e:
-            last_exc = e
-            sf = RETRY_BACKOFF ** (attempt - 1)
-            logger.warning(f"{method} {url} попытка {attempt}/{RETRY_COUNT}: {e}. Повтор через {sf}s")
-            time.sleep(sf)
-    raise last_exc
+# Запросы к VK Ads идут через асинхронный клиент vk_ads (aiohttp, keep-alive,
+# паузы по 429 / flood 9, 29 не блокируют event loop)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -519,24 +999,32 @@ async def send_error_async(message: str):
     try:
         url = _bot_api_url(ERROR_BOT_TOKEN, "sendMessage")
         timeout = aiohttp.ClientTimeout(connect=15, total=30)
-        connector = _aiohttp_connector()
-        if connector:
-            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-                await session.post(url,
-                    data={"chat_id": ERROR_CHAT_ID,
-                          "text": f"❌ bot_master v{VersionBotMaster}: {message}",
-                          "disable_notification": "true"},
-                    headers=_proxy_headers())
-        else:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                await session.post(url,
-                    data={"chat_id": ERROR_CHAT_ID,
-                          "text": f"❌ bot_master v{VersionBotMaster}: {message}",
-                          "disable_notification": "true"},
-                    headers=_proxy_headers())
+        session = await http_sessions.get_session(_active_proxy)
+        async with session.post(url,
+                data={"chat_id": ERROR_CHAT_ID,
+                      "text": f"❌ bot_master v{VersionBotMaster}: {message}",
+                      "disable_notification": "true"},
+                headers=_proxy_headers(), timeout=timeout):
+            pass
     except Exception:
         logging.exception("send_error_async failed")
-        send_error_sync(message)
+        await asyncio.to_thread(send_error_sync, message)
+
+
+_background_tasks: set = set()
+
+
+def notify_error(message: str):
+    """Уведомление error-бота фоном: вызывающая корутина (fan-out) не ждёт HTTP."""
+    task = asyncio.create_task(send_error_async(message))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def drain_notifications():
+    """Дожидается фоновых уведомлений — иначе asyncio.run отменит их при выходе."""
+    while _background_tasks:
+        await asyncio.gather(*list(_background_tasks), return_exceptions=True)
 
 
 def get_day_number(today: datetime) -> int:
@@ -561,18 +1049,22 @@ def seconds_until_window(hour_utc: int, minute_utc: int) -> float:
 # === КАБИНЕТЫ ИЗ ПОРТАЛА =====================================================
 # ══════════════════════════════════════════════════════════════════════════════
 
+def _read_cabinets_json() -> List[dict]:
+    """cabinets.json как есть; ошибка чтения/формата — исключение (файл мог писаться порталом)."""
+    with open(CABINETS_JSON, encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        raise Exception("Неожиданный формат cabinets.json")
+    return data
+
+
 def load_cabinets() -> List[dict]:
     """Читает список кабинетов из cabinets.json портала."""
     if not os.path.exists(CABINETS_JSON):
         logger.warning(f"cabinets.json не найден: {CABINETS_JSON}")
         return []
     try:
-        with open(CABINETS_JSON, encoding="utf-8") as f:
-            data = json.load(f)
-        if isinstance(data, list):
-            return data
-        logger.warning(f"Неожиданный формат cabinets.json")
-        return []
+        return _read_cabinets_json()
     except Exception as e:
         logger.exception(f"Ошибка чтения cabinets.json: {e}")
         return []
@@ -652,94 +1144,612 @@ def order_txt_files(files: List[str]) -> List[str]:
 # === СКАЧИВАНИЕ ИЗ TELEGRAM ==================================================
 # ══════════════════════════════════════════════════════════════════════════════
 
+# Резолв каналов кэшируется на клиента — прогрев заполняет его заранее
+_resolved_cache: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+# Прогретые клиенты: session_name → подключённый TelegramClient
+_prewarmed: Dict[str, TelegramClient] = {}
+
+
 async def _resolve_channel(client, channel: str):
     """
     Возвращает entity для канала/чата.
     Для числовых ID ищет в диалогах (InputPeerChat не работает по строке).
     """
+    cache = _resolved_cache.setdefault(client, {})
+    if channel in cache:
+        return cache[channel]
+
+    resolved = channel  # @username или t.me/+ ссылка — передаём напрямую
     raw = channel.lstrip('-')
     if raw.isdigit():
         target = int(raw)
         async for dlg in client.iter_dialogs():
             if abs(dlg.entity.id) == target:
-                return dlg.input_entity
+                resolved = dlg.input_entity
+                break
         # Не нашли в диалогах — пробуем как есть (может сработать для каналов -100...)
-        return channel
-    return channel  # @username или t.me/+ ссылка — передаём напрямую
+    cache[channel] = resolved
+    return resolved
 
 
-async def download_csv_from_channel(
-    channel: str,
-    to_folder: str,
-    limit: int = 7,
-    only_last_n: Optional[int] = None,
-    session_name: str = "session_master",
-) -> List[str]:
+async def _connect_telegram(
+    channel: str, session_name: str, account: Optional[dict] = None, reset_proxy: bool = True
+) -> Optional[TelegramClient]:
     """
-    Скачивает CSV из указанного TG-канала.
-    Перед подключением проверяет и при необходимости переключает прокси.
-    only_last_n: если задано — скачиваем только последние N файлов.
+    Подключается к Telegram через активный прокси (3 попытки с переключением).
+    account — запись из TG_ACCOUNTS (по умолчанию API_ID/API_HASH/PHONE).
+    reset_proxy=False — неудача не сбрасывает общий _active_proxy (доп. аккаунты пула:
+    их сбой не повод переключать прокси основной сессии).
+    Возвращает запущенный клиент или None.
     """
     global _active_proxy  # объявляем в начале функции — до любого использования
-    os.makedirs(to_folder, exist_ok=True)
 
-    # Проверяем/обновляем прокси (с 3 попытками)
+    # Прогретый клиент (prewarm перед окном) — забираем без повторного handshake
+    warm = _prewarmed.pop(session_name, None)
+    if warm is not None:
+        if warm.is_connected():
+            logger.info("📥 Скачиваем из %s — прогретое соединение", channel)
+            return warm
+        await warm.disconnect()
+
+    # Проверяем/обновляем прокси (с 3 попытками); уровень — из пула прокси
+    failed: List[str] = []
     for attempt in range(1, 4):
         await ensure_proxy()
-        proxy_kwargs = _telethon_proxy() or {}
-        proxy_label = (_active_proxy or {}).get("label", "direct")
+        tier = PROXY_POOL.pick(exclude=tuple(failed))
+        proxy_kwargs = _telethon_proxy(tier) or {}
+        proxy_label = (tier or _active_proxy or {}).get("label", "direct")
         logger.info("📥 Скачиваем из %s via %s (попытка %d)", channel, proxy_label, attempt)
 
         try:
-            client = TelegramClient(session_name, API_ID, API_HASH, **proxy_kwargs)
-            await client.start(PHONE)
-            break  # успешно подключились
+            if account:
+                client = TelegramClient(session_name, account["api_id"], account["api_hash"], **proxy_kwargs)
+                await client.start(account["phone"])
+            else:
+                client = TelegramClient(session_name, API_ID, API_HASH, **proxy_kwargs)
+                await client.start(PHONE)
+            PROXY_POOL.assign(client, tier)
+            return client  # успешно подключились
         except Exception as e:
             logger.warning("Подключение к TG не удалось (попытка %d): %s", attempt, e)
+            failed.append(proxy_label)
+            PROXY_POOL.note_failure(proxy_label)
             # Сбрасываем прокси чтобы select_proxy выбрал следующий
-            _active_proxy = None
+            if reset_proxy and (tier is None or tier["label"] == (_active_proxy or {}).get("label")):
+                _active_proxy = None
             if attempt == 3:
                 await send_error_async(f"Не удалось подключиться к TG за 3 попытки: {e}")
-                return []
+                return None
             await asyncio.sleep(5)
-    else:
+    return None
+
+
+# ── Пул Telethon-аккаунтов ───────────────────────────────────────────────────
+#
+# Лимиты FloodWait считаются на аккаунт, поэтому документы канала раздаются
+# воркерам разных аккаунтов через общую очередь (work stealing). Аккаунт,
+# получивший FloodWait, отмечается и не берёт новых файлов до истечения паузы.
+
+def load_tg_accounts() -> List[dict]:
+    """Основной аккаунт + дополнительные из TG_ACCOUNTS_JSON."""
+    accounts = [{"api_id": API_ID, "api_hash": API_HASH, "phone": PHONE, "session": "session_master"}]
+    if not os.path.exists(TG_ACCOUNTS_JSON):
+        return accounts
+    try:
+        with open(TG_ACCOUNTS_JSON, encoding="utf-8") as f:
+            data = json.load(f)
+        for acc in data if isinstance(data, list) else []:
+            if not all(acc.get(k) for k in ("api_id", "api_hash", "phone", "session")):
+                logger.warning("TG-аккаунт без api_id/api_hash/phone/session пропущен: %s", acc.get("session"))
+                continue
+            if acc["session"] not in {a["session"] for a in accounts}:
+                accounts.append(acc)
+    except Exception as e:
+        logger.exception("Ошибка чтения %s: %s", TG_ACCOUNTS_JSON, e)
+    return accounts
+
+
+class TelegramAccountPool:
+    """Аккаунты для скачивания с учётом нагрузки и FloodWait по каждому."""
+
+    def __init__(self, accounts: List[dict]):
+        self.accounts = accounts
+        self.stats: Dict[str, dict] = {
+            a["session"]: {"downloads": 0, "bytes": 0, "busy": 0, "flood_until": 0.0}
+            for a in accounts
+        }
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def is_flooded(self, account: dict) -> bool:
+        return self.stats[account["session"]]["flood_until"] > time.monotonic()
+
+    def available(self) -> List[dict]:
+        """Аккаунты без FloodWait — сначала наименее загруженные."""
+        ready = [a for a in self.accounts if not self.is_flooded(a)]
+        return sorted(ready, key=lambda a: (self.stats[a["session"]]["busy"],
+                                            self.stats[a["session"]]["downloads"]))
+
+    def pick(self) -> dict:
+        """Наименее загруженный аккаунт; если все во FloodWait — тот, что освободится раньше."""
+        ready = self.available()
+        if ready:
+            return ready[0]
+        return min(self.accounts, key=lambda a: self.stats[a["session"]]["flood_until"])
+
+    def note_download(self, account: dict, nbytes: int):
+        st = self.stats[account["session"]]
+        st["downloads"] += 1
+        st["bytes"] += nbytes
+
+    def note_flood(self, account: dict, seconds: int):
+        self.stats[account["session"]]["flood_until"] = time.monotonic() + seconds
+        logger.warning("⏳ Аккаунт %s: FloodWait %d с", account["session"], seconds)
+
+
+TG_POOL = TelegramAccountPool(load_tg_accounts())
+
+
+async def download_csv_pooled(
+    channel: str,
+    to_folder: str,
+    limit: int = 7,
+    only_last_n: Optional[int] = None,
+) -> List[str]:
+    """
+    Как download_csv_from_channel, но документы качают все свободные аккаунты
+    пула параллельно. Порядок результата — как в канале (свежие первыми).
+    Файл, не скачанный аккаунтом, возвращается в очередь другим; аккаунт без
+    доступа к каналу/сообщению больше работы не берёт. Потерянным файл
+    считается, только когда его не скачал ни один аккаунт пула.
+    """
+    from telethon.errors import BadRequestError, FloodWaitError, ForbiddenError
+
+    os.makedirs(to_folder, exist_ok=True)
+    date_suffix = datetime.today().strftime("(%d.%m)")
+
+    lister = TG_POOL.pick()
+    lister_client = await _connect_telegram(channel, lister["session"], lister)
+    if lister_client is None:
         return []
 
-    today = datetime.today()
-    date_suffix = today.strftime("(%d.%m)")
+    from telethon.tl.types import InputPeerChannel
+
+    try:
+        resolved = await _resolve_channel(lister_client, channel)
+        if not isinstance(await lister_client.get_input_entity(resolved), InputPeerChannel):
+            # Обычная группа (InputPeerChat): id сообщений у каждого аккаунта свои —
+            # раздать их другим аккаунтам нельзя, качаем одним клиентом
+            logger.info("📥 %s — не канал/супергруппа, скачиваем без пула аккаунтов", channel)
+            try:
+                return await download_csv_from_channel(
+                    channel, to_folder, limit=limit, only_last_n=only_last_n, client=lister_client)
+            finally:
+                await lister_client.disconnect()
+        items = [(msg.id, orig_name) async for msg, orig_name in _iter_channel_csv(lister_client, resolved, limit)]
+    except Exception as e:
+        await lister_client.disconnect()
+        logger.exception("Ошибка чтения канала %s", channel)
+        await send_error_async(f"Ошибка чтения канала {channel}: {e}")
+        return []
+    if only_last_n is not None:
+        items = items[:only_last_n]
+
+    pending: List[Tuple[int, str]] = list(items)
+    failed: Dict[int, set] = defaultdict(set)   # msg_id → аккаунты, у которых файл не скачался
+    broken: set = set()                           # аккаунты без доступа к каналу — работу не берут
+    paths: Dict[int, str] = {}
+
+    def _can_take(account: dict) -> bool:
+        return account["session"] not in broken and any(
+            account["session"] not in failed[msg_id] for msg_id, _ in pending)
+
+    def _take(account: dict) -> Optional[Tuple[int, str]]:
+        for i, (msg_id, _) in enumerate(pending):
+            if account["session"] not in failed[msg_id]:
+                return pending.pop(i)
+        return None
+
+    async def _worker(account: dict, client):
+        session = account["session"]
+        TG_POOL.stats[session]["busy"] += 1
+        try:
+            try:
+                peer = await _resolve_channel(client, channel)
+            except Exception as e:
+                logger.warning("Аккаунт %s не видит канал %s: %s — работает без него", session, channel, e)
+                broken.add(session)
+                return
+            while not TG_POOL.is_flooded(account) and session not in broken:
+                item = _take(account)
+                if item is None:
+                    break
+                msg_id, orig_name = item
+                filename = orig_name.replace(".csv", f" {date_suffix}.csv")
+                path = os.path.join(to_folder, filename)
+                try:
+                    msg = await client.get_messages(peer, ids=msg_id)
+                    if msg is None or not msg.file or msg.file.name != orig_name:
+                        broken.add(session)
+                        raise Exception(f"сообщение {msg_id} ({orig_name}) не найдено аккаунтом {session}")
+                    await _download_message(client, msg, path)
+                except FloodWaitError as e:
+                    TG_POOL.note_flood(account, e.seconds)
+                    pending.insert(0, item)  # заберёт другой аккаунт
+                    break
+                except Exception as e:
+                    failed[msg_id].add(session)
+                    if isinstance(e, (BadRequestError, ForbiddenError)):
+                        broken.add(session)   # нет прав / пир недоступен — остальное тоже не скачает
+                    logger.warning("Ошибка при скачивании %s (%s): %s — вернули в очередь",
+                                   orig_name, session, e)
+                    pending.insert(0, item)
+                    continue
+                paths[msg_id] = path
+                TG_POOL.note_download(account, msg.file.size or 0)
+                logger.info("✅ Скачан %s (аккаунт %s)", filename, session)
+                if "6_web" in orig_name:
+                    await asyncio.sleep(90)
+                await asyncio.sleep(random.uniform(10, 20))
+        finally:
+            TG_POOL.stats[session]["busy"] -= 1
+            if client is not lister_client:
+                await client.disconnect()
+
+    try:
+        # Доп. аккаунты подключаются параллельно и не трогают прокси основной сессии
+        extras = [a for a in TG_POOL.available() if a is not lister][:max(0, len(items) - 1)]
+        clients = await asyncio.gather(
+            *(_connect_telegram(channel, a["session"], a, reset_proxy=False) for a in extras),
+            return_exceptions=True,
+        )
+        workers = [_worker(lister, lister_client)]
+        for account, client in zip(extras, clients):
+            if client is not None and not isinstance(client, BaseException):
+                workers.append(_worker(account, client))
+            else:
+                broken.add(account["session"])
+        logger.info("📥 %s: %d файлов, %d аккаунтов", channel, len(items), len(workers))
+        await asyncio.gather(*workers)
+
+        # Остаток (FloodWait / ошибки) — аккаунтом, который ещё может его взять и чья
+        # пауза кончится раньше; снова FloodWait — файл вернётся в очередь
+        while pending:
+            candidates = [a for a in TG_POOL.accounts if _can_take(a)]
+            if not candidates:
+                break
+            account = min(candidates, key=lambda a: TG_POOL.stats[a["session"]]["flood_until"])
+            wait = TG_POOL.stats[account["session"]]["flood_until"] - time.monotonic()
+            if wait > 0:
+                logger.info("⏳ %s: %d файлов ждут конца FloodWait аккаунта %s (%.0f с)",
+                            channel, len(pending), account["session"], wait)
+                await asyncio.sleep(wait)
+            if account is lister:
+                client = lister_client
+            else:
+                client = await _connect_telegram(channel, account["session"], account, reset_proxy=False)
+                if client is None:
+                    broken.add(account["session"])
+                    continue
+            await _worker(account, client)
+    finally:
+        await lister_client.disconnect()
+
+    lost = [orig_name for msg_id, orig_name in items if msg_id not in paths]
+    if lost:
+        logger.error("Из %s не скачаны ни одним аккаунтом: %s", channel, ", ".join(lost))
+        await send_error_async(f"Ошибка скачивания из {channel}: ни один аккаунт пула "
+                               f"не скачал {', '.join(lost)}")
+
+    return [paths[msg_id] for msg_id, _ in items if msg_id in paths]
+
+
+async def prewarm(channels: List[str], session_name: str = "session_master"):
+    """
+    Прогрев перед окном: выбор прокси (с SSH-туннелем при необходимости),
+    handshake Telethon и резолв каналов. Клиент остаётся подключённым
+    и забирается _connect_telegram в момент старта.
+    """
+    started = time.monotonic()
+    try:
+        await select_proxy()
+        client = await _connect_telegram("прогрев", session_name)
+        if client is None:
+            return
+        for channel in channels:
+            await _resolve_channel(client, channel)
+        old = _prewarmed.pop(session_name, None)
+        if old is not None and old is not client:
+            await old.disconnect()
+        _prewarmed[session_name] = client
+        logger.info("🔥 Прогрев готов за %.1f с (%s via %s)",
+                    time.monotonic() - started, ", ".join(channels),
+                    (_active_proxy or {}).get("label", "direct"))
+    except Exception as e:
+        logger.warning("Прогрев не удался, подключимся в окне: %s", e)
+
+
+async def sleep_with_prewarm(wait: float, channels: List[str], session_name: str = "session_master"):
+    """Спит wait секунд, за PREWARM_SECONDS до конца выполняет prewarm."""
+    target = time.monotonic() + wait
+    if PREWARM_SECONDS and wait > 0:
+        await asyncio.sleep(max(0.0, wait - PREWARM_SECONDS))
+        await prewarm(channels, session_name)
+    await asyncio.sleep(max(0.0, target - time.monotonic()))
+
+
+async def _iter_channel_csv(client, resolved, limit: Optional[int],
+                            offset_date: Optional[datetime] = None,
+                            min_date: Optional[datetime] = None):
+    """
+    Перебирает последние limit сообщений канала и отдаёт (msg, orig_name)
+    для CSV-документов: без 389/390 и без повторов по имени.
+    offset_date/min_date (UTC) — окно по дате для догрузки истории.
+    """
     seen_names: set = set()
-    result_files: List[str] = []
+    async for msg in client.iter_messages(resolved, limit=limit, offset_date=offset_date):
+        if min_date is not None and msg.date < min_date:
+            break
+        if not (msg.file and msg.file.name and msg.file.name.endswith(".csv")):
+            continue
+        orig_name = msg.file.name
+        if orig_name in ("389.csv", "390.csv"):
+            logger.info("Пропускаем файл по имени: %s", orig_name)
+            continue
+        if orig_name in seen_names:
+            logger.info("Пропускаем дубликат: %s", orig_name)
+            continue
+        seen_names.add(orig_name)
+        yield msg, orig_name
+
+
+# ── Параллельное скачивание больших CSV по диапазонам байт ───────────────────
+#
+# Документ режется на куски по RANGED_PART_SIZE, куски качаются одновременно
+# через RANGED_WORKERS соединений (основной клиент + клоны на StringSession
+# той же авторизации), пишутся в .part по своим смещениям. Готовые куски
+# отмечаются в .ranges.json — после переключения прокси докачиваются только
+# недостающие.
+
+def _load_ranges_state(state_path: str, doc_id: int, size: int) -> set:
+    try:
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("doc_id") == doc_id and state.get("size") == size:
+            return set(state.get("done", []))
+    except (OSError, ValueError):
+        pass
+    return set()
+
+
+def _save_ranges_state(state_path: str, doc_id: int, size: int, done: set):
+    tmp = state_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"doc_id": doc_id, "size": size, "done": sorted(done)}, f)
+    os.replace(tmp, state_path)
+
+
+async def _failover_client_proxy(client):
+    """Переводит клиента с отказавшего уровня на другой (из пула или новый активный)."""
+    global _active_proxy
+    failed = PROXY_POOL.tier_of(client)
+    PROXY_POOL.note_failure(failed)
+    if failed is None or failed == (_active_proxy or {}).get("label"):
+        _active_proxy = None
+    await ensure_proxy()
+    tier = PROXY_POOL.pick(exclude=(failed,) if failed else ())
+    client.set_proxy((_telethon_proxy(tier) or {}).get("proxy"))
+    PROXY_POOL.assign(client, tier)
+    # set_proxy действует только при переподключении; «подключённый» сокет
+    # может висеть на старом прокси — переподключаемся явно
+    await client.disconnect()
+    await client.connect()
+
+
+async def _open_range_helpers(client, count: int) -> list:
+    """Дополнительные соединения с той же авторизацией (для параллельных диапазонов)."""
+    from telethon.sessions import StringSession
+
+    session_str = StringSession.save(client.session)
+    helpers = []
+    for _ in range(count):
+        # Каждое соединение — на наименее нагруженный по весу уровень пула
+        tier = PROXY_POOL.pick()
+        proxy_kwargs = _telethon_proxy(tier) or {}
+        helper = TelegramClient(StringSession(session_str), client.api_id, client.api_hash, **proxy_kwargs)
+        try:
+            await helper.connect()
+            PROXY_POOL.assign(helper, tier)
+            helpers.append(helper)
+        except Exception as e:
+            logger.warning("Доп. соединение для диапазонов не поднялось: %s", e)
+    return helpers
+
 
-    # Резолвим entity (нужно для InputPeerChat — обычных групп)
-    resolved = await _resolve_channel(client, channel)
-    logger.info("Резолв канала %s → %s", channel, type(resolved).__name__)
+async def download_ranged(client, msg, path: str) -> str:
+    """
+    Скачивает документ по диапазонам в несколько соединений.
+    При обрыве (смена прокси) продолжает с последних готовых диапазонов.
+    """
+    doc   = msg.document
+    size  = msg.file.size
+    parts = [(off, min(RANGED_PART_SIZE, size - off)) for off in range(0, size, RANGED_PART_SIZE)]
+    part_path  = path + ".part"
+    state_path = path + ".ranges.json"
 
+    done = _load_ranges_state(state_path, doc.id, size) if os.path.exists(part_path) else set()
+    if not done:
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+
+    logger.info("⚡ %s: %d MB, %d диапазонов (%d уже готово), %d соединений",
+                os.path.basename(path), size // (1024 * 1024), len(parts), len(done), RANGED_WORKERS)
+
+    fd = os.open(part_path, os.O_WRONLY)
     try:
-        async for msg in client.iter_messages(resolved, limit=limit):
+        for round_no in range(1, RANGED_MAX_ROUNDS + 1):
+            queue: asyncio.Queue = asyncio.Queue()
+            for off, length in parts:
+                if off not in done:
+                    queue.put_nowait((off, length))
+            if queue.empty():
+                break
+
+            helpers = await _open_range_helpers(client, min(RANGED_WORKERS, queue.qsize()) - 1)
+
+            async def _worker(tg):
+                progress = PROXY_POOL.progress_callback(tg)
+                received = 0
+                while not queue.empty():
+                    off, length = queue.get_nowait()
+                    buf = bytearray()
+                    async for chunk in tg.iter_download(
+                        doc, offset=off, request_size=RANGED_REQUEST_SIZE,
+                        limit=(length + RANGED_REQUEST_SIZE - 1) // RANGED_REQUEST_SIZE,
+                        file_size=size,
+                    ):
+                        buf.extend(chunk)
+                        received += len(chunk)
+                        progress(received, size)
+                    os.pwrite(fd, bytes(buf[:length]), off)
+                    done.add(off)
+                    _save_ranges_state(state_path, doc.id, size, done)
+
             try:
-                if msg.file and msg.file.name and msg.file.name.endswith(".csv"):
-                    orig_name = msg.file.name
-                    if orig_name in ("389.csv", "390.csv"):
-                        logger.info("Пропускаем файл по имени: %s", orig_name)
-                        continue
-                    if orig_name in seen_names:
-                        logger.info("Пропускаем дубликат: %s", orig_name)
-                        continue
-                    seen_names.add(orig_name)
+                results = await asyncio.gather(
+                    *(_worker(tg) for tg in [client, *helpers]), return_exceptions=True
+                )
+            finally:
+                for helper in helpers:
+                    await helper.disconnect()
+
+            errors = [r for r in results if isinstance(r, Exception)]
+            if errors and len(done) < len(parts):
+                logger.warning("Диапазонное скачивание прервано (раунд %d, готово %d/%d): %s",
+                               round_no, len(done), len(parts), errors[0])
+                if round_no < RANGED_MAX_ROUNDS:
+                    await _failover_client_proxy(client)
+    finally:
+        os.close(fd)
+
+    if len(done) < len(parts):
+        raise Exception(f"Диапазонное скачивание не завершено: {len(done)}/{len(parts)}")
+
+    os.replace(part_path, path)
+    try:
+        os.remove(state_path)
+    except OSError:
+        pass
+    return path
+
+
+async def _download_message(client, msg, path: str) -> str:
+    """Большие документы — по диапазонам в несколько соединений, остальные — целиком."""
+    if RANGED_WORKERS > 1 and (msg.file.size or 0) >= RANGED_MIN_SIZE:
+        return await download_ranged(client, msg, path)
+    await client.download_media(msg, file=path, progress_callback=PROXY_POOL.progress_callback(client))
+    return path
+
+
+async def sample_csv_document(client, msg, max_kb: int = TEST_SAMPLE_KB) -> dict:
+    """
+    Качает только первые max_kb КБ CSV-документа и разбирает заголовок
+    и первые строки. Размер берётся из метаданных, число строк — оценка
+    по средней длине строки в выборке.
+    """
+    want = max_kb * 1024
+    request_size = 64 * 1024
+    buf = bytearray()
+    async for chunk in client.iter_download(
+        msg.document, request_size=request_size,
+        limit=(want + request_size - 1) // request_size,
+    ):
+        buf.extend(chunk)
+
+    size = msg.file.size or len(buf)
+    complete = len(buf) >= size
+    if not complete:
+        # Последняя строка обрезана на границе выборки — отбрасываем её
+        cut = buf.rfind(b"\n")
+        if cut >= 0:
+            del buf[cut + 1:]
+    rows = [r for r in csv.reader(io.StringIO(buf.decode("utf-8-sig", errors="replace"))) if r]
+    header = [c.strip() for c in rows[0]] if rows else []
+    data_rows = rows[1:]
+
+    if complete or not buf:
+        row_estimate = len(data_rows)
+    else:
+        row_estimate = int(len(data_rows) * size / len(buf))
+    return {
+        "header":       header,
+        "rows":         data_rows,
+        "size":         size,
+        "sampled":      len(buf),
+        "complete":     complete,
+        "row_estimate": row_estimate,
+    }
+
 
-                    filename = orig_name.replace(".csv", f" {date_suffix}.csv")
-                    path = os.path.join(to_folder, filename)
-                    await msg.download_media(file=path)
+async def download_csv_from_channel(
+    channel: str,
+    to_folder: str,
+    limit: int = 7,
+    only_last_n: Optional[int] = None,
+    session_name: str = "session_master",
+    client=None,
+    day: Optional[datetime] = None,
+    throttle: bool = True,
+) -> List[str]:
+    """
+    Скачивает CSV из указанного TG-канала.
+    Перед подключением проверяет и при необходимости переключает прокси.
+    only_last_n: если задано — скачиваем только последние N файлов.
+    client: готовый клиент (например, takeout) — не подключаемся и не отключаем.
+    day: брать только сообщения этого дня (UTC) вместо последних limit.
+    throttle: паузы против FloodWait между файлами; False — только для takeout-сессии.
+    """
+    os.makedirs(to_folder, exist_ok=True)
+
+    own_client = client is None
+    if own_client:
+        client = await _connect_telegram(channel, session_name)
+        if client is None:
+            return []
+
+    offset_date = min_date = None
+    if day is not None:
+        min_date    = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+        offset_date = min_date + timedelta(days=1)
+        limit       = None
+    date_suffix = (day or datetime.today()).strftime("(%d.%m)")
+    result_files: List[str] = []
+
+    try:
+        # Резолвим entity (нужно для InputPeerChat — обычных групп)
+        resolved = await _resolve_channel(client, channel)
+        logger.info("Резолв канала %s → %s", channel, type(resolved).__name__)
+
+        async for msg, orig_name in _iter_channel_csv(client, resolved, limit, offset_date, min_date):
+            try:
+                filename = orig_name.replace(".csv", f" {date_suffix}.csv")
+                path = os.path.join(to_folder, filename)
+                await _download_message(client, msg, path)
+                result_files.append(path)
+                logger.info("✅ Скачан %s", filename)
+                if throttle:
+                    # Паузы против FloodWait обычной сессии (takeout их не требует)
                     if "6_web" in orig_name:
                         await asyncio.sleep(90)
-                    result_files.append(path)
-                    logger.info("✅ Скачан %s", filename)
                     await asyncio.sleep(random.uniform(10, 20))
             except Exception as e:
                 logger.exception("Ошибка при скачивании сообщения")
                 await send_error_async(f"Ошибка скачивания из {channel}: {e}")
     finally:
-        await client.disconnect()
+        if own_client:
+            await client.disconnect()
 
     if only_last_n is not None and len(result_files) > only_last_n:
         # Оставляем только последние N (они первые в iter_messages = свежие)
@@ -752,12 +1762,53 @@ async def download_csv_from_channel(
 # === ОБРАБОТКА CSV → TXT =====================================================
 # ══════════════════════════════════════════════════════════════════════════════
 
-def process_csv_files_ch1(files: List[str]) -> List[str]:
-    """Обработка CSV от канала 1 (старая логика + дедупликация)."""
-    today = datetime.today()
+# 6_web: channel_id → группа ББ (всё остальное — ББ ДОП_3)
+WEB6_CHANNEL_GROUPS = {"15883": "ББ", "15686": "ББ ДОП_1", "15273": "ББ ДОП_2"}
+
+
+def save_txt_outputs(output_data: Dict[str, set], label: str = "") -> List[str]:
+    """Пишет TXT по группам в /opt/bot/txt. Возвращает список путей."""
+    os.makedirs("/opt/bot/txt", exist_ok=True)
+    txt_files = []
+    for name, phones in output_data.items():
+        path = os.path.join("/opt/bot/txt", name)
+        # Дедупликация — phones уже Set
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(sorted(phones)))
+        txt_files.append(path)
+        logger.info("Сохранён TXT%s: %s (%d номеров)", label, name, len(phones))
+    return txt_files
+
+
+def save_approve_phones(approve_phones: set, today: datetime):
+    """LAL-файл b_approve_DD_MM_YYYY.txt из номеров CSV 253."""
+    if not approve_phones:
+        return
+    os.makedirs("/opt/bot/txt_for_lal", exist_ok=True)
+    date_str = today.strftime("%d_%m_%Y")
+    approve_path = f"/opt/bot/txt_for_lal/b_approve_{date_str}.txt"
+    with open(approve_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(sorted(approve_phones)))
+    logger.info("Сохранён LAL файл: %s (%d номеров)", approve_path, len(approve_phones))
+
+
+def process_csv_files_ch1(
+    files: List[str],
+    output_data: Optional[Dict[str, set]] = None,
+    approve_phones: Optional[set] = None,
+    today: Optional[datetime] = None,
+) -> List[str]:
+    """
+    Обработка CSV от канала 1 (старая логика + дедупликация).
+    output_data/approve_phones — накопители между вызовами (режим слушателя).
+    today — день, по которому считается номер (догрузка истории).
+    """
+    today = today or datetime.today()
     day_number = get_day_number(today)
-    output_data: Dict[str, set] = defaultdict(set)
-    approve_phones: set = set()
+    if output_data is None:
+        output_data = defaultdict(set)
+    if approve_phones is None:
+        approve_phones = set()
 
     for file in files:
         try:
@@ -795,7 +1846,7 @@ def process_csv_files_ch1(files: List[str]) -> List[str]:
                     if not phone:
                         continue
                     ch = str(row.get("channel_id", "")).strip()
-                    group = {"15883": "ББ", "15686": "ББ ДОП_1", "15273": "ББ ДОП_2"}.get(ch, "ББ ДОП_3")
+                    group = WEB6_CHANNEL_GROUPS.get(ch, "ББ ДОП_3")
                     output_data[f"{group} ({day_number}).txt"].add(phone)
 
             else:
@@ -813,37 +1864,26 @@ def process_csv_files_ch1(files: List[str]) -> List[str]:
             logger.exception(msg)
             send_error_sync(msg)
 
-    os.makedirs("/opt/bot/txt", exist_ok=True)
-    txt_files = []
-    for name, phones in output_data.items():
-        path = os.path.join("/opt/bot/txt", name)
-        # Дедупликация — phones уже Set
-        with open(path, "w", encoding="utf-8") as f:
-            f.write("\n".join(sorted(phones)))
-        txt_files.append(path)
-        logger.info("Сохранён TXT: %s (%d номеров)", name, len(phones))
-
-    if approve_phones:
-        os.makedirs("/opt/bot/txt_for_lal", exist_ok=True)
-        date_str = today.strftime("%d_%m_%Y")
-        approve_path = f"/opt/bot/txt_for_lal/b_approve_{date_str}.txt"
-        with open(approve_path, "w", encoding="utf-8") as f:
-            f.write("\n".join(sorted(approve_phones)))
-        logger.info("Сохранён LAL файл: %s (%d номеров)", approve_path, len(approve_phones))
-
+    txt_files = save_txt_outputs(output_data)
+    save_approve_phones(approve_phones, today)
     return txt_files
 
 
-def process_csv_files_ch2(files: List[str]) -> List[str]:
+def process_csv_files_ch2(
+    files: List[str],
+    output_data: Optional[Dict[str, set]] = None,
+    today: Optional[datetime] = None,
+) -> List[str]:
     """
     Обработка CSV от канала 2:
       web_121_* → КБ21 (день).txt
       web_122_* → КБ22 (день).txt
     Дедупликация номеров внутри каждого файла.
     """
-    today = datetime.today()
+    today = today or datetime.today()
     day_number = get_day_number(today)
-    output_data: Dict[str, set] = defaultdict(set)
+    if output_data is None:
+        output_data = defaultdict(set)
 
     for file in files:
         try:
@@ -868,16 +1908,229 @@ def process_csv_files_ch2(files: List[str]) -> List[str]:
             logger.exception("Ошибка обработки %s: %s", file, e)
             send_error_sync(f"Ошибка обработки CSV2 {file}: {e}")
 
-    os.makedirs("/opt/bot/txt", exist_ok=True)
-    txt_files = []
-    for name, phones in output_data.items():
-        path = os.path.join("/opt/bot/txt", name)
-        with open(path, "w", encoding="utf-8") as f:
-            f.write("\n".join(sorted(phones)))
-        txt_files.append(path)
-        logger.info("Сохранён TXT (канал 2): %s (%d номеров)", name, len(phones))
+    return save_txt_outputs(output_data, label=" (канал 2)")
 
-    return txt_files
+
+# ══════════════════════════════════════════════════════════════════════════════
+# === ПОТОКОВАЯ ОБРАБОТКА CSV (без записи на диск) ============================
+# ══════════════════════════════════════════════════════════════════════════════
+#
+# BOT_STREAM_CSV=1: чанки client.iter_download сразу идут в CsvStreamRouter,
+# номера раскладываются по тем же TXT-группам, что и в process_csv_files_ch1/ch2.
+# Скачивание и разбор перекрываются, CSV в /opt/bot/csv не пишется.
+# BOT_STREAM_DEBUG_DIR — если задан, туда дополнительно пишется копия CSV.
+
+class CsvStreamRouter:
+    """
+    Инкрементальный разбор CSV: принимает байтовые чанки, режет их на записи
+    (с учётом переводов строк внутри кавычек) и сразу раскладывает номера.
+    Работает внутри корутины скачивания — ошибки уходят фоном (notify_error).
+    """
+
+    def __init__(self, fname: str, channel_no: int, day_number: int,
+                 output_data: Dict[str, set], approve_phones: Optional[set] = None):
+        self.fname          = fname
+        self.channel_no     = channel_no
+        self.day_number     = day_number
+        self.output_data    = output_data
+        self.approve_phones = approve_phones if approve_phones is not None else set()
+        self.rows   = 0
+        self.phones = 0
+
+        if channel_no == 1:
+            self.output_name, self.group_key = get_output_filename(fname, day_number)
+        else:
+            self.output_name = get_ch2_output_filename(fname, day_number)
+            self.group_key   = "ch2" if self.output_name else None
+
+        self._decoder   = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+        self._tail      = ""     # неполная строка с конца предыдущего чанка
+        self._record    = ""     # запись с переводом строки внутри кавычек
+        self._phone_idx: Optional[int] = None
+        self._cid_idx:   Optional[int] = None
+        self._header_ok = False
+        self._header_seen = False
+
+    @property
+    def wanted(self) -> bool:
+        """Файл подпадает под обработку — есть смысл его скачивать."""
+        return bool(self.group_key)
+
+    def feed(self, chunk: bytes):
+        text  = self._tail + self._decoder.decode(chunk)
+        lines = text.split("\n")
+        self._tail = lines.pop()
+        for line in lines:
+            self._push_line(line + "\n")
+
+    def close(self) -> int:
+        """Дочитывает хвост. Возвращает количество разложенных номеров."""
+        text = self._tail + self._decoder.decode(b"", final=True)
+        self._tail = ""
+        if text:
+            self._push_line(text)
+        if self._record:
+            # Незакрытая кавычка в конце файла — разбираем как есть
+            self._handle_record(self._record)
+            self._record = ""
+
+        if self._header_ok and not self.phones:
+            msg = f"Пропущен пустой CSV: {self.fname}"
+            logger.warning(msg)
+            if self.channel_no == 1:
+                notify_error(msg)
+        return self.phones
+
+    def _push_line(self, line: str):
+        self._record += line
+        if self._record.count('"') % 2:
+            return  # кавычка не закрыта — запись продолжается на следующей строке
+        record, self._record = self._record, ""
+        self._handle_record(record)
+
+    def _handle_record(self, record: str):
+        row = next(csv.reader([record]), [])
+        if not row or not any(c.strip() for c in row):
+            return
+        if not self._header_seen:
+            self._handle_header([c.strip() for c in row])
+            return
+        if not self._header_ok:
+            return
+        self.rows += 1
+        self._route(row)
+
+    def _handle_header(self, header: List[str]):
+        self._header_seen = True
+        if "phone" not in header:
+            msg = f"Пропущен пустой CSV: {self.fname}"
+            logger.warning(msg)
+            if self.channel_no == 1:
+                notify_error(msg)
+            return
+        self._phone_idx = header.index("phone")
+        if "channel_id" in header:
+            self._cid_idx = header.index("channel_id")
+        elif self.group_key in ("broker", "6_web"):
+            notify_error(f"В {self.fname} нет channel_id")
+            return
+        self._header_ok = True
+
+    def _cell(self, row: List[str], idx: Optional[int]) -> str:
+        if idx is None or idx >= len(row):
+            return ""
+        return row[idx].strip()
+
+    def _route(self, row: List[str]):
+        phone = self._cell(row, self._phone_idx).replace("+", "").strip()
+        if not phone:
+            return
+        self.phones += 1
+        if self.group_key == "broker":
+            cid = self._cell(row, self._cid_idx)
+            self.output_data[broker_channel_group(cid, self.day_number)].add(phone)
+        elif self.group_key == "6_web":
+            group = WEB6_CHANNEL_GROUPS.get(self._cell(row, self._cid_idx), "ББ ДОП_3")
+            self.output_data[f"{group} ({self.day_number}).txt"].add(phone)
+        else:
+            if self.output_name:
+                self.output_data[self.output_name].add(phone)
+            if self.channel_no == 1 and "253" in self.fname:
+                self.approve_phones.add(phone)
+
+
+async def _stream_document(client, msg, router: CsvStreamRouter, debug_path: Optional[str] = None):
+    """
+    Качает документ чанками и параллельно скармливает их роутеру:
+    пока разбирается чанк N, запрос за чанком N+1 уже в пути.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+
+    async def _producer():
+        progress = PROXY_POOL.progress_callback(client)
+        received = 0
+        try:
+            async for chunk in client.iter_download(msg.document, request_size=STREAM_REQUEST_SIZE):
+                received += len(chunk)
+                progress(received, msg.file.size or 0)
+                await queue.put(chunk)
+        except Exception:
+            await queue.put(None)   # потребитель жив и дочитает очередь, ошибку отдаст await producer
+            raise
+        # Отмену (потребитель уже вышел) не глушим put'ом в полную очередь — он бы висел вечно
+        await queue.put(None)
+
+    producer = asyncio.create_task(_producer())
+    debug_f = open(debug_path, "wb") if debug_path else None
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            router.feed(chunk)
+            if debug_f:
+                debug_f.write(chunk)
+        await producer  # пробрасываем ошибку скачивания, если была
+    finally:
+        if not producer.done():
+            producer.cancel()
+        # Дожидаемся отменённого продюсера, не маскируя ошибку потребителя
+        await asyncio.gather(producer, return_exceptions=True)
+        if debug_f:
+            debug_f.close()
+    return router.close()
+
+
+async def stream_csv_from_channel(
+    channel: str,
+    channel_no: int,
+    output_data: Dict[str, set],
+    approve_phones: Optional[set] = None,
+    limit: int = 7,
+    only_last_n: Optional[int] = None,
+    session_name: str = "session_master",
+) -> int:
+    """
+    Потоковый аналог download_csv_from_channel + process_csv_files_ch1/ch2:
+    номера сразу попадают в output_data. Возвращает число разобранных CSV.
+    """
+    client = await _connect_telegram(channel, session_name)
+    if client is None:
+        return 0
+
+    day_number = get_day_number(datetime.today())
+    if STREAM_DEBUG_DIR:
+        os.makedirs(STREAM_DEBUG_DIR, exist_ok=True)
+    taken = 0
+    processed = 0
+
+    try:
+        resolved = await _resolve_channel(client, channel)
+        logger.info("Резолв канала %s → %s", channel, type(resolved).__name__)
+
+        async for msg, orig_name in _iter_channel_csv(client, resolved, limit):
+            if only_last_n is not None and taken >= only_last_n:
+                break
+            taken += 1
+            router = CsvStreamRouter(orig_name, channel_no, day_number, output_data, approve_phones)
+            if not router.wanted:
+                logger.info("Файл %s не подпадает под обработку (канал %d)", orig_name, channel_no)
+                continue
+            try:
+                debug_path = os.path.join(STREAM_DEBUG_DIR, orig_name) if STREAM_DEBUG_DIR else None
+                phones = await _stream_document(client, msg, router, debug_path)
+                processed += 1
+                logger.info("✅ Разобран потоком %s: %d строк, %d номеров", orig_name, router.rows, phones)
+                if "6_web" in orig_name:
+                    await asyncio.sleep(90)
+                await asyncio.sleep(random.uniform(10, 20))
+            except Exception as e:
+                logger.exception("Ошибка потоковой обработки %s", orig_name)
+                await send_error_async(f"Ошибка потокового скачивания из {channel}: {e}")
+    finally:
+        await client.disconnect()
+
+    return processed
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -898,115 +2151,557 @@ def upload_to_s3(file_path: str):
         send_error_sync(msg)
 
 
-def download_new_subs_from_s3(to_folder="/opt/bot/new_subs") -> Optional[str]:
-    if not NEW_S3_BUCKET:
+def download_new_subs_from_s3(to_folder="/opt/bot/new_subs") -> Optional[str]:
+    if not NEW_S3_BUCKET:
+        return None
+    yesterday = datetime.today() - timedelta(days=1)
+    filename = f"new_subs_{yesterday.strftime('%d_%m_%Y')}.txt"
+    os.makedirs(to_folder, exist_ok=True)
+    local_path = os.path.join(to_folder, filename)
+    try:
+        client = boto3.client(
+            "s3",
+            endpoint_url=NEW_S3_ENDPOINT or S3_ENDPOINT or None,
+            aws_access_key_id=NEW_S3_ACCESS_KEY or S3_ACCESS_KEY,
+            aws_secret_access_key=NEW_S3_SECRET_KEY or S3_SECRET_KEY
+        )
+        client.download_file(NEW_S3_BUCKET, filename, local_path)
+        logger.info("Скачан new_subs: %s", filename)
+        return local_path
+    except Exception as e:
+        logger.exception("Ошибка скачивания new_subs: %s", e)
+        send_error_sync(f"Ошибка new_subs S3: {e}")
+        return None
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# === TELEGRAM ОТПРАВКА =======================================================
+# ══════════════════════════════════════════════════════════════════════════════
+
+async def send_file_to_telegram(file_path: str, chat_id: str = CHAT_ID):
+    global _active_proxy  # объявляем в начале функции
+    if not BOT_TOKEN or not chat_id:
+        return
+
+    await ensure_proxy()
+    tier = PROXY_POOL.pick()
+    url = _bot_api_url(BOT_TOKEN, "sendDocument", tier)
+    proxy_label = (tier or _active_proxy or {}).get("label", "direct")
+    logger.info("📤 Отправка %s в TG via %s", os.path.basename(file_path), proxy_label)
+
+    timeout = aiohttp.ClientTimeout(connect=15, total=120)
+
+    async def _do_send(session):
+        with open(file_path, "rb") as f:
+            form = aiohttp.FormData()
+            form.add_field("chat_id", chat_id)
+            form.add_field("document", f)
+            form.add_field("disable_notification", "true")
+            async with session.post(url, data=form, headers=_proxy_headers(), timeout=timeout) as resp:
+                if resp.status != 200:
+                    txt = await resp.text()
+                    raise Exception(f"TG API {resp.status}: {txt}")
+
+    for attempt in range(1, 4):
+        try:
+            with PROXY_POOL.http(tier):
+                await _do_send(await http_sessions.get_session(tier or _active_proxy))
+            return  # успех
+        except Exception as e:
+            logger.warning("Ошибка отправки в TG (попытка %d): %s", attempt, e)
+            if attempt < 3:
+                PROXY_POOL.note_failure(proxy_label)
+                if tier is None or tier["label"] == (_active_proxy or {}).get("label"):
+                    _active_proxy = None
+                await ensure_proxy()
+                tier = PROXY_POOL.pick(exclude=(proxy_label,))
+                proxy_label = (tier or _active_proxy or {}).get("label", "direct")
+                url = _bot_api_url(BOT_TOKEN, "sendDocument", tier)
+                await asyncio.sleep(3)
+            else:
+                logger.exception("Не удалось отправить файл в TG")
+                await send_error_async(f"Ошибка отправки TG {file_path}: {e}")
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# === VK ЗАГРУЗКА =============================================================
+# ══════════════════════════════════════════════════════════════════════════════
+
+async def upload_user_list_vk(file_path: str, list_name: str, vk_token: str, list_type="phones",
+                              body: Optional[vk_ads.MultipartBody] = None) -> int:
+    return await vk_ads.get_client().upload_user_list(file_path, list_name, vk_token,
+                                                      list_type=list_type, body=body)
+
+
+async def create_segment_vk(list_ids, segment_name: str, vk_token: str) -> int:
+    return await vk_ads.get_client().create_segment(list_ids, segment_name, vk_token)
+
+
+def _split_base_name(file_path: str) -> Tuple[str, str]:
+    """«База (123).txt» → ('База (123)', 'База') — имя списка и имя базы для прав кабинета."""
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    # Убираем суффикс " (NNN)" из имени базы для проверки прав
+    if base_name.endswith(")"):
+        base_short = base_name.rsplit(" (", 1)[0]
+    else:
+        base_short = base_name
+    return base_name, base_short
+
+
+# ═══ === ДЕЛЬТА-ВЫГРУЗКА ===
+# Состояние на (кабинет, база): <fp>_<база>.npz — в одном файле отсортированные
+# номера, покрытые цепочкой списков (phones), и id списков цепочки (list_ids,
+# для relations сегмента). Файл заменяется целиком (os.replace) — номера и id
+# всегда из одной записи.
+
+def _delta_state_path(token: str, base_short: str) -> str:
+    stem = f"{vk_ads.token_fingerprint(token)}_{hashlib.sha1(base_short.encode()).hexdigest()[:12]}"
+    return os.path.join(VK_DELTA_DIR, stem + ".npz")
+
+
+def _load_delta_state(token: str, base_short: str) -> Optional[Tuple[np.ndarray, List[int]]]:
+    try:
+        with np.load(_delta_state_path(token, base_short)) as data:
+            return data["phones"], [int(i) for i in data["list_ids"]]
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Дельта-состояние «%s» не прочитано, будет полная выгрузка: %s", base_short, e)
+        return None
+
+
+def _save_delta_state(token: str, base_short: str, phones: np.ndarray, list_ids: List[int]):
+    os.makedirs(VK_DELTA_DIR, exist_ok=True)
+    path = _delta_state_path(token, base_short)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, phones=phones, list_ids=np.asarray(list_ids, dtype=np.int64))
+    os.replace(tmp, path)
+
+
+_phones_memo: Dict[tuple, Optional[np.ndarray]] = {}
+_phones_lock = threading.Lock()     # разбор из потоков fan-out: один файл — один разбор
+
+
+def _read_phones(file_path: str) -> Optional[np.ndarray]:
+    """
+    TXT → отсортированный уникальный int64-массив номеров (один разбор на fan-out).
+    None — в файле не только номера (или ведущие нули) — дельта для него не считается.
+    """
+    st = os.stat(file_path)
+    memo_key = (file_path, st.st_size, st.st_mtime_ns)
+    with _phones_lock:
+        if memo_key in _phones_memo:
+            return _phones_memo[memo_key]
+        if len(_phones_memo) >= 4:
+            _phones_memo.clear()
+        with open(file_path, "rb") as f:
+            lines = np.array(f.read().split())
+        phones = None
+        if lines.size == 0:
+            phones = np.empty(0, dtype=np.int64)
+        elif (np.char.isdigit(lines).all() and np.char.str_len(lines).max() <= 18
+              and not np.char.startswith(lines, b"0").any()):
+            phones = np.unique(lines.astype(np.int64))
+        _phones_memo[memo_key] = phones
+        return phones
+
+
+def _plan_delta(token: str, file_path: str) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, List[int]]]:
+    """
+    (номера сегодня, новые номера, номера цепочки, id её списков) или None — нужна полная выгрузка
+    (нет состояния, цепочка достигла VK_DELTA_MAX_CHAIN, файл не из одних номеров).
+    """
+    _, base_short = _split_base_name(file_path)
+    today = _read_phones(file_path)
+    state = _load_delta_state(token, base_short)
+    if today is None or state is None:
+        return None
+    prev, prev_ids = state
+    if len(prev_ids) >= VK_DELTA_MAX_CHAIN:
+        return None
+    new = np.setdiff1d(today, prev, assume_unique=True)
+    return today, new, prev, prev_ids
+
+
+def _commit_delta_state(token: str, base_short: str, file_path: str, list_ids: List[int],
+                        delta: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, List[int]]] = None):
+    """
+    Состояние цепочки после выгрузки: дельта — прежние номера плюс новые,
+    полная выгрузка — номера файла (новая цепочка). Вызывается через asyncio.to_thread.
+    """
+    if delta is not None:
+        _, new, prev, _ = delta
+        phones = np.union1d(prev, new)
+    else:
+        phones = _read_phones(file_path)
+        if phones is None:
+            return
+    _save_delta_state(token, base_short, phones, list_ids)
+
+
+def _phones_to_bytes(phones: np.ndarray) -> bytes:
+    return "\n".join(map(str, phones.tolist())).encode()
+
+
+async def _upload_shards(
+    cabinet: dict,
+    file_path: str,
+    bodies: List[vk_ads.MultipartBody],
+    list_type: str,
+    key: Optional[str] = None,
+) -> Optional[List[int]]:
+    """
+    Грузит список (или все его шарды параллельно), по слоту лимита на каждый.
+    Возвращает id списков; None — на все шарды лимита не хватило (ничего не грузили).
+    key — ключ кэша выгрузок: id каждого шарда запоминается сразу, и повтор
+    после частичной неудачи грузит только недостающие шарды.
+    """
+    token = cabinet["token"]
+    quota = vk_ads.get_quota_ledger()
+    cache = vk_ads.get_upload_cache()
+    sizes = [b.size for b in bodies]
+    done = cache.get_shards(key, sizes) if key else {}
+    todo = [i for i in range(len(bodies)) if i not in done]
+    # Резерв до запроса: параллельные выгрузки (и другие процессы) не превысят лимит
+    reserved = 0
+    while reserved < len(todo) and quota.reserve(token):
+        reserved += 1
+    if reserved < len(todo):
+        for _ in range(reserved):
+            quota.release(token)
+        logger.warning("Лимит загрузок для кабинета «%s» (нужно списков: %d)",
+                       cabinet.get("name"), len(todo))
+        return None
+
+    if len(bodies) > 1:
+        logger.info("VK: «%s» → кабинет «%s» шардами: %d по ≤%d байт%s",
+                    os.path.basename(file_path), cabinet.get("name"), len(bodies),
+                    max(b.size for b in bodies),
+                    f" (уже загружено {len(done)})" if done else "")
+
+    async def _upload_one(i: int) -> int:
+        list_id = await upload_user_list_vk(file_path, bodies[i].list_name, token,
+                                            list_type=list_type, body=bodies[i])
+        if key:
+            cache.put_shard(key, sizes, i, list_id)
+        return list_id
+
+    results = await asyncio.gather(*(_upload_one(i) for i in todo), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    for _ in errors:
+        quota.release(token)
+    if errors:
+        # Загруженные шарды остаются в кабинете (и в кэше), сегмент без всех шардов не создаём
+        raise next((e for e in errors if isinstance(e, vk_ads.VkCircuitOpen)), errors[0])
+    done.update(zip(todo, results))
+    return [done[i] for i in range(len(bodies))]
+
+
+async def _upload_list_stage(
+    cabinet: dict,
+    file_path: str,
+    list_name: Optional[str],
+    list_type: str,
+    body_for: Optional[Callable[[str, str], Awaitable[List[vk_ads.MultipartBody]]]] = None,
+    segment_prefix: str = "LAL ",
+) -> Optional[Tuple[str, List[int], str]]:
+    """
+    Этап 1 конвейера: загрузка списка в кабинет (через _upload_shards).
+    Тот же контент в том же кабинете (кэш vk_ads.UploadCache) повторно не грузится.
+
+    Возвращает (ключ кэша, id списков для сегмента, имя списка), если нужен сегмент, иначе None.
+    В дельта-режиме грузятся только новые номера, а в id — вся цепочка списков базы.
+    В первом случае блокировка ключа остаётся захваченной — её отпускает _segment_stage.
+    body_for(path, list_name) — общие для fan-out multipart-тела файла (шарды, если он большой).
+    Ошибка — задание уходит в очередь повтора (DeadLetterQueue), fan-out не ждёт.
+    """
+    token = cabinet["token"]
+    fname = os.path.basename(file_path)
+    base_name, base_short = _split_base_name(file_path)
+    effective_list_name = list_name or base_name
+
+    cache = vk_ads.get_upload_cache()
+    try:
+        # Хэш большого файла — в потоке; пропавший файл не должен ронять gather fan-out
+        digest = await asyncio.to_thread(vk_ads.file_sha256, file_path)
+    except Exception as e:
+        logger.exception("Ошибка чтения «%s» для кабинета «%s»", fname, cabinet.get("name"))
+        get_dlq().push(cabinet, file_path, f"hash: {e}", effective_list_name, list_type, segment_prefix)
         return None
-    yesterday = datetime.today() - timedelta(days=1)
-    filename = f"new_subs_{yesterday.strftime('%d_%m_%Y')}.txt"
-    os.makedirs(to_folder, exist_ok=True)
-    local_path = os.path.join(to_folder, filename)
+    key = cache.key(token, digest, list_type)
+    lock = cache.lock(key)
+    await lock.acquire()
+    handed_over = False
     try:
-        client = boto3.client(
-            "s3",
-            endpoint_url=NEW_S3_ENDPOINT or S3_ENDPOINT or None,
-            aws_access_key_id=NEW_S3_ACCESS_KEY or S3_ACCESS_KEY,
-            aws_secret_access_key=NEW_S3_SECRET_KEY or S3_SECRET_KEY
-        )
-        client.download_file(NEW_S3_BUCKET, filename, local_path)
-        logger.info("Скачан new_subs: %s", filename)
-        return local_path
+        hit = cache.get(key)
+        if hit and hit.get("segment_id"):
+            logger.info("♻️ VK upload: кабинет «%s» уже содержит «%s» (list_id=%s), пропускаем",
+                        cabinet.get("name"), fname, hit["list_id"])
+            get_dlq().discard(cabinet, file_path)
+            return None
+
+        use_delta = VK_DELTA_MODE and list_type == "phones"
+        if hit:
+            # Список уже загружен ранее, не хватает только сегмента — лимит не тратим
+            list_ids = hit.get("list_ids") or [hit["list_id"]]
+        else:
+            # Разбор файла и разность с цепочкой — numpy на полных списках, не в event loop
+            delta = await asyncio.to_thread(_plan_delta, token, file_path) if use_delta else None
+            if delta is not None and not len(delta[1]):
+                # Новых номеров нет — новый сегмент на прежнюю цепочку, без загрузки
+                list_ids = delta[3]
+                logger.info("Δ VK: кабинет «%s» «%s» — новых номеров нет, цепочка из %d списков",
+                            cabinet.get("name"), fname, len(list_ids))
+            else:
+                if delta is not None:
+                    today, new, prev, prev_ids = delta
+                    logger.info("Δ VK: кабинет «%s» «%s» — %d новых из %d",
+                                cabinet.get("name"), fname, len(new), len(today))
+                    bodies = await vk_ads.MultipartBody.shards_from_bytes(
+                        await asyncio.to_thread(_phones_to_bytes, new),
+                        f"{base_name} delta.txt", f"{effective_list_name} Δ{len(prev_ids)}", list_type,
+                    )
+                elif body_for:
+                    bodies = await body_for(file_path, effective_list_name)
+                else:
+                    bodies = await vk_ads.MultipartBody.load_shards(file_path, effective_list_name, list_type)
+
+                uploaded = await _upload_shards(cabinet, file_path, bodies, list_type, key)
+                if uploaded is None:
+                    return None
+                list_ids = uploaded
+                if delta is not None:
+                    list_ids = prev_ids + uploaded
+                if use_delta:
+                    # Полная выгрузка начинает новую цепочку, дельта её продолжает
+                    await asyncio.to_thread(_commit_delta_state, token, base_short, file_path, list_ids, delta)
+            cache.put(key, list_ids[-1], None, effective_list_name, list_ids)
+        handed_over = True
+        return key, list_ids, effective_list_name
+    except vk_ads.VkCircuitOpen:
+        raise
     except Exception as e:
-        logger.exception("Ошибка скачивания new_subs: %s", e)
-        send_error_sync(f"Ошибка new_subs S3: {e}")
+        logger.exception("Ошибка VK upload «%s» → кабинет «%s»", fname, cabinet.get("name"))
+        get_dlq().push(cabinet, file_path, f"upload: {e}", effective_list_name, list_type, segment_prefix)
         return None
+    finally:
+        if not handed_over:
+            lock.release()
 
 
-# ══════════════════════════════════════════════════════════════════════════════
-# === TELEGRAM ОТПРАВКА =======================================================
-# ══════════════════════════════════════════════════════════════════════════════
+async def _segment_stage(
+    cabinet: dict,
+    file_path: str,
+    key: str,
+    list_ids: List[int],
+    effective_list_name: str,
+    segment_prefix: str,
+    list_type: str = "phones",
+):
+    """
+    Этап 2 конвейера: сегмент по уже загруженным спискам (позитивное условие
+    на каждый). Повторяется сам, списки заново не грузятся; при неудаче
+    list_id остаётся в кэше, а задание — в очереди повтора: повтор создаст только сегмент.
+    """
+    list_id = list_ids[-1]
+    token = cabinet["token"]
+    fname = os.path.basename(file_path)
+    segment_name = f"{segment_prefix}{effective_list_name}"
+    cache = vk_ads.get_upload_cache()
+    try:
+        for attempt in range(1, VK_SEGMENT_RETRIES + 1):
+            try:
+                segment_id = await create_segment_vk(list_ids, segment_name, token)
+                break
+            except vk_ads.VkCircuitOpen:
+                raise
+            except Exception as e:
+                if attempt == VK_SEGMENT_RETRIES:
+                    raise
+                delay = VK_SEGMENT_RETRY_SEC * attempt
+                logger.warning("Сегмент «%s» в кабинете «%s», попытка %d/%d: %s. Повтор через %ds",
+                               segment_name, cabinet.get("name"), attempt, VK_SEGMENT_RETRIES, e, delay)
+                await asyncio.sleep(delay)
+        cache.put(key, list_id, segment_id, effective_list_name, list_ids)
+        get_dlq().discard(cabinet, file_path)
+        logger.info("✅ VK upload: кабинет «%s» ← «%s» list_id=%s",
+                    cabinet.get("name"), fname, list_id)
+    except Exception as e:
+        logger.exception("Ошибка VK сегмента «%s» → кабинет «%s» (список %s загружен)",
+                         fname, cabinet.get("name"), list_id)
+        get_dlq().push(cabinet, file_path, f"segment (список {list_id} загружен): {e}",
+                       effective_list_name, list_type, segment_prefix)
+    finally:
+        cache.lock(key).release()
 
-async def send_file_to_telegram(file_path: str, chat_id: str = CHAT_ID):
-    global _active_proxy  # объявляем в начале функции
-    if not BOT_TOKEN or not chat_id:
-        return
 
-    await ensure_proxy()
-    url = _bot_api_url(BOT_TOKEN, "sendDocument")
-    proxy_label = (_active_proxy or {}).get("label", "direct")
-    logger.info("📤 Отправка %s в TG via %s", os.path.basename(file_path), proxy_label)
+async def _upload_cached(token: str, file_path: str, list_type: str = "phones") -> bool:
+    """Файл уже выгружен в кабинет целиком (список + сегмент) — лимит не тратит."""
+    cache = vk_ads.get_upload_cache()
+    try:
+        # Первый хэш большого списка — в потоке, чтобы не стопорить listener'ы Telegram
+        digest = await asyncio.to_thread(vk_ads.file_sha256, file_path)
+    except OSError:
+        return False        # файл пропал — этап загрузки отправит его в очередь повтора
+    hit = cache.get(cache.key(token, digest, list_type))
+    return bool(hit and hit.get("segment_id"))
 
-    timeout = aiohttp.ClientTimeout(connect=15, total=120)
-    connector = _aiohttp_connector()
 
-    async def _do_send(session):
-        with open(file_path, "rb") as f:
-            form = aiohttp.FormData()
-            form.add_field("chat_id", chat_id)
-            form.add_field("document", f)
-            form.add_field("disable_notification", "true")
-            async with session.post(url, data=form, headers=_proxy_headers()) as resp:
-                if resp.status != 200:
-                    txt = await resp.text()
-                    raise Exception(f"TG API {resp.status}: {txt}")
+async def _fit_quota(cabinet: dict, paths: List[str], list_type: str = "phones") -> List[str]:
+    """
+    Обрезает список файлов кабинета под остаток суточного лимита.
+    paths — по убыванию приоритета; отбрасываются последние из новых загрузок.
+    """
+    token = cabinet["token"]
+    budget = vk_ads.get_quota_ledger().remaining(token)
+    fresh = [p for p in paths if not await _upload_cached(token, p, list_type)]
+    if len(fresh) <= budget:
+        return paths
+    dropped = set(fresh[budget:])
+    logger.warning("Кабинет «%s»: остаток лимита %d, не выгружаем %d файл(ов): %s",
+                   cabinet.get("name"), budget, len(dropped),
+                   ", ".join(os.path.basename(p) for p in fresh[budget:]))
+    return [p for p in paths if p not in dropped]
+
+
+class CabinetRouting:
+    """
+    Индекс маршрутизации на прогон: база → кабинеты, которым она разрешена,
+    и база → файл. Права кабинета (cabinet['bases'], пустой = все базы) —
+    множества, файл разбирается на имя базы один раз.
+    """
 
-    for attempt in range(1, 4):
-        try:
-            if connector:
-                async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-                    await _do_send(session)
-            else:
-                async with aiohttp.ClientSession(timeout=timeout) as session:
-                    await _do_send(session)
-            return  # успех
-        except Exception as e:
-            logger.warning("Ошибка отправки в TG (попытка %d): %s", attempt, e)
-            if attempt < 3:
-                _active_proxy = None
-                await ensure_proxy()
-                connector = _aiohttp_connector()
-                url = _bot_api_url(BOT_TOKEN, "sendDocument")
-                await asyncio.sleep(3)
-            else:
-                logger.exception("Не удалось отправить файл в TG")
-                await send_error_async(f"Ошибка отправки TG {file_path}: {e}")
+    def __init__(self, cabinets: List[dict], file_paths: List[str]):
+        self.cabinets = [c for c in cabinets if c.get("token", "")]
+        self._open: List[dict] = []                              # все базы разрешены
+        self._by_base: Dict[str, List[dict]] = defaultdict(list)
+        self._allowed: Dict[int, frozenset] = {}
+        for cabinet in self.cabinets:
+            allowed = frozenset(cabinet.get("bases") or ())
+            self._allowed[id(cabinet)] = allowed
+            if not allowed:
+                self._open.append(cabinet)
+            for base in allowed:
+                self._by_base[base].append(cabinet)
+
+        self.base_of: Dict[str, str] = {}
+        self.path_by_base: Dict[str, str] = {}
+        self.add_files(file_paths)
+
+    def add_files(self, file_paths: List[str]):
+        for path in file_paths:
+            if path not in self.base_of:
+                _, base_short = _split_base_name(path)
+                self.base_of[path] = base_short
+                self.path_by_base.setdefault(base_short, path)   # первый по приоритету
+
+    def cabinets_for(self, base_short: str) -> List[dict]:
+        return self._open + self._by_base.get(base_short, [])
+
+    def allows(self, cabinet: dict, path: str) -> bool:
+        allowed = self._allowed.get(id(cabinet), frozenset(cabinet.get("bases") or ()))
+        return not allowed or self.base_of[path] in allowed
+
+    def plan(self, file_paths: List[str]) -> List[Tuple[dict, List[str]]]:
+        """«кабинет → его файлы» по порядку file_paths — O(файлы + пары), без перебора кабинетов."""
+        self.add_files(file_paths)
+        per_cabinet: Dict[int, Tuple[dict, List[str]]] = {}
+        for path in file_paths:
+            for cabinet in self.cabinets_for(self.base_of[path]):
+                per_cabinet.setdefault(id(cabinet), (cabinet, []))[1].append(path)
+        return list(per_cabinet.values())
+
+
+async def upload_files_to_cabinets(
+    file_paths: List[str],
+    cabinets: List[dict],
+    list_name: Optional[str] = None,
+    list_type: str = "phones",
+    segment_prefix: str = "LAL ",
+    routing: Optional[CabinetRouting] = None,
+):
+    """
+    Fan-out: все кабинеты выгружаются одновременно, внутри кабинета файлы
+    идут по порядку file_paths (приоритет при лимите загрузок на токен).
+    Остаток суточного лимита проверяется заранее — лишние файлы не выгружаются.
+    Темп запросов держит vk_ads: ведро на токен + общий потолок конкурентности.
+    Фильтр: cabinet['bases'] — список разрешённых баз (пустой = все);
+    routing — готовый индекс прогона (иначе строится здесь).
+    """
+    routing = routing or CabinetRouting(cabinets, file_paths)
+    plan: List[Tuple[dict, List[str]]] = []
+    for cabinet, paths in routing.plan(file_paths):
+        paths = await _fit_quota(cabinet, paths, list_type)
+        if paths:
+            plan.append((cabinet, paths))
+    await _run_fanout(plan, list_name, list_type, segment_prefix)
 
 
-# ══════════════════════════════════════════════════════════════════════════════
-# === VK ЗАГРУЗКА =============================================================
-# ══════════════════════════════════════════════════════════════════════════════
+async def _run_fanout(
+    plan: List[Tuple[dict, List[str]]],
+    list_name: Optional[str] = None,
+    list_type: str = "phones",
+    segment_prefix: str = "LAL ",
+):
+    """
+    Выполняет план «кабинет → файлы»: кабинеты параллельно, файлы кабинета по порядку.
+    Внутри кабинета — конвейер: сегмент списка N создаётся, пока грузится список N+1.
+    Файл читается и кодируется в multipart один раз на весь fan-out; тело
+    освобождается, когда его прошли все кабинеты.
+    """
+    bodies: Dict[str, asyncio.Task] = {}
+    users: Dict[str, int] = defaultdict(int)
+    for _, paths in plan:
+        for path in paths:
+            users[path] += 1
+
+    async def _body_for(path: str, effective_list_name: str) -> List[vk_ads.MultipartBody]:
+        task = bodies.get(path)
+        if task is None:
+            task = bodies[path] = asyncio.create_task(
+                vk_ads.MultipartBody.load_shards(path, effective_list_name, list_type)
+            )
+        return await task
 
-def upload_user_list_vk(file_path: str, list_name: str, vk_token: str, list_type="phones") -> int:
-    url = f"{BASE_URL_V3}/remarketing/users_lists.json"
-    headers = {"Authorization": f"Bearer {vk_token}"}
-    files = {"file": open(file_path, "rb")}
-    data  = {"name": list_name, "type": list_type}
-    try:
-        resp = req_with_retry("POST", url, headers=headers, files=files, data=data, timeout=60)
-    finally:
-        files["file"].close()
-    result = resp.json()
-    if resp.status_code != 200 or isinstance(result.get("error"), dict):
-        raise Exception(f"VK upload error: {result}")
-    list_id = result.get("id")
-    if not list_id:
-        raise Exception(f"Нет list_id в ответе VK: {result}")
-    return list_id
-
-
-def create_segment_vk(list_id: int, segment_name: str, vk_token: str) -> int:
-    url = f"{BASE_URL_V2}/remarketing/segments.json"
-    headers = {"Authorization": f"Bearer {vk_token}", "Content-Type": "application/json"}
-    payload = {
-        "name": segment_name,
-        "pass_condition": 1,
-        "relations": [{"object_type": "remarketing_users_list",
-                        "params": {"source_id": list_id, "type": "positive"}}],
-    }
-    resp = req_with_retry("POST", url, headers=headers, json_body=payload, timeout=60)
-    result = resp.json()
-    if resp.status_code != 200 or isinstance(result.get("error"), dict):
-        raise Exception(f"VK segment error: {result}")
-    return result.get("id")
+    def _release_body(path: str):
+        users[path] -= 1
+        if users[path] <= 0:
+            bodies.pop(path, None)
+
+    async def _cabinet_worker(cabinet: dict, paths: List[str]):
+        segments: List[asyncio.Task] = []
+        try:
+            for i, path in enumerate(paths):
+                try:
+                    staged = await _upload_list_stage(cabinet, path, list_name, list_type,
+                                                      _body_for, segment_prefix)
+                except vk_ads.VkCircuitOpen as e:
+                    # Кабинет припаркован — остальные файлы не дёргают VK, а ждут повтора в очереди
+                    logger.warning("VK кабинет «%s» припаркован: %s. В очередь повтора: %s",
+                                   cabinet.get("name"), e, ", ".join(os.path.basename(p) for p in paths[i:]))
+                    dlq = get_dlq()
+                    for rest in paths[i:]:
+                        base_name, _ = _split_base_name(rest)
+                        dlq.push(cabinet, rest, f"кабинет припаркован: {e}",
+                                 list_name or base_name, list_type, segment_prefix)
+                    for rest in paths[i + 1:]:
+                        _release_body(rest)
+                    break
+                finally:
+                    _release_body(path)
+                if staged:
+                    segments.append(asyncio.create_task(
+                        _segment_stage(cabinet, path, *staged, segment_prefix, list_type)
+                    ))
+        finally:
+            if segments:
+                await asyncio.gather(*segments)
+
+    if plan:
+        logger.info("VK fan-out: %d кабинетов, %d выгрузок",
+                    len(plan), sum(len(p) for _, p in plan))
+        await asyncio.gather(*(_cabinet_worker(cab, paths) for cab, paths in plan))
 
 
 async def upload_file_to_cabinets(
@@ -1016,70 +2711,251 @@ async def upload_file_to_cabinets(
     list_type: str = "phones",
     segment_prefix: str = "LAL ",
 ):
-    """
-    Загружает один TXT-файл в кабинеты, у которых эта база разрешена.
-    Фильтр: cabinet['bases'] — список разрешённых баз (пустой = все).
-    """
-    fname = os.path.basename(file_path)
-    base_name = os.path.splitext(fname)[0]
-    # Убираем суффикс " (NNN)" из имени базы для проверки прав
-    if base_name.endswith(")"):
-        base_short = base_name.rsplit(" (", 1)[0]
-    else:
-        base_short = base_name
+    """Загружает один TXT-файл во все кабинеты, у которых эта база разрешена."""
+    await upload_files_to_cabinets([file_path], cabinets, list_name, list_type, segment_prefix)
 
-    effective_list_name = list_name or base_name
-    segment_name = f"{segment_prefix}{effective_list_name}"
 
-    for cabinet in cabinets:
-        token = cabinet.get("token", "")
-        if not token:
-            continue
+# ══════════════════════════════════════════════════════════════════════════════
+# === ОЧЕРЕДЬ ПОВТОРА VK (DEAD-LETTER) =========================================
+# ══════════════════════════════════════════════════════════════════════════════
 
-        # Проверяем разрешения: cabinet.bases пустой = все базы
-        allowed = cabinet.get("bases", [])
-        if allowed and base_short not in allowed:
-            logger.info("Кабинет «%s»: база «%s» не в списке разрешённых, пропускаем",
-                        cabinet.get("name"), base_short)
-            continue
+def _dlq_day() -> str:
+    """Текущие сутки пользователя (UTC+4) — повторы живут в пределах дня."""
+    return (now_utc() + timedelta(hours=4)).strftime("%Y-%m-%d")
 
-        if token not in VK_UPLOAD_COUNTERS:
-            VK_UPLOAD_COUNTERS[token] = 0
-        if VK_UPLOAD_COUNTERS[token] >= MAX_UPLOADS_PER_TOKEN:
-            logger.warning("Лимит загрузок для кабинета «%s»", cabinet.get("name"))
-            continue
 
+def _pid_alive(pid: Optional[int]) -> bool:
+    """Процесс pid жив (и это не мы) — его задания очереди не подхватываем."""
+    if not pid or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _dlq_day_end() -> float:
+    """Конец текущих суток UTC+4 как epoch."""
+    local = now_utc() + timedelta(hours=4)
+    midnight = (local + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return time.time() + (midnight - local).total_seconds()
+
+
+class DeadLetterQueue:
+    """
+    Неудавшиеся выгрузки (кабинет, файл) на диске (JSON, tmp + os.replace).
+    Файл общий для процессов (ежедневный прогон, ручной запуск): запись — под
+    flock с перечитыванием, меняются только свои ключи. Задание помечено pid
+    владельца; при старте подхватываются только задания завершившихся процессов.
+    Кабинет хранится отпечатком токена — при повторе токен берётся из cabinets.json.
+    Повтор через VK_DLQ_BASE_SEC × 2^(попытка-1), не дольше VK_DLQ_MAX_SEC,
+    не больше VK_DLQ_MAX_ATTEMPTS раз и не позже конца суток; записи прошлых дней отбрасываются.
+    Уведомление — при постановке в очередь и при окончательном отказе, фоном.
+    """
+
+    def __init__(self, path: str = VK_DLQ_PATH):
+        self.path = path
+        self._items: Dict[str, dict] = {}
+        with self._locked():
+            on_disk = self._read()
+        # Задания живого процесса (параллельный прогон) — его, не трогаем
+        self._items = {k: v for k, v in on_disk.items() if not _pid_alive(v.get("pid"))}
+        today = _dlq_day()
+        for v in self._items.values():
+            v["pid"] = os.getpid()
+            if v.get("next_at", 0) >= 1e12:
+                v["next_at"] = time.time()   # прошлый процесс упал посреди повтора
+        stale = [k for k, v in self._items.items() if v.get("day") != today]
+        for k in stale:
+            del self._items[k]
+        if stale:
+            logger.info("Очередь повтора VK: отброшено %d заданий прошлых дней", len(stale))
+        if self._items or stale:
+            self._save(*self._items, *stale)
+
+    @staticmethod
+    def _key(fp: str, file_path: str) -> str:
+        return f"{fp}:{file_path}"
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def push(self, cabinet: dict, file_path: str, error: str,
+             list_name: str, list_type: str, segment_prefix: str):
+        fp = vk_ads.token_fingerprint(cabinet["token"])
+        key = self._key(fp, file_path)
+        item = self._items.get(key) or {
+            "fp": fp, "cabinet": cabinet.get("name"), "path": file_path, "day": _dlq_day(),
+            "list_name": list_name, "list_type": list_type, "segment_prefix": segment_prefix,
+            "attempts": 0, "pid": os.getpid(),
+        }
+        item["attempts"] += 1
+        item["error"] = error[:500]
+        fname = os.path.basename(file_path)
+        delay = min(VK_DLQ_BASE_SEC * 2 ** (item["attempts"] - 1), VK_DLQ_MAX_SEC)
+        if item["attempts"] > VK_DLQ_MAX_ATTEMPTS or time.time() + delay > _dlq_day_end():
+            self._items.pop(key, None)
+            self._save(key)
+            msg = (f"VK upload «{fname}» → кабинет «{item['cabinet']}» не удался "
+                   f"после {item['attempts']} попыток: {error}")
+            logger.error(msg)
+            notify_error(msg)
+            return
+        item["next_at"] = time.time() + delay
+        self._items[key] = item
+        self._save(key)
+        if item["attempts"] == 1:
+            notify_error(f"Ошибка VK upload «{fname}» → кабинет «{item['cabinet']}»: {error}. "
+                         f"Повтор через {delay // 60} мин")
+        else:
+            logger.warning("VK upload «%s» → «%s»: попытка %d не удалась, повтор через %d мин",
+                           fname, item["cabinet"], item["attempts"], delay // 60)
+
+    def discard(self, cabinet: dict, file_path: str):
+        key = self._key(vk_ads.token_fingerprint(cabinet["token"]), file_path)
+        if self._items.pop(key, None):
+            logger.info("Очередь повтора VK: «%s» → «%s» выгружен",
+                        os.path.basename(file_path), cabinet.get("name"))
+            self._save(key)
+
+    def drop(self, key: str, reason: str):
+        item = self._items.pop(key, None)
+        if item:
+            logger.warning("Очередь повтора VK: «%s» → «%s» снят: %s",
+                           os.path.basename(item["path"]), item["cabinet"], reason)
+            self._save(key)
+
+    def take_due(self) -> List[Tuple[str, dict]]:
+        """Наступившие задания; до окончания попытки они не выдаются повторно."""
+        now = time.time()
+        due = [(k, v) for k, v in self._items.items() if v["next_at"] <= now]
+        for _, v in due:
+            v["next_at"] = float("inf")
+        return due
+
+    def next_due(self) -> Optional[float]:
+        pending = [v["next_at"] for v in self._items.values() if v["next_at"] != float("inf")]
+        return min(pending) if pending else None
+
+    def get(self, key: str) -> Optional[dict]:
+        return self._items.get(key)
+
+    @contextmanager
+    def _locked(self):
+        """Межпроцессная блокировка файла очереди (flock на соседний .lock)."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".lock", "w") as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def _read(self) -> Dict[str, dict]:
         try:
-            list_id = upload_user_list_vk(file_path, effective_list_name, token, list_type=list_type)
-            create_segment_vk(list_id, segment_name, token)
-            VK_UPLOAD_COUNTERS[token] += 1
-            logger.info("✅ VK upload: кабинет «%s» ← «%s» list_id=%s",
-                        cabinet.get("name"), fname, list_id)
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
         except Exception as e:
-            msg = f"Ошибка VK upload «{fname}» → кабинет «{cabinet.get('name')}»: {e}"
-            logger.exception(msg)
-            send_error_sync(msg)
+            logger.warning("Очередь повтора VK %s не прочитана: %s", self.path, e)
+            return {}
+
+    def _save(self, *keys: str):
+        """Перечитывает файл и переписывает в нём только keys — записи других процессов сохраняются."""
+        try:
+            with self._locked():
+                items = self._read()
+                for k in keys:
+                    v = self._items.get(k)
+                    if v is None:
+                        items.pop(k, None)
+                    else:
+                        items[k] = dict(v, next_at=min(v["next_at"], 1e12))
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(items, f, ensure_ascii=False)
+                os.replace(tmp, self.path)
+        except Exception as e:
+            logger.warning("Не удалось сохранить очередь повтора VK: %s", e)
+
+
+_dlq: Optional[DeadLetterQueue] = None
+
 
-        # Пауза между кабинетами
-        await asyncio.sleep(2)
+def get_dlq() -> DeadLetterQueue:
+    global _dlq
+    if _dlq is None:
+        _dlq = DeadLetterQueue()
+    return _dlq
+
+
+async def vk_dlq_worker(stop: asyncio.Event):
+    """
+    Фоновый повтор заданий из очереди. Работает параллельно основному fan-out /
+    планировщику; после stop — пока очередь не опустеет (повторы ограничены сутками).
+    main() ждёт его последним шагом, так что процесс может жить ещё до ~2.5 ч.
+    """
+    dlq = get_dlq()
+    while True:
+        due = dlq.take_due()
+        if due:
+            cabinets = {vk_ads.token_fingerprint(c["token"]): c for c in load_cabinets() if c.get("token")}
+            groups: Dict[Tuple[str, str, str], Dict[str, Tuple[dict, List[str]]]] = defaultdict(dict)
+            attempts = {}
+            for key, item in due:
+                cabinet = cabinets.get(item["fp"])
+                if cabinet is None:
+                    dlq.drop(key, "кабинет удалён или токен сменился")
+                    continue
+                if not os.path.exists(item["path"]):
+                    dlq.drop(key, "файл больше не существует")
+                    continue
+                attempts[key] = item["attempts"]
+                params = (item["list_name"], item["list_type"], item["segment_prefix"])
+                groups[params].setdefault(item["fp"], (cabinet, []))[1].append(item["path"])
+            logger.info("🔁 Очередь повтора VK: %d заданий", len(attempts))
+            for (list_name, list_type, segment_prefix), plan in groups.items():
+                try:
+                    await _run_fanout(list(plan.values()), list_name, list_type, segment_prefix)
+                except Exception as e:
+                    logger.exception("Ошибка повтора из очереди VK: %s", e)
+            # Задания, которые не выгрузились и не упали (лимит, кэш-блокировка), — снова в очередь
+            for key, item in due:
+                current = dlq.get(key)
+                if current is not None and current["attempts"] == attempts.get(key):
+                    cabinet = cabinets[item["fp"]]
+                    dlq.push(cabinet, item["path"], "не выполнено при повторе (лимит загрузок?)",
+                             item["list_name"], item["list_type"], item["segment_prefix"])
+
+        if stop.is_set() and not len(dlq):
+            return
+        next_at = dlq.next_due()
+        wait = CABINETS_POLL_SEC if next_at is None else max(0.0, min(next_at - time.time(), 60.0))
+        if stop.is_set():
+            await asyncio.sleep(wait)
+            continue
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 # === ПЛАНИРОВЩИК ВЫГРУЗКИ В VK ===============================================
 # ══════════════════════════════════════════════════════════════════════════════
 
-async def vk_upload_scheduler(cabinets: List[dict], txt_files: List[str]):
+def _schedule_specs(routing: CabinetRouting) -> Dict[Tuple[str, str], dict]:
     """
-    Для каждого кабинета и каждого файла из fileSchedules запускает выгрузку
-    в заданное время (UTC+4, хранится как hour/minute UTC в cabinets.json после
-    пересчёта на фронтенде).
-
-    Ждём, пока не наступит нужное время, потом загружаем.
-    Все задачи идут параллельно через asyncio.gather.
+    Разворачивает fileSchedules кабинетов в задания планировщика.
+    Ключ — (отпечаток токена, база); значение — кабинет, файл и время HH:MM UTC.
+    Файл базы — поиск в индексе routing.path_by_base.
     """
-    tasks = []
-
-    for cabinet in cabinets:
+    specs: Dict[Tuple[str, str], dict] = {}
+    for cabinet in routing.cabinets:
         schedules: dict = cabinet.get("fileSchedules", {})
         token = cabinet.get("token", "")
         if not token or not schedules:
@@ -1096,35 +2972,138 @@ async def vk_upload_scheduler(cabinets: List[dict], txt_files: List[str]):
             # Пользователь задаёт время в UTC+4, seconds_until_window работает с UTC
             hour = (hour - 4) % 24
 
-            # Найти файл для этой базы в txt_files
-            matching = [
-                p for p in txt_files
-                if os.path.basename(p).startswith(base_name + " (")
-                   or os.path.basename(p) == f"{base_name}.txt"
-            ]
-            if not matching:
+            # Файл этой базы: «База (N).txt» или «База.txt»
+            path = routing.path_by_base.get(base_name)
+            if path is None:
                 logger.info("Файл для базы «%s» не найден, пропускаем планировщик", base_name)
                 continue
 
-            file_path = matching[0]
+            specs[(vk_ads.token_fingerprint(token), base_name)] = {
+                "cabinet": cabinet, "path": path, "base": base_name,
+                "hour": hour, "minute": minute,
+            }
+    return specs
 
-            async def scheduled_upload(cab=cabinet, path=file_path, h=hour, m=minute, bname=base_name):
-                delay = seconds_until_window(h, m)
-                logger.info(
-                    "⏰ Кабинет «%s» файл «%s» — выгрузка через %.0f мин (%02d:%02d UTC = %02d:%02d UTC+4)",
-                    cab.get("name"), bname, delay / 60, h, m, (h + 4) % 24, m
-                )
-                await asyncio.sleep(delay)
-                try:
-                    await upload_file_to_cabinets(path, [cab])
-                except Exception as e:
-                    logger.exception("Ошибка плановой выгрузки: %s", e)
-                    send_error_sync(f"Ошибка плановой выгрузки «{bname}»: {e}")
 
-            tasks.append(scheduled_upload())
+async def vk_upload_scheduler(cabinets: List[dict], txt_files: List[str]):
+    """
+    Планировщик выгрузки: для каждого кабинета и каждого файла из fileSchedules
+    выгрузка в заданное время (UTC+4, хранится как hour/minute UTC в cabinets.json
+    после пересчёта на фронтенде).
+
+    Один цикл на куче сроков (heapq) вместо корутины на каждую пару:
+      • cabinets.json перечитывается при смене mtime — новые задания добавляются,
+        удалённые/выключенные отменяются, изменённое время переносится;
+      • задания, наступившие одновременно, уходят одним fan-out (кабинеты параллельно);
+      • задания сверх остатка суточного лимита кабинета не планируются
+        (остаются самые приоритетные по порядку txt_files).
+    Завершается, когда все задания выполнены.
+    """
+    heap: List[Tuple[float, int, Tuple[str, str]]] = []   # (срок, seq, ключ) — устаревшие пропускаются
+    pending: Dict[Tuple[str, str], dict] = {}
+    done: set = set()
+    running: set = set()
+    seq = 0
+    routing: Optional[CabinetRouting] = None   # пересобирается при каждом чтении cabinets.json
+
+    async def _apply(new_cabinets: List[dict]):
+        nonlocal seq
+        nonlocal routing
+        routing = CabinetRouting(new_cabinets, txt_files)
+        specs = _schedule_specs(routing)
+        # Лимит: по каждому кабинету оставляем приоритетные файлы из ещё не выполненных
+        by_cabinet: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
+        for key in specs:
+            if key not in done:
+                by_cabinet[key[0]].append(key)
+        allowed_keys = set()
+        for keys in by_cabinet.values():
+            cab = specs[keys[0]]["cabinet"]
+            order = {specs[k]["path"]: k for k in keys}
+            fitted = await _fit_quota(cab, [p for p in txt_files if p in order])
+            allowed_keys.update(order[p] for p in fitted)
+
+        for key in list(pending):
+            if key not in allowed_keys:
+                logger.info("⏹ Кабинет «%s» файл «%s» — выгрузка отменена",
+                            pending[key]["cabinet"].get("name"), key[1])
+                del pending[key]
+
+        for key in allowed_keys:
+            spec = specs[key]
+            old = pending.get(key)
+            if old and (old["hour"], old["minute"], old["path"]) == (spec["hour"], spec["minute"], spec["path"]):
+                old["cabinet"] = spec["cabinet"]   # токен/имя/базы могли смениться — время прежнее
+                continue
+            h, m = spec["hour"], spec["minute"]
+            delay = seconds_until_window(h, m)
+            spec["due"] = time.time() + delay
+            pending[key] = spec
+            seq += 1
+            heapq.heappush(heap, (spec["due"], seq, key))
+            logger.info(
+                "⏰ Кабинет «%s» файл «%s» — выгрузка через %.0f мин (%02d:%02d UTC = %02d:%02d UTC+4)%s",
+                spec["cabinet"].get("name"), spec["base"], delay / 60, h, m, (h + 4) % 24, m,
+                " (перенесено)" if old else "",
+            )
+
+    async def _run_batch(batch: List[dict]):
+        plan: Dict[str, Tuple[dict, List[str]]] = {}
+        for spec in batch:
+            fp = vk_ads.token_fingerprint(spec["cabinet"]["token"])
+            plan.setdefault(fp, (spec["cabinet"], []))[1].append(spec["path"])
+        try:
+            await _run_fanout([(cab, [p for p in paths if routing.allows(cab, p)])
+                               for cab, paths in plan.values()])
+        except Exception as e:
+            logger.exception("Ошибка плановой выгрузки: %s", e)
+            notify_error(f"Ошибка плановой выгрузки «{', '.join(s['base'] for s in batch)}»: {e}")
+
+    try:
+        mtime = os.path.getmtime(CABINETS_JSON)
+    except OSError:
+        mtime = None
+    await _apply(cabinets)
 
-    if tasks:
-        await asyncio.gather(*tasks)
+    while pending or running:
+        # Правки из портала
+        try:
+            new_mtime = os.path.getmtime(CABINETS_JSON)
+        except OSError:
+            new_mtime = mtime
+        if new_mtime != mtime:
+            try:
+                new_cabinets = _read_cabinets_json()
+                mtime = new_mtime
+                logger.info("🔄 cabinets.json изменён — пересчитываем расписание VK")
+                await _apply(new_cabinets)
+            except Exception as e:
+                # Портал мог ещё дописывать файл — повторим на следующем тике
+                logger.warning("cabinets.json не перечитан: %s", e)
+
+        # Всё, что наступило, — одним fan-out
+        now = time.time()
+        batch = []
+        while heap and heap[0][0] <= now:
+            due, _, key = heapq.heappop(heap)
+            spec = pending.get(key)
+            if spec is None or spec["due"] != due:
+                continue   # отменено или перенесено
+            del pending[key]
+            done.add(key)
+            batch.append(spec)
+        if batch:
+            task = asyncio.create_task(_run_batch(batch))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+        next_due = heap[0][0] - time.time() if heap else CABINETS_POLL_SEC
+        timeout = max(0.0, min(next_due, CABINETS_POLL_SEC))
+        if running and not pending:
+            # Ждать больше нечего — выходим, как только досчитаются последние fan-out
+            await asyncio.wait(set(running), timeout=timeout)
+        else:
+            await asyncio.sleep(timeout)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -1177,20 +3156,44 @@ async def task_channel1() -> List[str]:
     затем скачивает CSV из канала 1, обрабатывает, загружает в S3.
     Возвращает список txt-файлов.
     """
-    # Таймер запускает бота уже в нужное время — сразу качаем
+    # Таймер запускает бота уже в нужное время — сразу качаем.
+    # Если таймер сработал раньше окна (не более чем на PREWARM_SECONDS) —
+    # прогреваемся и стартуем ровно в начало окна.
     if not CHANNEL_NAME:
         logger.warning("CHANNEL_NAME не задан, пропускаем канал 1")
         return []
 
-    csv_files = await download_csv_from_channel(
-        CHANNEL_NAME, "/opt/bot/csv", limit=7, session_name="session_master"
-    )
-    if not csv_files:
-        await send_error_async("CSV файлы не найдены в канале 1")
-        return []
+    if not MANUAL_MODE and PREWARM_SECONDS:
+        delay = seconds_until_window(*CHANNEL1_WINDOW_START)
+        if delay <= PREWARM_SECONDS:
+            logger.info("Канал 1: прогрев, старт через %.0f с", delay)
+            await sleep_with_prewarm(delay, [CHANNEL_NAME])
+
+    if STREAM_CSV:
+        output_data: Dict[str, set] = defaultdict(set)
+        approve_phones: set = set()
+        processed = await stream_csv_from_channel(
+            CHANNEL_NAME, 1, output_data, approve_phones,
+            limit=7, session_name="session_master"
+        )
+        if not processed:
+            await send_error_async("CSV файлы не найдены в канале 1")
+            return []
+        txt_files = save_txt_outputs(output_data)
+        save_approve_phones(approve_phones, datetime.today())
+    else:
+        if len(TG_POOL) > 1:
+            csv_files = await download_csv_pooled(CHANNEL_NAME, "/opt/bot/csv", limit=7)
+        else:
+            csv_files = await download_csv_from_channel(
+                CHANNEL_NAME, "/opt/bot/csv", limit=7, session_name="session_master"
+            )
+        if not csv_files:
+            await send_error_async("CSV файлы не найдены в канале 1")
+            return []
 
-    txt_files = process_csv_files_ch1(csv_files)
-    cleanup_files(csv_files)
+        txt_files = process_csv_files_ch1(csv_files)
+        cleanup_files(csv_files)
 
     for f in txt_files:
         try:
@@ -1218,22 +3221,41 @@ async def task_channel2() -> List[str]:
         jitter = random.uniform(0, (end_m - start_m) * 60)
         wait   = delay + jitter
         logger.info("Канал 2: ждём %.0f мин до скачивания (05:02–05:06 UTC)", wait / 60)
-        await asyncio.sleep(wait)
+        if CHANNEL_NAME_2:
+            await sleep_with_prewarm(wait, [CHANNEL_NAME_2])
+        else:
+            await asyncio.sleep(wait)
 
     if not CHANNEL_NAME_2:
         logger.info("CHANNEL_NAME_2 не задан, пропускаем канал 2")
         return []
 
-    csv_files = await download_csv_from_channel(
-        CHANNEL_NAME_2, "/opt/bot/csv2", limit=7,
-        only_last_n=2, session_name="session_master"
-    )
-    if not csv_files:
-        await send_error_async("CSV файлы не найдены в канале 2")
-        return []
+    if STREAM_CSV:
+        output_data: Dict[str, set] = defaultdict(set)
+        processed = await stream_csv_from_channel(
+            CHANNEL_NAME_2, 2, output_data, limit=7,
+            only_last_n=CHANNEL2_LAST_N, session_name="session_master"
+        )
+        if not processed:
+            await send_error_async("CSV файлы не найдены в канале 2")
+            return []
+        txt_files = save_txt_outputs(output_data, label=" (канал 2)")
+    else:
+        if len(TG_POOL) > 1:
+            csv_files = await download_csv_pooled(
+                CHANNEL_NAME_2, "/opt/bot/csv2", limit=7, only_last_n=CHANNEL2_LAST_N
+            )
+        else:
+            csv_files = await download_csv_from_channel(
+                CHANNEL_NAME_2, "/opt/bot/csv2", limit=7,
+                only_last_n=CHANNEL2_LAST_N, session_name="session_master"
+            )
+        if not csv_files:
+            await send_error_async("CSV файлы не найдены в канале 2")
+            return []
 
-    txt_files = process_csv_files_ch2(csv_files)
-    cleanup_files(csv_files)
+        txt_files = process_csv_files_ch2(csv_files)
+        cleanup_files(csv_files)
 
     for f in txt_files:
         try:
@@ -1244,6 +3266,174 @@ async def task_channel2() -> List[str]:
     return txt_files
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+# === РЕЖИМ СЛУШАТЕЛЯ (events.NewMessage) =====================================
+# ══════════════════════════════════════════════════════════════════════════════
+#
+# Вместо ожидания окон и опроса iter_messages — обработчики NewMessage на оба
+# канала. Каждый CSV скачивается и раскладывается сразу после публикации,
+# изменённые TXT тут же уходят в S3. Номера копятся за день, так что файлы,
+# пишущие в один TXT (253 и 345 → Б1), не затирают друг друга.
+
+class _ChannelIngest:
+    """Состояние одного канала в режиме слушателя."""
+
+    def __init__(self, channel: str, channel_no: int, to_folder: str,
+                 max_files: Optional[int] = None):
+        self.channel    = channel
+        self.channel_no = channel_no
+        self.to_folder  = to_folder
+        self.max_files  = max_files
+        self.output_data: Dict[str, set] = defaultdict(set)
+        self.approve_phones: set = set()
+        self.seen_names: set = set()
+        self.txt_files:  set = set()
+        self.files = 0
+        self.last_file_at: Optional[float] = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def complete(self) -> bool:
+        """Канал 2 — после max_files файлов, канал 1 — после LISTEN_SETTLE_SEC тишины."""
+        if self.max_files is not None:
+            return self.files >= self.max_files
+        return (self.last_file_at is not None
+                and time.monotonic() - self.last_file_at >= LISTEN_SETTLE_SEC)
+
+    def accepts(self, msg) -> bool:
+        if not (msg.file and msg.file.name and msg.file.name.endswith(".csv")):
+            return False
+        if msg.file.name in ("389.csv", "390.csv") or msg.file.name in self.seen_names:
+            return False
+        return self.max_files is None or self.files < self.max_files
+
+
+async def _ingest_message(client, msg, ingest: _ChannelIngest):
+    """Скачивает и сразу обрабатывает один CSV, дописывает изменённые TXT в S3."""
+    async with ingest.lock:
+        if not ingest.accepts(msg):
+            return
+        orig_name = msg.file.name
+        ingest.seen_names.add(orig_name)
+        ingest.files += 1
+        before = {name: len(phones) for name, phones in ingest.output_data.items()}
+        logger.info("📨 Канал %d: новый CSV %s", ingest.channel_no, orig_name)
+
+        try:
+            if STREAM_CSV:
+                day_number = get_day_number(datetime.today())
+                router = CsvStreamRouter(orig_name, ingest.channel_no, day_number,
+                                         ingest.output_data, ingest.approve_phones)
+                if not router.wanted:
+                    logger.info("Файл %s не подпадает под обработку (канал %d)",
+                                orig_name, ingest.channel_no)
+                    return
+                debug_path = os.path.join(STREAM_DEBUG_DIR, orig_name) if STREAM_DEBUG_DIR else None
+                if debug_path:
+                    os.makedirs(STREAM_DEBUG_DIR, exist_ok=True)
+                await _stream_document(client, msg, router, debug_path)
+            else:
+                os.makedirs(ingest.to_folder, exist_ok=True)
+                date_suffix = datetime.today().strftime("(%d.%m)")
+                path = os.path.join(ingest.to_folder, orig_name.replace(".csv", f" {date_suffix}.csv"))
+                await _download_message(client, msg, path)
+                try:
+                    if ingest.channel_no == 1:
+                        process_csv_files_ch1([path], ingest.output_data, ingest.approve_phones)
+                    else:
+                        process_csv_files_ch2([path], ingest.output_data)
+                finally:
+                    cleanup_files([path])
+        except Exception as e:
+            logger.exception("Ошибка обработки %s (слушатель)", orig_name)
+            await send_error_async(f"Ошибка обработки {orig_name} из канала {ingest.channel_no}: {e}")
+            return
+        finally:
+            ingest.last_file_at = time.monotonic()
+
+        changed = {name: phones for name, phones in ingest.output_data.items()
+                   if len(phones) != before.get(name)}
+        if STREAM_CSV:
+            label = "" if ingest.channel_no == 1 else " (канал 2)"
+            save_txt_outputs(changed, label=label)
+            save_approve_phones(ingest.approve_phones, datetime.today())
+        for name in changed:
+            path = os.path.join("/opt/bot/txt", name)
+            ingest.txt_files.add(path)
+            try:
+                upload_to_s3(path)
+            except Exception as e:
+                send_error_sync(f"S3 ошибка {path}: {e}")
+        logger.info("✅ Канал %d: %s обработан, обновлено TXT: %d",
+                    ingest.channel_no, orig_name, len(changed))
+
+
+async def listen_channels() -> Tuple[List[str], List[str]]:
+    """
+    Слушает оба канала до прихода всех файлов или до LISTEN_DEADLINE (UTC).
+    Файлы, опубликованные сегодня до запуска, подхватываются сразу.
+    Возвращает (txt_files_ch1, txt_files_ch2).
+    """
+    from telethon import events
+
+    ingests: List[_ChannelIngest] = []
+    if CHANNEL_NAME:
+        ingests.append(_ChannelIngest(CHANNEL_NAME, 1, "/opt/bot/csv"))
+    else:
+        logger.warning("CHANNEL_NAME не задан, пропускаем канал 1")
+    if CHANNEL_NAME_2:
+        ingests.append(_ChannelIngest(CHANNEL_NAME_2, 2, "/opt/bot/csv2", max_files=CHANNEL2_LAST_N))
+    else:
+        logger.info("CHANNEL_NAME_2 не задан, пропускаем канал 2")
+    if not ingests:
+        return [], []
+
+    client = await _connect_telegram("слушатель", "session_master")
+    if client is None:
+        return [], []
+
+    try:
+        resolved_list = []
+        for ingest in ingests:
+            resolved = await _resolve_channel(client, ingest.channel)
+            resolved_list.append(resolved)
+
+            async def _on_new_message(event, ingest=ingest):
+                await _ingest_message(client, event.message, ingest)
+
+            client.add_event_handler(_on_new_message, events.NewMessage(chats=resolved))
+            logger.info("👂 Слушаем канал %d (%s)", ingest.channel_no, ingest.channel)
+
+        # Догоняем файлы, опубликованные сегодня до запуска (свежие первыми)
+        today_utc = now_utc().date()
+        for ingest, resolved in zip(ingests, resolved_list):
+            async for msg in client.iter_messages(resolved, limit=7):
+                if msg.date and msg.date.date() == today_utc:
+                    await _ingest_message(client, msg, ingest)
+
+        wait = seconds_until_window(*LISTEN_DEADLINE)
+        if wait > 12 * 3600:
+            wait = 0  # дедлайн сегодня уже прошёл — только догоняющая выборка
+        logger.info("👂 Ждём файлы до %02d:%02d UTC (%.0f мин)", *LISTEN_DEADLINE, wait / 60)
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline and not all(i.complete for i in ingests):
+            await asyncio.sleep(5)
+
+        # Дожидаемся файлов, которые обрабатываются прямо сейчас
+        for ingest in ingests:
+            async with ingest.lock:
+                pass
+    finally:
+        await client.disconnect()
+
+    result: Dict[int, List[str]] = {1: [], 2: []}
+    for ingest in ingests:
+        if not ingest.files:
+            await send_error_async(f"CSV файлы не найдены в канале {ingest.channel_no} (слушатель)")
+        result[ingest.channel_no] = sorted(ingest.txt_files)
+    return result[1], result[2]
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # === ГЛАВНЫЙ ПРОЦЕСС =========================================================
 # ══════════════════════════════════════════════════════════════════════════════
@@ -1315,11 +3505,93 @@ async def refresh_portal_bases():
     await loop.run_in_executor(None, refresh_portal_bases_sync)
 
 
+async def _backfill_days(tg, days: List[datetime], throttle: bool) -> List[str]:
+    """
+    Для каждого дня: CSV обоих каналов → обработка с номером этого дня → S3.
+    throttle=False — tg это takeout-сессия, паузы против FloodWait не нужны.
+    """
+    all_txt: List[str] = []
+    for day in days:
+        day_number = get_day_number(day)
+        logger.info("📚 Догрузка %s (день %d)", day.strftime("%d.%m.%Y"), day_number)
+        txt_files: List[str] = []
+
+        if CHANNEL_NAME:
+            csv_files = await download_csv_from_channel(
+                CHANNEL_NAME, "/opt/bot/csv_backfill", client=tg, day=day, throttle=throttle
+            )
+            txt_files += process_csv_files_ch1(csv_files, today=day)
+            cleanup_files(csv_files)
+        if CHANNEL_NAME_2:
+            csv_files = await download_csv_from_channel(
+                CHANNEL_NAME_2, "/opt/bot/csv2_backfill", client=tg, day=day,
+                only_last_n=CHANNEL2_LAST_N, throttle=throttle,
+            )
+            txt_files += process_csv_files_ch2(csv_files, today=day)
+            cleanup_files(csv_files)
+
+        if not txt_files:
+            logger.warning("За %s файлов нет", day.strftime("%d.%m.%Y"))
+        for f in txt_files:
+            try:
+                upload_to_s3(f)
+            except Exception as e:
+                send_error_sync(f"S3 ошибка {f}: {e}")
+        all_txt += txt_files
+    return all_txt
+
+
+async def run_backfill(date_range: str):
+    """
+    Догрузка истории за диапазон дат (ГГГГ-ММ-ДД[:ГГГГ-ММ-ДД]).
+    Takeout-сессия Telegram даёт заметно более мягкие лимиты на массовое
+    чтение и скачивание, чем обычная. TXT получают номера своих дней
+    и уходят в S3; выгрузка в VK не выполняется.
+    """
+    from telethon.errors import TakeoutInitDelayError
+
+    start_s, _, end_s = date_range.partition(":")
+    date_from = datetime.strptime(start_s.strip(), "%Y-%m-%d")
+    date_to   = datetime.strptime((end_s or start_s).strip(), "%Y-%m-%d")
+    days = [date_from + timedelta(days=i) for i in range((date_to - date_from).days + 1)]
+    logger.info("=== 📚 Догрузка истории: %s — %s (%d дн.) ===",
+                date_from.strftime("%d.%m.%Y"), date_to.strftime("%d.%m.%Y"), len(days))
+    if not days:
+        logger.error("Пустой диапазон дат: %s", date_range)
+        return
+
+    await select_proxy()
+    client = await _connect_telegram("догрузка", "session_master")
+    if client is None:
+        return
+
+    try:
+        try:
+            async with client.takeout(finalize=True, chats=True, megagroups=True,
+                                      channels=True, files=True) as takeout:
+                txt_files = await _backfill_days(takeout, days, throttle=False)
+        except TakeoutInitDelayError as e:
+            msg = (f"Takeout требует подтверждения в приложении Telegram "
+                   f"(или повтора через {e.seconds} с) — догружаем обычной сессией")
+            logger.warning(msg)
+            await send_error_async(msg)
+            txt_files = await _backfill_days(client, days, throttle=True)
+    finally:
+        await client.disconnect()
+
+    if txt_files:
+        await refresh_portal_bases()
+    logger.info("=== 📚 Догрузка завершена: %d TXT ===", len(txt_files))
+    await drain_notifications()
+    await http_sessions.close_sessions()
+
+
 async def run_test():
     """
     Тест-режим:
       1) Показывает первые 15 диалогов — для поиска ID каналов
-      2) Проверяет канал 1: находит наименьший CSV и берёт 10 строк
+      2) Проверяет канал 1: находит наименьший CSV, читает первые
+         TEST_SAMPLE_KB КБ и берёт 10 номеров
       3) Проверяет канал 2 (если задан): показывает последние 2 файла
       4) Загружает test.txt в первый кабинет VK
     """
@@ -1333,7 +3605,7 @@ async def run_test():
 
     print(f"Параметры: диалоги={DO_DIALOGS} канал1={DO_CHANNEL1} канал2={DO_CHANNEL2} vk={DO_VK}\n")
 
-    select_proxy()
+    await select_proxy()
 
     from telethon.tl.types import Channel, Chat
 
@@ -1397,25 +3669,23 @@ async def run_test():
                     smallest_size, smallest_msg = candidates[0]
                     print(f"  Файлов найдено: {len(candidates)}")
                     print(f"  Самый маленький: {smallest_msg.file.name} ({smallest_size // 1024} KB)")
-                    os.makedirs("/opt/bot/csv_test", exist_ok=True)
-                    path = f"/opt/bot/csv_test/test_ch1_{smallest_msg.file.name}"
-                    await smallest_msg.download_media(file=path)
-                    print(f"  ✅ Скачан: {smallest_msg.file.name}")
                     try:
-                        df = pd.read_csv(path)
-                        total = len(df)
-                        cols  = list(df.columns)
-                        print(f"  Строк: {total}, колонки: {cols}")
-                        if "phone" in df.columns:
-                            phones_count = df["phone"].dropna().count()
-                            print(f"  Номеров телефонов: {phones_count}")
+                        info = await sample_csv_document(client, smallest_msg)
+                        cols = info["header"]
+                        total_note = "" if info["complete"] else " (оценка по метаданным)"
+                        print(f"  ✅ Прочитано {info['sampled'] // 1024} KB из {info['size'] // 1024} KB")
+                        print(f"  Строк: ~{info['row_estimate']}{total_note}, колонки: {cols}")
+                        if "phone" in cols:
+                            idx = cols.index("phone")
+                            sample = [
+                                row[idx].replace("+", "").strip()
+                                for row in info["rows"]
+                                if len(row) > idx and row[idx].replace("+", "").strip()
+                            ]
+                            print(f"  Номеров в выборке: {len(sample)}")
+                            sample = sample[:10]
                             test_txt = "/opt/bot/txt/test.txt"
                             os.makedirs("/opt/bot/txt", exist_ok=True)
-                            sample = [
-                                str(p).replace("+", "").strip()
-                                for p in df["phone"].dropna()
-                                if str(p).replace("+", "").strip()
-                            ][:10]
                             with open(test_txt, "w") as f:
                                 f.write("\n".join(sample))
                             print(f"  test.txt: {len(sample)} номеров (для VK)")
@@ -1425,9 +3695,6 @@ async def run_test():
                     except Exception as e:
                         print(f"  ❌ Ошибка чтения CSV: {e}")
                         test_txt = None
-                    finally:
-                        try: os.remove(path)
-                        except Exception: pass
                 print()
 
         # ── 3. Проверка канала 2 ────────────────────────────────────────────
@@ -1502,12 +3769,13 @@ async def run_test():
             cab = cabs[0]
             print(f"📤 VK: загружаем test.txt в кабинет «{cab.get('name')}»...")
             try:
-                list_id = upload_user_list_vk(test_txt, "test", cab["token"], list_type="phones")
-                create_segment_vk(list_id, "LAL test", cab["token"])
+                list_id = await upload_user_list_vk(test_txt, "test", cab["token"], list_type="phones")
+                await create_segment_vk(list_id, "LAL test", cab["token"])
                 print(f"  ✅ Загружено в «{cab.get('name')}» (list_id={list_id})")
             except Exception as e:
                 print(f"  ❌ Ошибка VK: {e}")
             finally:
+                await vk_ads.close_client()
                 try: os.remove(test_txt)
                 except Exception: pass
     else:
@@ -1517,13 +3785,15 @@ async def run_test():
             except Exception: pass
 
     logger.info("=== 🧪 ТЕСТ ЗАВЕРШЁН ===")
+    await drain_notifications()
+    await http_sessions.close_sessions()
 
 
 async def main():
     logger.info("=== 🚀 Запуск bot_master v%s ===", VersionBotMaster)
 
     # 0a) Выбираем рабочий прокси при старте
-    select_proxy()
+    await select_proxy()
 
     # 0b) new_subs из дополнительного S3
     new_subs_path = download_new_subs_from_s3()
@@ -1532,7 +3802,10 @@ async def main():
     leads_sub6_path = await process_previous_day_file()
 
     # 2) Скачивание из каналов
-    if MANUAL_MODE:
+    if LISTEN_MODE:
+        logger.info("👂 Режим слушателя: файлы обрабатываются по мере публикации")
+        txt_files_ch1, txt_files_ch2 = await listen_channels()
+    elif MANUAL_MODE:
         logger.info("🖱 Ручной режим: ch1=%s ch2=%s vk=%s", MANUAL_CH1, MANUAL_CH2, MANUAL_VK)
         txt_files_ch1 = await task_channel1() if MANUAL_CH1 else []
         txt_files_ch2 = await task_channel2() if MANUAL_CH2 else []
@@ -1588,27 +3861,24 @@ async def main():
 
     # 8) Загружаем в VK
     do_vk = MANUAL_VK if MANUAL_MODE else VK_UPLOAD
+    dlq_task = None
     if do_vk:
         cabinets = load_cabinets()
         if not cabinets:
             logger.warning("Кабинеты не загружены из портала, VK выгрузка пропущена")
         else:
             logger.info("Загружено %d кабинетов из портала", len(cabinets))
+            dlq_stop = asyncio.Event()
+            dlq_task = asyncio.create_task(vk_dlq_worker(dlq_stop))
             if MANUAL_MODE:
                 logger.info("🖱 Ручная VK выгрузка (без расписания)")
-                for path in files_pipeline:
-                    await upload_file_to_cabinets(path, cabinets)
+                await upload_files_to_cabinets(files_pipeline, cabinets)
             else:
                 await vk_upload_scheduler(cabinets, files_pipeline)
+            # Повторы из очереди дожидаемся в конце — max_checker и очистка их не ждут
+            dlq_stop.set()
 
-    # 9) Удаляем new_subs
-    try:
-        if new_subs_path and os.path.exists(new_subs_path):
-            os.remove(new_subs_path)
-    except Exception:
-        logger.exception("Ошибка удаления new_subs")
-
-    # 10) Ждём max_checker
+    # 9) Ждём max_checker
     if checker_task is not None:
         logger.info("⏳ Ожидаем max_checker...")
         try:
@@ -1618,20 +3888,40 @@ async def main():
             logger.exception("Ошибка max_checker")
             await send_error_async(f"max_checker: {e}")
 
-    # 11) Очистка
+    # 10) Очистка
     try:
         cleanup_previous_day_txt_files()
     except Exception:
         logger.exception("Ошибка очистки файлов")
 
+    # 11) Повторы VK из очереди (до ~2.5 ч, см. VK_DLQ_*) — new_subs нужен им до конца
+    if dlq_task is not None:
+        if len(get_dlq()):
+            next_at = get_dlq().next_due()
+            logger.info("⏳ Ожидаем повторы VK из очереди (%d заданий, ближайший через %.0f мин)...",
+                        len(get_dlq()), max(0.0, (next_at or time.time()) - time.time()) / 60)
+        await dlq_task
+    await vk_ads.close_client()
+
+    # 12) Удаляем new_subs
+    try:
+        if new_subs_path and os.path.exists(new_subs_path):
+            os.remove(new_subs_path)
+    except Exception:
+        logger.exception("Ошибка удаления new_subs")
+
     logger.info("✅ bot_master завершён")
 
     # Завершаем SSH-туннель если использовался
-    _stop_ssh_tunnel()
+    await SSH_TUNNEL.stop()
+    await drain_notifications()
+    await http_sessions.close_sessions()
 
 
 if __name__ == "__main__":
     if TEST_MODE:
         asyncio.run(run_test())
+    elif BACKFILL_RANGE:
+        asyncio.run(run_backfill(BACKFILL_RANGE))
     else:
         asyncio.run(main())
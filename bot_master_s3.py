@@ -14,6 +14,8 @@ from datetime import datetime, timedelta
 from telethon import TelegramClient
 from collections import defaultdict
 
+import vk_ads
+
 load_dotenv()
 
 # === Настройки ===
@@ -56,75 +58,9 @@ s3 = boto3.client(
     aws_secret_access_key=S3_SECRET_KEY
 )
 
-# === VK API URLs ===
-BASE_URL_V3 = "https://ads.vk.com/api/v3"
-BASE_URL_V2 = "https://ads.vk.com/api/v2"
-
-MAX_UPLOADS_PER_TOKEN = 20  # максимум загрузок на один кабинет
-VK_UPLOAD_COUNTERS = {}
-
-# === HTTP с повторами и обработкой rate limit ===
-RETRY_COUNT = 3
-RETRY_BACKOFF = 2
-RATE_LIMIT_SLEEP = (10, 30)
-
-def req_with_retry(
-    method: str,
-    url: str,
-    headers: Dict[str, str],
-    params: Optional[Dict[str, Any]] = None,
-    json_body: Optional[Dict[str, Any]] = None,
-    files: Optional[Dict[str, Any]] = None,
-    data: Optional[Dict[str, Any]] = None,
-    timeout: int = 60
-) -> requests.Response:
-    last_exc: Optional[Exception] = None
-
-    for attempt in range(1, RETRY_COUNT + 1):
-        try:
-            resp = requests.request(
-                method, url,
-                headers=headers,
-                params=params,
-                json=json_body,
-                data=data,
-                files=files,
-                timeout=timeout
-            )
-
-            # === Обработка rate limit ===
-            if resp.status_code == 429:
-                retry_after = int(resp.headers.get("Retry-After", "5"))
-                logger.warning(f"⚠️ VK API rate limit (429). Пауза {retry_after}s перед повтором...")
-                time.sleep(retry_after)
-                continue
-
-            try:
-                result = resp.json()
-                vk_error = result.get("error", {})
-                if isinstance(vk_error, dict) and vk_error.get("error_code") in (9, 29):
-                    sleep_for = random.uniform(*RATE_LIMIT_SLEEP)
-                    logger.warning(f"⚠️ VK flood control ({vk_error.get('error_code')}). "
-                                   f"Пауза {sleep_for:.1f}s перед повтором...")
-                    time.sleep(sleep_for)
-                    continue
-            except Exception:
-                pass
-
-            if resp.status_code >= 500:
-                raise requests.HTTPError(f"{resp.status_code} {resp.text}")
-
-            return resp
+# Лимит загрузок на кабинет в сутки — vk_ads.QuotaLedger (SQLite, общий с bot_master.py)
 
-        except Exception as e:
-            last_exc = e
-            sleep_for = RETRY_BACKOFF ** (attempt - 1)
-            logger.warning(f"{method} {url} попытка {attempt}/{RETRY_COUNT} не удалась: {e}. "
-                           f"Повтор через {sleep_for:.1f}s")
-            time.sleep(sleep_for)
-
-    assert last_exc is not None
-    raise last_exc
+# === VK API: асинхронный клиент vk_ads (aiohttp, повторы и rate limit без блокировки loop) ===
 
 
 # === Утилиты ===
@@ -386,45 +322,16 @@ def upload_to_s3(file_path):
         send_error_sync(msg)
 
 
-def upload_user_list_vk(file_path, list_name, vk_token, list_type="phones"):
-    """Загружает список в конкретный VK кабинет (token). Возвращает list_id."""
-    url = f"{BASE_URL_V3}/remarketing/users_lists.json"
-    headers = {"Authorization": f"Bearer {vk_token}"}
-    files = {"file": open(file_path, "rb")}
-    data = {"name": list_name, "type": list_type}
-    try:
-        resp = req_with_retry("POST", url, headers=headers, files=files, data=data, timeout=60)
-    finally:
-        files["file"].close()
-
-    try:
-        result = resp.json()
-    except Exception:
-        raise Exception(f"Некорректный ответ VK: {resp.text}")
-    if resp.status_code != 200 or isinstance(result.get("error"), dict):
-        raise Exception(f"Ошибка загрузки списка: {result}")
-    list_id = result.get("id")
-    if not list_id:
-        raise Exception(f"Не удалось получить ID списка: {result}")
-    return list_id
+async def upload_user_list_vk(file_path, list_name, vk_token, list_type="phones", body=None):
+    """Загружает список в конкретный VK кабинет (token). Возвращает list_id.
+       body — заранее собранное multipart-тело (vk_ads.MultipartBody), общее для всех кабинетов."""
+    return await vk_ads.get_client().upload_user_list(file_path, list_name, vk_token,
+                                                      list_type=list_type, body=body)
 
 
-def create_segment_vk(list_id, segment_name, vk_token):
+async def create_segment_vk(list_id, segment_name, vk_token):
     """Создаёт сегмент в VK для конкретного кабинета."""
-    url = f"{BASE_URL_V2}/remarketing/segments.json"
-    headers = {"Authorization": f"Bearer {vk_token}", "Content-Type": "application/json"}
-    payload = {
-        "name": segment_name,
-        "pass_condition": 1,
-        "relations": [
-            {"object_type": "remarketing_users_list", "params": {"source_id": list_id, "type": "positive"}}
-        ],
-    }
-    resp = req_with_retry("POST", url, headers=headers, json_body=payload, timeout=60)
-    result = resp.json()
-    if resp.status_code != 200 or isinstance(result.get("error"), dict):
-        raise Exception(f"Ошибка создания сегмента: {result}")
-    return result.get("id")
+    return await vk_ads.get_client().create_segment(list_id, segment_name, vk_token)
 
 async def upload_to_all_vk_and_get_one_sharing_key(file_path, vk_tokens, *, list_name=None, list_type="phones", segment_prefix="LAL "):
     """
@@ -437,22 +344,26 @@ async def upload_to_all_vk_and_get_one_sharing_key(file_path, vk_tokens, *, list
     list_name = list_name or base_list_name
     segment_name = f"{segment_prefix}{list_name}"
 
+    quota = vk_ads.get_quota_ledger()
+    body = None  # файл читается и кодируется один раз — при первой реальной загрузке
     first_success = None  # tuple (list_id, token)
     for token in vk_tokens:
-        if token not in VK_UPLOAD_COUNTERS:
-            VK_UPLOAD_COUNTERS[token] = 0
-
-        # 🔒 Проверка лимита
-        if VK_UPLOAD_COUNTERS[token] >= MAX_UPLOADS_PER_TOKEN:
+        # 🔒 Проверка лимита (резерв до загрузки, возврат при ошибке)
+        if not quota.reserve(token):
             logging.warning(
-                f"⚠️ Превышен лимит {MAX_UPLOADS_PER_TOKEN} загрузок для VK кабинета {token[:8]}... Пропускаем."
+                f"⚠️ Превышен лимит {quota.limit} загрузок для VK кабинета {token[:8]}... Пропускаем."
             )
             continue
 
         try:
-            list_id = upload_user_list_vk(file_path, list_name, token, list_type=list_type)
-            create_segment_vk(list_id, segment_name, token)
-            VK_UPLOAD_COUNTERS[token] += 1  # ✅ инкремент при успехе
+            try:
+                if body is None:
+                    body = await vk_ads.MultipartBody.build(file_path, list_name, list_type)
+                list_id = await upload_user_list_vk(file_path, list_name, token, list_type=list_type, body=body)
+            except Exception:
+                quota.release(token)
+                raise
+            await create_segment_vk(list_id, segment_name, token)
             logging.info("VK upload OK for token (truncated): %s ... list_id=%s", token[:8], list_id)
             if first_success is None:
                 first_success = (list_id, token)
@@ -608,6 +519,8 @@ async def main():
             logging.exception("Ошибка VK загрузки")
             send_error_sync(f"Ошибка VK загрузки {fname}: {e}")
 
+    await vk_ads.close_client()
+
     # 9) Очистка временных файлов
     try:
         cleanup_files(csv_files)
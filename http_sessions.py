@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+http_sessions.py — общие aiohttp-сессии Bot API по маршрутам прокси.
+
+bot_master.py и max_checker.py раньше открывали ClientSession и коннектор
+на каждое сообщение — каждый вызов заново платил за TCP, SOCKS5-handshake
+и TLS. Здесь на каждый маршрут (прямое подключение / конкретный SOCKS5)
+держится одна долгоживущая сессия: keep-alive, кэш DNS, лимиты соединений.
+
+Маршрут определяется dict прокси в формате bot_master (_active_proxy /
+уровни пула): {'type': 'socks5', 'host', 'port', 'user', 'pass'} — свой
+маршрут; 'http' (relay) и 'direct' — прямое подключение. Сессия маршрута
+пересоздаётся, только когда она закрыта, принадлежит другому event loop
+или её сбросили через drop_session() (прокси упал / сменился).
+
+    session = await get_session(proxy)
+    async with session.post(url, data=..., timeout=...) as resp: ...
+    ...
+    await close_sessions()      # в конце main()
+
+aiohttp-socks нужен только для SOCKS5 (pip install aiohttp-socks).
+"""
+
+import asyncio
+import logging
+import os
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+
+logger = logging.getLogger("http_sessions")
+
+TG_HTTP_LIMIT          = int(os.getenv("TG_HTTP_LIMIT", "20"))            # соединений на маршрут
+TG_HTTP_LIMIT_PER_HOST = int(os.getenv("TG_HTTP_LIMIT_PER_HOST", "10"))
+TG_HTTP_KEEPALIVE      = 60                                               # сек держать idle-соединение
+TG_HTTP_DNS_TTL        = 300                                              # сек кэша DNS
+
+
+def route_key(proxy: Optional[dict]) -> str:
+    """Ключ маршрута: одинаковые прокси — одна сессия."""
+    proxy = proxy or {}
+    if proxy.get("type") == "socks5" and proxy.get("host"):
+        user = proxy.get("user") or ""
+        return f"socks5://{user + '@' if user else ''}{proxy['host']}:{proxy['port']}"
+    return "direct"
+
+
+def _connector(proxy: Optional[dict]) -> aiohttp.BaseConnector:
+    common = dict(
+        limit=TG_HTTP_LIMIT,
+        limit_per_host=TG_HTTP_LIMIT_PER_HOST,
+        keepalive_timeout=TG_HTTP_KEEPALIVE,
+        ttl_dns_cache=TG_HTTP_DNS_TTL,
+    )
+    proxy = proxy or {}
+    if route_key(proxy) != "direct":
+        try:
+            from aiohttp_socks import ProxyConnector, ProxyType
+            return ProxyConnector(
+                proxy_type=ProxyType.SOCKS5,
+                host=proxy["host"], port=proxy["port"],
+                username=proxy.get("user") or None,
+                password=proxy.get("pass") or None,
+                rdns=True,
+                **common,
+            )
+        except ImportError:
+            logger.warning("aiohttp-socks не установлен, SOCKS5 недоступен — прямое подключение")
+    return aiohttp.TCPConnector(**common)
+
+
+# маршрут → (loop, сессия)
+_sessions: Dict[str, Tuple[asyncio.AbstractEventLoop, aiohttp.ClientSession]] = {}
+
+
+async def get_session(proxy: Optional[dict] = None) -> aiohttp.ClientSession:
+    """Сессия маршрута proxy; создаётся при первом обращении или после сброса."""
+    key = route_key(proxy)
+    loop = asyncio.get_running_loop()
+    entry = _sessions.get(key)
+    if entry is not None:
+        session_loop, session = entry
+        if session_loop is loop and not session.closed:
+            return session
+        if session_loop is loop:
+            await session.close()
+        # сессия от прошлого asyncio.run() — закрыть её в чужом loop нельзя, просто забываем
+    session = aiohttp.ClientSession(connector=_connector(proxy))
+    _sessions[key] = (loop, session)
+    logger.info("Новая HTTP-сессия Telegram: %s", key)
+    return session
+
+
+async def drop_session(proxy: Optional[dict] = None):
+    """Закрывает сессию маршрута (прокси упал/сменился) — следующий get_session создаст новую."""
+    entry = _sessions.pop(route_key(proxy), None)
+    if entry is not None and entry[0] is asyncio.get_running_loop():
+        await entry[1].close()
+
+
+async def close_sessions():
+    """Закрывает все сессии текущего loop — вызывать в конце main()."""
+    loop = asyncio.get_running_loop()
+    for key, (session_loop, session) in list(_sessions.items()):
+        if session_loop is loop:
+            await session.close()
+        _sessions.pop(key, None)
@@ -14,6 +14,8 @@ from datetime import datetime
 from typing import Optional, Set, List, Tuple
 from dotenv import load_dotenv
 
+import http_sessions
+
 load_dotenv("/opt/bot/.env")
 
 VERSION_MAX_CHECKER = "1.38"
@@ -72,27 +74,15 @@ def _proxy_headers() -> dict:
     return {}
 
 
-def _aiohttp_connector():
-    """SOCKS5 коннектор для aiohttp — использует те же настройки что bot_master."""
+def _tg_proxy() -> Optional[dict]:
+    """SOCKS5 для Telegram в формате bot_master — маршрут общей сессии http_sessions."""
     if not _TG_SOCKS5_HOST:
         return None
-    try:
-        from aiohttp_socks import ProxyConnector, ProxyType
-        if _TG_SOCKS5_USER:
-            return ProxyConnector(
-                proxy_type=ProxyType.SOCKS5,
-                host=_TG_SOCKS5_HOST, port=_TG_SOCKS5_PORT,
-                username=_TG_SOCKS5_USER, password=_TG_SOCKS5_PASS,
-                rdns=True,
-            )
-        return ProxyConnector(
-            proxy_type=ProxyType.SOCKS5,
-            host=_TG_SOCKS5_HOST, port=_TG_SOCKS5_PORT,
-            rdns=True,
-        )
-    except ImportError:
-        logging.warning("aiohttp-socks не установлен, SOCKS5 недоступен")
-        return None
+    return {
+        "type": "socks5",
+        "host": _TG_SOCKS5_HOST, "port": _TG_SOCKS5_PORT,
+        "user": _TG_SOCKS5_USER, "pass": _TG_SOCKS5_PASS,
+    }
 
 def get_usd_rub_rate() -> float:
     """Получает текущий курс USD/RUB"""
@@ -581,17 +571,16 @@ async def send_telegram_message(text: str, chat_id: str = CHECKER_CHAT_ID):
         return
 
     url = _bot_api_url(BOT_TOKEN, "sendMessage")
-    connector = _aiohttp_connector()
     try:
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.post(
-                url,
-                data={"chat_id": chat_id, "text": text, "parse_mode": "HTML"},
-                headers=_proxy_headers()
-            ) as resp:
-                if resp.status != 200:
-                    text_resp = await resp.text()
-                    logger.error(f"Ошибка отправки сообщения: {resp.status} {text_resp}")
+        session = await http_sessions.get_session(_tg_proxy())
+        async with session.post(
+            url,
+            data={"chat_id": chat_id, "text": text, "parse_mode": "HTML"},
+            headers=_proxy_headers()
+        ) as resp:
+            if resp.status != 200:
+                text_resp = await resp.text()
+                logger.error(f"Ошибка отправки сообщения: {resp.status} {text_resp}")
     except Exception as e:
         logger.exception(f"Ошибка при отправке сообщения в Telegram: {e}")
 
@@ -603,25 +592,24 @@ async def send_telegram_file(file_path: str, caption: str = "", chat_id: str = C
         return
 
     url = _bot_api_url(BOT_TOKEN, "sendDocument")
-    connector = _aiohttp_connector()
     try:
-        async with aiohttp.ClientSession(connector=connector) as session:
-            with open(file_path, "rb") as f:
-                form = aiohttp.FormData()
-                form.add_field("chat_id", chat_id)
-
-                filename = custom_filename or os.path.basename(file_path)
-                form.add_field("document", f, filename=filename)
-
-                if caption:
-                    form.add_field("caption", caption)
-
-                async with session.post(
-                    url, data=form, headers=_proxy_headers()
-                ) as resp:
-                    if resp.status != 200:
-                        text_resp = await resp.text()
-                        logger.error(f"Ошибка отправки файла: {resp.status} {text_resp}")
+        session = await http_sessions.get_session(_tg_proxy())
+        with open(file_path, "rb") as f:
+            form = aiohttp.FormData()
+            form.add_field("chat_id", chat_id)
+
+            filename = custom_filename or os.path.basename(file_path)
+            form.add_field("document", f, filename=filename)
+
+            if caption:
+                form.add_field("caption", caption)
+
+            async with session.post(
+                url, data=form, headers=_proxy_headers()
+            ) as resp:
+                if resp.status != 200:
+                    text_resp = await resp.text()
+                    logger.error(f"Ошибка отправки файла: {resp.status} {text_resp}")
     except Exception as e:
         logger.exception(f"Ошибка при отправке файла в Telegram: {e}")
 
@@ -967,6 +955,13 @@ def start_checker_task():
     return asyncio.create_task(run_max_checker())
 
 
+async def _run_standalone():
+    try:
+        await run_max_checker()
+    finally:
+        await http_sessions.close_sessions()
+
+
 if __name__ == "__main__":
     # Для тестирования
-    asyncio.run(run_max_checker())
+    asyncio.run(_run_standalone())
@@ -0,0 +1,74 @@
+import os
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_LOG_PATH", os.devnull)
+
+import bot_master  # noqa: E402
+
+# Без пустых channel_id: pandas делает такую колонку float («915.0») и старый путь
+# уводит все номера файла в ДОП_10 — потоковый разбор эту особенность не повторяет.
+CSV_FILES = {
+    "leads_MFO5.csv": (
+        "﻿id,name,phone\n"
+        "1,Иван,+79001234567\n"
+        "2,\"Пётр\nВторая строка\",79007654321\n"
+        "3,\"Анна, \"\"А\"\"\",+79005550000\n"
+        "\n"
+        "4,Олег,79001234567"
+    ),
+    "leads_broker.csv": (
+        "phone,channel_id,comment\n"
+        "+79110000001,915,\"много\nстрок\"\n"
+        "79110000002,12063,\n"
+        "79110000003,77777,x\n"
+        "79110000004,9189,y\n"
+    ),
+    "6_web_leads.csv": (
+        "phone,channel_id\r\n"
+        "+79220000001,15883\r\n"
+        "79220000002,15273\r\n"
+        "79220000003,1\r\n"
+    ),
+    "leads_253.csv": "phone\n79330000001\n+79330000002\n",
+}
+
+
+@pytest.fixture
+def no_side_effects(monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot_master, "send_error_sync", sent.append)
+    monkeypatch.setattr(bot_master, "notify_error", sent.append)
+    monkeypatch.setattr(bot_master, "save_txt_outputs", lambda output_data, label="": [])
+    monkeypatch.setattr(bot_master, "save_approve_phones", lambda phones, today: None)
+    return sent
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64, 1 << 20])
+def test_stream_router_matches_pandas_path(tmp_path, no_side_effects, chunk_size):
+    today = datetime.today()
+    day_number = bot_master.get_day_number(today)
+    paths = []
+    for name, text in CSV_FILES.items():
+        path = tmp_path / name
+        path.write_bytes(text.encode("utf-8"))
+        paths.append(str(path))
+
+    expected, expected_approve = defaultdict(set), set()
+    bot_master.process_csv_files_ch1(paths, expected, expected_approve, today)
+
+    got, got_approve = defaultdict(set), set()
+    for path in paths:
+        router = bot_master.CsvStreamRouter(os.path.basename(path), 1, day_number, got, got_approve)
+        data = open(path, "rb").read()
+        for i in range(0, len(data), chunk_size):
+            router.feed(data[i:i + chunk_size])
+        router.close()
+
+    assert dict(got) == dict(expected)
+    assert got_approve == expected_approve
+    assert not no_side_effects
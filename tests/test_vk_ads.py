@@ -0,0 +1,135 @@
+import asyncio
+import os
+import sys
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vk_ads  # noqa: E402
+
+
+@pytest.fixture
+def fast_breakers(monkeypatch):
+    monkeypatch.setattr(vk_ads, "RETRY_COUNT", 1)
+    monkeypatch.setattr(vk_ads, "VK_BREAKER_FAILURES", 2)
+    monkeypatch.setattr(vk_ads, "VK_BREAKER_COOLDOWN", 0.2)
+    monkeypatch.setattr(vk_ads, "VK_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(vk_ads, "VK_BACKOFF_CAP", 0.01)
+
+
+def test_429_on_half_open_probe_releases_endpoint_breaker(fast_breakers):
+    """500, 500 открывают breaker эндпоинта; 429 на пробе не должен оставить его в probing."""
+    statuses = [500, 500, 429]
+
+    async def handler(request):
+        status = statuses.pop(0) if statuses else 200
+        if status == 429:
+            return web.Response(status=429, headers={"Retry-After": "0"})
+        if status >= 500:
+            return web.Response(status=status, text="boom")
+        return web.json_response({"id": 1})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/seg", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/seg"
+        client = vk_ads.VkAdsClient()
+        try:
+            for _ in range(3):
+                with pytest.raises(vk_ads.VkHttpError):
+                    await client.req_with_retry("POST", url, {"Authorization": "Bearer a"})
+                if client._breaker("POST /seg").state == "open":
+                    await asyncio.sleep(0.3)   # → half-open, следующий запрос — проба
+
+            endpoint = client._breaker("POST /seg")
+            assert not endpoint.probing
+            resp = await asyncio.wait_for(
+                client.req_with_retry("POST", url, {"Authorization": "Bearer b"}), timeout=5)
+            assert resp.status_code == 200
+            assert endpoint.state == "closed"
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_cancelled_probe_releases_breakers(fast_breakers):
+    breaker = vk_ads.CircuitBreaker("x")
+    breaker.failures = vk_ads.VK_BREAKER_FAILURES
+    breaker.begin()
+    assert breaker.probing and breaker.wait_time() == 1.0
+    breaker.release()
+    assert breaker.wait_time() == 0.0
+
+
+def test_response_headers_are_case_insensitive():
+    resp = vk_ads.VkResponse(429, vk_ads.CIMultiDict({"retry-after": "7", "x-ratelimit-rps-limit": "1"}), b"")
+    assert vk_ads._retry_after(resp.headers) == 7.0
+    assert resp.headers.get("X-RateLimit-RPS-Limit") == "1"
+
+
+def test_upload_timeout_scales_with_body_size():
+    small = vk_ads.upload_timeout(1024)
+    big = vk_ads.upload_timeout(vk_ads.VK_LIST_MAX_BYTES)
+    assert small.total >= 60
+    assert big.total > 60 + vk_ads.VK_LIST_MAX_BYTES / (vk_ads.VK_UPLOAD_MIN_KBPS * 1024) - 1
+    assert big.sock_read == vk_ads.VK_UPLOAD_SOCK_READ
+
+
+def test_split_rejects_line_longer_than_limit():
+    with pytest.raises(Exception):
+        vk_ads.split_list_content(b"1\n" + b"9" * 50 + b"\n2", max_bytes=10)
+    assert vk_ads.split_list_content(b"11\n22\n33\n44", max_bytes=6) == [b"11\n22", b"33\n44"]
+
+
+def test_upload_cache_keeps_partial_shards(tmp_path):
+    cache = vk_ads.UploadCache(str(tmp_path / "cache.json"))
+    cache.put_shard("k", [10, 10, 5], 0, 101)
+    cache.put_shard("k", [10, 10, 5], 2, 103)
+    reloaded = vk_ads.UploadCache(str(tmp_path / "cache.json"))
+    assert reloaded.get("k") is None
+    assert reloaded.get_shards("k", [10, 10, 5]) == {0: 101, 2: 103}
+    assert reloaded.get_shards("k", [12, 13]) == {}
+    reloaded.put("k", 103, None, "list", [101, 102, 103])
+    assert reloaded.get_shards("k", [10, 10, 5]) == {}
+
+
+def test_multipart_encode_matches_formdata():
+    class Buffer:
+        def __init__(self):
+            self.chunks = []
+
+        async def write(self, chunk):
+            self.chunks.append(bytes(chunk))
+
+    async def formdata(content, filename, list_name, list_type):
+        form = aiohttp.FormData()
+        form.add_field("name", list_name)
+        form.add_field("type", list_type)
+        form.add_field("file", content, filename=filename)
+        writer = form()
+        buf = Buffer()
+        await writer.write(buf)
+        return b"".join(buf.chunks), writer.boundary
+
+    args = (b"79001234567\n79007654321", "Б0 (515).txt", "Список «Б0»", "phones")
+    body = asyncio.run(vk_ads.MultipartBody.from_bytes(*args))
+    expected, boundary = asyncio.run(formdata(*args))
+    ours = body.content_type.split("boundary=")[1]
+    assert body.body.replace(ours.encode(), boundary.encode()) == expected
+    assert body.size == len(args[0])
+
+
+def test_load_shards_reads_file(tmp_path):
+    path = tmp_path / "list.txt"
+    path.write_bytes(b"1\n2\n3")
+    bodies = asyncio.run(vk_ads.MultipartBody.load_shards(str(path), "L"))
+    assert len(bodies) == 1 and b"\r\n\r\n1\n2\n3\r\n" in bodies[0].body
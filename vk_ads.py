@@ -0,0 +1,748 @@
+#!/usr/bin/env python3
+"""
+vk_ads.py — асинхронный клиент VK Ads API (v2/v3) на aiohttp.
+
+Используется bot_master.py и bot_master_s3.py для загрузки списков
+ремаркетинга и создания сегментов. В отличие от requests + time.sleep
+не блокирует event loop: пауза по 429 / flood-ошибкам 9 и 29 одного
+кабинета не останавливает остальные выгрузки и max_checker.
+
+Соединения к ads.vk.com переиспользуются (keep-alive) через один
+ClientSession на процесс — get_client() / close_client().
+
+Темп запросов: token bucket на каждый токен кабинета (VK_TOKEN_RPS /
+VK_TOKEN_BURST) и общий потолок одновременных запросов (VK_MAX_CONCURRENCY).
+Так выгрузку можно вести во все кабинеты сразу, не упираясь в лимиты
+отдельного аккаунта.
+
+UploadCache — кэш «(отпечаток токена, sha256 содержимого, тип списка) →
+list_id / id сегмента» на диске: повторная выгрузка того же файла в тот же
+кабинет не создаёт дубликат списка и не тратит лимит загрузок.
+
+Отказы: circuit breaker на эндпоинт (5xx, сеть) и на токен (429, flood 9/29,
+401/403). Открытый breaker «паркует» кабинет — его запросы ждут или сразу
+получают VkCircuitOpen, остальные кабинеты идут с полной скоростью. Паузы между
+повторами — decorrelated jitter с учётом Retry-After.
+
+MultipartBody — тело загрузки списка собирается один раз (одно чтение файла,
+одно кодирование multipart) и отправляется во все кабинеты fan-out. Список
+больше VK_LIST_MAX_BYTES / VK_LIST_MAX_ROWS режется по строкам на шарды.
+
+QuotaLedger — суточный учёт загрузок на токен в SQLite: счётчик переживает
+перезапуск и общий для всех процессов (ежедневный прогон, ручной запуск
+с портала, bot_master_s3.py).
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp.helpers import content_disposition_header
+from multidict import CIMultiDict
+
+logger = logging.getLogger("vk_ads")
+
+# VK_ADS_BASE_URL — подмена хоста (локальный vk_mock_server.py для нагрузочных прогонов)
+VK_ADS_BASE_URL = os.getenv("VK_ADS_BASE_URL", "https://ads.vk.com").rstrip("/")
+BASE_URL_V3 = f"{VK_ADS_BASE_URL}/api/v3"
+BASE_URL_V2 = f"{VK_ADS_BASE_URL}/api/v2"
+
+RETRY_COUNT        = 3
+VK_BACKOFF_BASE    = 1.0     # сек, нижняя граница паузы между повторами
+VK_BACKOFF_CAP     = 60.0    # сек, верхняя граница
+VK_FLOOD_BACKOFF   = 10.0    # сек, нижняя граница паузы после flood 9/29
+
+# Circuit breaker: после N отказов подряд ключ «паркуется» на cooldown (удваивается
+# при провале пробного запроса, до _MAX). Дольше VK_BREAKER_MAX_WAIT не ждём — VkCircuitOpen.
+VK_BREAKER_FAILURES     = int(os.getenv("VK_BREAKER_FAILURES", "5"))
+VK_BREAKER_COOLDOWN     = float(os.getenv("VK_BREAKER_COOLDOWN", "30"))
+VK_BREAKER_COOLDOWN_MAX = float(os.getenv("VK_BREAKER_COOLDOWN_MAX", "600"))
+VK_BREAKER_MAX_WAIT     = float(os.getenv("VK_BREAKER_MAX_WAIT", "120"))
+
+# Пул соединений к VK Ads
+VK_HTTP_LIMIT     = int(os.getenv("VK_HTTP_LIMIT", "32"))     # всего соединений
+VK_HTTP_KEEPALIVE = 60                                      # сек держать idle-соединение
+
+# Лимиты VK Ads: запросов/сек на токен, размер «пачки» и одновременных запросов на процесс.
+# Если VK прислал X-RateLimit-RPS-Limit ниже VK_TOKEN_RPS — ведро токена подстраивается под него.
+VK_TOKEN_RPS       = float(os.getenv("VK_TOKEN_RPS", "2"))
+VK_TOKEN_BURST     = int(os.getenv("VK_TOKEN_BURST", "4"))
+VK_MAX_CONCURRENCY = int(os.getenv("VK_MAX_CONCURRENCY", "16"))
+
+# Лимиты VK на один файл списка: больше — режем на шарды (каждый отдельный список)
+VK_LIST_MAX_BYTES = int(os.getenv("VK_LIST_MAX_BYTES", str(200 * 1024 * 1024)))
+VK_LIST_MAX_ROWS  = int(os.getenv("VK_LIST_MAX_ROWS", "5000000"))
+
+# Таймауты загрузки списка: total растёт с размером тела (не ниже VK_UPLOAD_MIN_KBPS),
+# сокетные — ловят зависшее соединение. Фиксированный total — только для мелких JSON-запросов.
+VK_UPLOAD_MIN_KBPS     = int(os.getenv("VK_UPLOAD_MIN_KBPS", "256"))
+VK_UPLOAD_SOCK_CONNECT = 30
+VK_UPLOAD_SOCK_READ    = int(os.getenv("VK_UPLOAD_SOCK_READ", "120"))
+
+# Кэш выгрузок: после TTL запись забывается (список могли удалить в кабинете вручную)
+VK_UPLOAD_CACHE     = os.getenv("VK_UPLOAD_CACHE", "/opt/bot/vk_upload_cache.json")
+VK_UPLOAD_CACHE_TTL = int(os.getenv("VK_UPLOAD_CACHE_TTL_DAYS", "30")) * 86400
+
+# Учёт суточного лимита загрузок: сутки VK считаются по Москве (UTC+3)
+VK_QUOTA_DB         = os.getenv("VK_QUOTA_DB", "/opt/bot/vk_quota.sqlite3")
+VK_QUOTA_UTC_OFFSET = int(os.getenv("VK_QUOTA_UTC_OFFSET", "3"))
+VK_QUOTA_KEEP_DAYS  = 14
+VK_MAX_UPLOADS_PER_TOKEN = int(os.getenv("VK_MAX_UPLOADS_PER_TOKEN", "20"))   # загрузок в сутки на кабинет
+
+
+class VkHttpError(Exception):
+    """5xx от VK Ads (повторяется в req_with_retry)."""
+
+
+class VkCircuitOpen(Exception):
+    """Эндпоинт или кабинет припаркован circuit breaker'ом — запрос не отправлялся."""
+
+
+class VkResponse:
+    """
+    Прочитанный ответ VK: статус, заголовки и тело (соединение уже отпущено в пул).
+    Заголовки — CIMultiDict: поиск без учёта регистра, как у requests.
+    """
+
+    def __init__(self, status_code: int, headers: CIMultiDict, body: bytes):
+        self.status_code = status_code
+        self.headers     = headers
+        self.body        = body
+
+    @property
+    def text(self) -> str:
+        return self.body.decode("utf-8", errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.body)
+
+
+class TokenBucket:
+    """Token bucket: не больше rate запросов/сек в среднем, до burst подряд."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate   = max(rate, 0.01)
+        self.burst  = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.ts     = time.monotonic()
+        self._lock  = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    async def acquire(self):
+        # Под замком — ожидающие получают жетоны по очереди (FIFO)
+        async with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def set_rate(self, rate: float):
+        if 0 < rate < self.rate:
+            logger.info(f"VK RPS-лимит токена: {self.rate:g} → {rate:g}")
+            self.rate  = rate
+            self.burst = max(1, min(self.burst, int(rate)))
+
+
+def _decorrelated_jitter(prev: float, base: float, cap: float) -> float:
+    """Decorrelated jitter: пауза случайна в [base, prev*3], но не больше cap."""
+    return min(cap, random.uniform(base, max(base, prev * 3)))
+
+
+def _retry_after(headers: CIMultiDict) -> float:
+    try:
+        return max(0.0, float(headers.get("Retry-After", "")))
+    except ValueError:
+        return 0.0
+
+
+class CircuitBreaker:
+    """
+    closed → (N отказов подряд) → open на cooldown → half-open: один пробный запрос.
+    Проба удалась — closed; провалилась — снова open с удвоенным cooldown.
+    """
+
+    def __init__(self, name: str):
+        self.name       = name
+        self.failures   = 0
+        self.open_until = 0.0
+        self.cooldown   = VK_BREAKER_COOLDOWN
+        self.probing    = False
+
+    @property
+    def state(self) -> str:
+        if self.failures < VK_BREAKER_FAILURES:
+            return "closed"
+        return "open" if time.monotonic() < self.open_until else "half-open"
+
+    def wait_time(self) -> float:
+        """Сколько ждать до права отправить запрос (0 — можно сейчас)."""
+        state = self.state
+        if state == "open":
+            return self.open_until - time.monotonic()
+        if state == "half-open" and self.probing:
+            return 1.0
+        return 0.0
+
+    def begin(self):
+        if self.state == "half-open":
+            self.probing = True
+
+    def release(self):
+        """Попытка закончилась без вердикта для этого breaker'а (или отменена) — проба снята, счёт не меняется."""
+        self.probing = False
+
+    def success(self):
+        if self.failures >= VK_BREAKER_FAILURES:
+            logger.info(f"VK breaker «{self.name}» закрыт")
+        self.failures = 0
+        self.cooldown = VK_BREAKER_COOLDOWN
+        self.probing  = False
+
+    def failure(self, retry_after: float = 0.0):
+        was_probe = self.probing
+        self.probing = False
+        self.failures += 1
+        if self.failures < VK_BREAKER_FAILURES:
+            return
+        if was_probe:
+            self.cooldown = min(self.cooldown * 2, VK_BREAKER_COOLDOWN_MAX)
+        until = time.monotonic() + max(self.cooldown, retry_after)
+        if until > self.open_until:
+            if self.open_until <= time.monotonic():
+                logger.warning(f"VK breaker «{self.name}» открыт на {until - time.monotonic():.0f}s")
+            self.open_until = until
+
+
+def split_list_content(content: bytes, max_bytes: int = VK_LIST_MAX_BYTES,
+                       max_rows: int = VK_LIST_MAX_ROWS) -> List[bytes]:
+    """Режет список по строкам на равные шарды, каждый в пределах лимитов VK."""
+    if len(content) <= max_bytes and content.count(b"\n") < max_rows:
+        return [content]
+    lines = content.splitlines()
+    longest = max(map(len, lines), default=0)
+    if longest > max_bytes:
+        # Строку не разрезать — без проверки цикл ниже не закончится
+        raise Exception(f"Строка списка длиной {longest} байт больше лимита VK {max_bytes}")
+    n = max(math.ceil(len(content) / max_bytes), math.ceil(len(lines) / max_rows), 1)
+    while True:
+        per = math.ceil(len(lines) / n)
+        parts = [b"\n".join(lines[i:i + per]) for i in range(0, len(lines), per)]
+        if all(len(p) <= max_bytes for p in parts):
+            return parts
+        n += 1
+
+
+class MultipartBody:
+    """
+    Готовое multipart/form-data тело списка ремаркетинга (name, type, file).
+    Неизменяемое: одни и те же байты уходят в любое число кабинетов и повторов.
+    Чтение файла, нарезка на шарды и кодирование — в asyncio.to_thread:
+    список в сотни МБ не стопорит event loop.
+    """
+
+    def __init__(self, body: bytes, content_type: str, size: int, list_name: str):
+        self.body         = body
+        self.content_type = content_type
+        self.size         = size
+        self.list_name    = list_name
+
+    @classmethod
+    def encode(cls, content: bytes, filename: str, list_name: str,
+               list_type: str = "phones") -> "MultipartBody":
+        """Синхронная сборка тела — те же байты, что у aiohttp.FormData (поля name, type, file)."""
+        boundary = uuid.uuid4().hex
+        text = "text/plain; charset=utf-8"
+        fields = (
+            ("name", list_name.encode("utf-8"), text, {}),
+            ("type", list_type.encode("utf-8"), text, {}),
+            ("file", content, "application/octet-stream", {"filename": filename}),
+        )
+        chunks: List[bytes] = []
+        for name, value, ctype, params in fields:
+            disposition = content_disposition_header("form-data", name=name, **params)
+            chunks += [f"--{boundary}\r\nContent-Type: {ctype}\r\n"
+                       f"Content-Disposition: {disposition}\r\n\r\n".encode("utf-8"), value, b"\r\n"]
+        chunks.append(f"--{boundary}--\r\n".encode("utf-8"))
+        return cls(b"".join(chunks), f"multipart/form-data; boundary={boundary}", len(content), list_name)
+
+    @classmethod
+    def encode_shards(cls, content: bytes, filename: str, list_name: str,
+                      list_type: str = "phones") -> List["MultipartBody"]:
+        """Тело или, если список превышает лимиты VK, по телу на шард «имя [i/N]»."""
+        parts = split_list_content(content)
+        if len(parts) == 1:
+            return [cls.encode(content, filename, list_name, list_type)]
+        stem, ext = os.path.splitext(filename)
+        n = len(parts)
+        return [cls.encode(part, f"{stem}_{i}{ext}", f"{list_name} [{i}/{n}]", list_type)
+                for i, part in enumerate(parts, 1)]
+
+    @staticmethod
+    def _read(file_path: str) -> bytes:
+        with open(file_path, "rb") as f:
+            return f.read()
+
+    @classmethod
+    async def build(cls, file_path: str, list_name: str, list_type: str = "phones") -> "MultipartBody":
+        def _build():
+            return cls.encode(cls._read(file_path), os.path.basename(file_path), list_name, list_type)
+        return await asyncio.to_thread(_build)
+
+    @classmethod
+    async def from_bytes(cls, content: bytes, filename: str, list_name: str,
+                         list_type: str = "phones") -> "MultipartBody":
+        """Тело из готовых байтов (дельта, шард) — без файла на диске."""
+        return await asyncio.to_thread(cls.encode, content, filename, list_name, list_type)
+
+    @classmethod
+    async def shards_from_bytes(cls, content: bytes, filename: str, list_name: str,
+                                list_type: str = "phones") -> List["MultipartBody"]:
+        return await asyncio.to_thread(cls.encode_shards, content, filename, list_name, list_type)
+
+    @classmethod
+    async def load_shards(cls, file_path: str, list_name: str,
+                          list_type: str = "phones") -> List["MultipartBody"]:
+        def _load():
+            return cls.encode_shards(cls._read(file_path), os.path.basename(file_path), list_name, list_type)
+        return await asyncio.to_thread(_load)
+
+
+def upload_timeout(size: int) -> aiohttp.ClientTimeout:
+    """Таймаут загрузки тела size байт: 200 МБ не должны упираться в total=60."""
+    return aiohttp.ClientTimeout(
+        total=60 + size / (VK_UPLOAD_MIN_KBPS * 1024),
+        sock_connect=VK_UPLOAD_SOCK_CONNECT,
+        sock_read=VK_UPLOAD_SOCK_READ,
+    )
+
+
+# data: готовое тело или фабрика (FormData нельзя отправить дважды — на каждую попытку новая)
+Payload = Union[None, bytes, Dict[str, Any], aiohttp.FormData, Callable[[], Any]]
+
+
+class VkAdsClient:
+    """Клиент VK Ads с общим пулом keep-alive соединений и неблокирующими повторами."""
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._concurrency = asyncio.Semaphore(VK_MAX_CONCURRENCY)
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        # Счётчики попыток/повторов/отказов и длительности вызовов по пути API (для vk_bench.py и логов)
+        self.stats: Dict[str, int] = defaultdict(int)
+        self.latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=10000))
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=VK_HTTP_LIMIT,
+                ttl_dns_cache=300,
+                keepalive_timeout=VK_HTTP_KEEPALIVE,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def _bucket(self, headers: Dict[str, str]) -> TokenBucket:
+        token = headers.get("Authorization", "")
+        bucket = self._buckets.get(token)
+        if bucket is None:
+            bucket = self._buckets[token] = TokenBucket(VK_TOKEN_RPS, VK_TOKEN_BURST)
+        return bucket
+
+    def _breaker(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker(name)
+        return breaker
+
+    def token_breaker(self, vk_token: str) -> CircuitBreaker:
+        return self._breaker(f"token:{token_fingerprint(f'Bearer {vk_token}')}")
+
+    async def _pass_breakers(self, breakers: Iterable[CircuitBreaker]):
+        """Ждёт закрытия breaker'ов; если парковка дольше VK_BREAKER_MAX_WAIT — VkCircuitOpen."""
+        breakers = list(breakers)
+        while True:
+            wait = max(b.wait_time() for b in breakers)
+            if wait <= 0:
+                break
+            if wait > VK_BREAKER_MAX_WAIT:
+                names = ", ".join(b.name for b in breakers if b.wait_time() > 0)
+                self.stats["circuit_open"] += 1
+                raise VkCircuitOpen(f"VK breaker открыт ({names}), ещё {wait:.0f}s")
+            await asyncio.sleep(wait)
+        for b in breakers:
+            b.begin()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def req_with_retry(
+        self, method: str, url: str, headers: Dict[str, str],
+        params=None, json_body=None, data: Payload = None,
+        timeout: Union[int, aiohttp.ClientTimeout] = 60,
+    ) -> VkResponse:
+        last_exc: Optional[Exception] = None
+        session = self._get_session()
+        bucket = self._bucket(headers)
+        path = urlsplit(url).path
+        endpoint = self._breaker(f"{method} {path}")
+        token = self._breaker(f"token:{token_fingerprint(headers.get('Authorization', ''))}")
+        delay = VK_BACKOFF_BASE
+        started = time.monotonic()
+        pause = 0.0
+        if not isinstance(timeout, aiohttp.ClientTimeout):
+            timeout = aiohttp.ClientTimeout(total=timeout)
+        for attempt in range(1, RETRY_COUNT + 1):
+            if pause:
+                await asyncio.sleep(pause)
+                pause = 0.0
+            await self._pass_breakers((endpoint, token))
+            self.stats["requests"] += 1
+            if attempt > 1:
+                self.stats["retries"] += 1
+            # begin() ставит пробу на оба breaker'а, а исход попытки засчитывается
+            # одному из них — другой (и оба при отмене) снимает пробу в finally
+            try:
+                try:
+                    body = data() if callable(data) else data
+                    # Каждая попытка (и повтор) проходит через ведро токена и общий семафор
+                    await bucket.acquire()
+                    async with self._concurrency:
+                        async with session.request(
+                            method, url, headers=headers, params=params,
+                            json=json_body, data=body,
+                            timeout=timeout,
+                        ) as r:
+                            resp = VkResponse(r.status, CIMultiDict(r.headers), await r.read())
+                except Exception as e:
+                    # Сеть / таймаут — проблема эндпоинта, а не кабинета
+                    self.stats["network_errors"] += 1
+                    endpoint.failure()
+                    last_exc = e
+                    delay = _decorrelated_jitter(delay, VK_BACKOFF_BASE, VK_BACKOFF_CAP)
+                    logger.warning(f"{method} {url} попытка {attempt}/{RETRY_COUNT}: {e}. Повтор через {delay:.1f}s")
+                    pause = delay
+                    continue
+
+                try:
+                    bucket.set_rate(float(resp.headers.get("X-RateLimit-RPS-Limit", "0")))
+                except ValueError:
+                    pass
+
+                if resp.status_code == 429:
+                    retry_after = _retry_after(resp.headers)
+                    self.stats["rate_limited"] += 1
+                    token.failure(retry_after)
+                    delay = max(retry_after, _decorrelated_jitter(delay, VK_BACKOFF_BASE, VK_BACKOFF_CAP))
+                    logger.warning(f"VK rate limit 429, пауза {delay:.1f}s")
+                    pause = delay
+                    continue
+
+                vk_err = None
+                try:
+                    vk_err = resp.json().get("error", {})
+                except Exception:
+                    pass
+                if isinstance(vk_err, dict) and vk_err.get("error_code") in (9, 29):
+                    self.stats["flood"] += 1
+                    token.failure()
+                    delay = _decorrelated_jitter(max(delay, VK_FLOOD_BACKOFF), VK_FLOOD_BACKOFF, VK_BACKOFF_CAP)
+                    logger.warning(f"VK flood {vk_err.get('error_code')}, пауза {delay:.1f}s")
+                    pause = delay
+                    continue
+
+                if resp.status_code >= 500:
+                    self.stats["server_errors"] += 1
+                    endpoint.failure(_retry_after(resp.headers))
+                    last_exc = VkHttpError(f"{resp.status_code} {resp.text}")
+                    delay = max(_retry_after(resp.headers),
+                                _decorrelated_jitter(delay, VK_BACKOFF_BASE, VK_BACKOFF_CAP))
+                    logger.warning(f"{method} {url} попытка {attempt}/{RETRY_COUNT}: {last_exc}. Повтор через {delay:.1f}s")
+                    pause = delay
+                    continue
+
+                endpoint.success()
+                if resp.status_code in (401, 403):
+                    # Токен отозван / нет прав — паркуем кабинет, не дёргая VK каждым файлом
+                    token.failure()
+                else:
+                    token.success()
+                self.latencies[path].append(time.monotonic() - started)
+                return resp
+            finally:
+                endpoint.release()
+                token.release()
+        if last_exc is None:
+            last_exc = VkHttpError(f"{method} {url}: лимит VK не снят за {RETRY_COUNT} попытки")
+        raise last_exc
+
+    async def upload_user_list(self, file_path: str, list_name: str, vk_token: str,
+                               list_type: str = "phones",
+                               body: Optional[MultipartBody] = None) -> int:
+        """
+        Загружает TXT как список ремаркетинга. Возвращает list_id.
+        body — заранее собранное тело (общее для fan-out); без него собирается здесь.
+        """
+        url = f"{BASE_URL_V3}/remarketing/users_lists.json"
+        if body is None:
+            body = await MultipartBody.build(file_path, list_name, list_type)
+        headers = {"Authorization": f"Bearer {vk_token}", "Content-Type": body.content_type}
+
+        resp = await self.req_with_retry("POST", url, headers=headers, data=body.body,
+                                         timeout=upload_timeout(len(body.body)))
+        try:
+            result = resp.json()
+        except Exception:
+            raise Exception(f"Некорректный ответ VK: {resp.text}")
+        if resp.status_code != 200 or isinstance(result.get("error"), dict):
+            raise Exception(f"VK upload error: {result}")
+        list_id = result.get("id")
+        if not list_id:
+            raise Exception(f"Нет list_id в ответе VK: {result}")
+        return list_id
+
+    async def create_segment(self, list_ids: Union[int, List[int]], segment_name: str, vk_token: str) -> int:
+        """
+        Создаёт сегмент: позитивное условие по каждому списку (pass_condition=1 —
+        достаточно любого, т.е. объединение списков). Возвращает id сегмента.
+        """
+        if not isinstance(list_ids, (list, tuple)):
+            list_ids = [list_ids]
+        url = f"{BASE_URL_V2}/remarketing/segments.json"
+        headers = {"Authorization": f"Bearer {vk_token}", "Content-Type": "application/json"}
+        payload = {
+            "name": segment_name,
+            "pass_condition": 1,
+            "relations": [{"object_type": "remarketing_users_list",
+                           "params": {"source_id": list_id, "type": "positive"}}
+                          for list_id in list_ids],
+        }
+        resp = await self.req_with_retry("POST", url, headers=headers, json_body=payload, timeout=60)
+        result = resp.json()
+        if resp.status_code != 200 or isinstance(result.get("error"), dict):
+            raise Exception(f"VK segment error: {result}")
+        return result.get("id")
+
+
+# ═══ === КЭШ ВЫГРУЗОК ===
+
+def token_fingerprint(vk_token: str) -> str:
+    """Отпечаток токена для ключей кэша — сам токен на диск не пишем."""
+    return hashlib.sha256(vk_token.encode()).hexdigest()[:16]
+
+
+_hash_memo: Dict[tuple, str] = {}
+
+
+def file_sha256(file_path: str) -> str:
+    """sha256 содержимого; один файл на много кабинетов хэшируется один раз."""
+    st = os.stat(file_path)
+    memo_key = (file_path, st.st_size, st.st_mtime_ns)
+    digest = _hash_memo.get(memo_key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = _hash_memo[memo_key] = h.hexdigest()
+    return digest
+
+
+class UploadCache:
+    """
+    JSON-кэш выгрузок: ключ «fp:sha256:list_type» → {list_id, segment_id, name, ts[, list_ids]}.
+    segment_id=None — список загружен, сегмент ещё нет (повтор создаст только сегмент).
+    «ключ#shards» → {sizes, ids, ts} — уже загруженные шарды недогруженного списка:
+    повтор грузит только недостающие, без дублей в кабинете и лишних слотов лимита.
+    """
+
+    def __init__(self, path: str = VK_UPLOAD_CACHE):
+        self.path = path
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._data: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self._data = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Кэш выгрузок {path} не прочитан, начинаем с пустого: {e}")
+        now = time.time()
+        self._data = {k: v for k, v in self._data.items()
+                      if now - v.get("ts", 0) < VK_UPLOAD_CACHE_TTL}
+
+    @staticmethod
+    def key(vk_token: str, content_hash: str, list_type: str) -> str:
+        return f"{token_fingerprint(vk_token)}:{content_hash}:{list_type}"
+
+    def lock(self, key: str) -> asyncio.Lock:
+        """Одна выгрузка на ключ: два одинаковых задания не загрузят список дважды."""
+        lk = self._locks.get(key)
+        if lk is None:
+            lk = self._locks[key] = asyncio.Lock()
+        return lk
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._data.get(key)
+
+    def put(self, key: str, list_id: int, segment_id: Optional[int], name: str,
+            list_ids: Optional[List[int]] = None):
+        """list_ids — все списки сегмента (шарды, дельта-цепочка), если их больше одного."""
+        entry = {"list_id": list_id, "segment_id": segment_id, "name": name, "ts": int(time.time())}
+        if list_ids and len(list_ids) > 1:
+            entry["list_ids"] = list_ids
+        self._data[key] = entry
+        self._data.pop(f"{key}#shards", None)
+        self._save()
+
+    def get_shards(self, key: str, sizes: List[int]) -> Dict[int, int]:
+        """Шарды ключа (индекс → list_id), загруженные при том же разбиении (размеры шардов)."""
+        entry = self._data.get(f"{key}#shards")
+        if not entry or entry.get("sizes") != sizes:
+            return {}
+        return {int(i): list_id for i, list_id in entry["ids"].items()}
+
+    def put_shard(self, key: str, sizes: List[int], index: int, list_id: int):
+        entry = self._data.get(f"{key}#shards")
+        if not entry or entry.get("sizes") != sizes:
+            entry = self._data[f"{key}#shards"] = {"sizes": sizes, "ids": {}}
+        entry["ids"][str(index)] = list_id
+        entry["ts"] = int(time.time())
+        self._save()
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить кэш выгрузок {self.path}: {e}")
+
+
+_upload_cache: Optional[UploadCache] = None
+
+
+def get_upload_cache() -> UploadCache:
+    global _upload_cache
+    if _upload_cache is None:
+        _upload_cache = UploadCache()
+    return _upload_cache
+
+
+# ═══ === ЛИМИТ ЗАГРУЗОК ===
+
+class QuotaLedger:
+    """
+    Суточный счётчик загрузок на токен в SQLite (ключ — отпечаток токена + дата).
+    reserve() атомарен между процессами (BEGIN IMMEDIATE), сброс — сменой даты.
+    """
+
+    def __init__(self, limit: int = VK_MAX_UPLOADS_PER_TOKEN, path: str = VK_QUOTA_DB):
+        self.limit = limit
+        self.path  = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with closing(self._connect()) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS quota ("
+                       "fp TEXT NOT NULL, day TEXT NOT NULL, used INTEGER NOT NULL DEFAULT 0, "
+                       "PRIMARY KEY (fp, day))")
+            old = (self._now() - timedelta(days=VK_QUOTA_KEEP_DAYS)).strftime("%Y-%m-%d")
+            db.execute("DELETE FROM quota WHERE day < ?", (old,))
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None — транзакциями управляем сами; timeout — ждём чужую блокировку
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    @staticmethod
+    def _now() -> datetime:
+        return datetime.now(timezone.utc) + timedelta(hours=VK_QUOTA_UTC_OFFSET)
+
+    def _day(self) -> str:
+        return self._now().strftime("%Y-%m-%d")
+
+    def used(self, vk_token: str) -> int:
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT used FROM quota WHERE fp = ? AND day = ?",
+                             (token_fingerprint(vk_token), self._day())).fetchone()
+        return row[0] if row else 0
+
+    def remaining(self, vk_token: str) -> int:
+        return max(0, self.limit - self.used(vk_token))
+
+    def reserve(self, vk_token: str) -> bool:
+        """Занимает одну загрузку; False — лимит на сегодня исчерпан."""
+        fp, day = token_fingerprint(vk_token), self._day()
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT used FROM quota WHERE fp = ? AND day = ?", (fp, day)).fetchone()
+            used = row[0] if row else 0
+            if used >= self.limit:
+                db.execute("ROLLBACK")
+                return False
+            db.execute("INSERT INTO quota (fp, day, used) VALUES (?, ?, 1) "
+                       "ON CONFLICT(fp, day) DO UPDATE SET used = used + 1", (fp, day))
+            db.execute("COMMIT")
+            return True
+        except Exception:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def release(self, vk_token: str):
+        """Возвращает резерв неудавшейся загрузки."""
+        with closing(self._connect()) as db:
+            db.execute("UPDATE quota SET used = MAX(used - 1, 0) WHERE fp = ? AND day = ?",
+                       (token_fingerprint(vk_token), self._day()))
+
+
+_quota_ledger: Optional[QuotaLedger] = None
+
+
+def get_quota_ledger() -> QuotaLedger:
+    global _quota_ledger
+    if _quota_ledger is None:
+        _quota_ledger = QuotaLedger()
+    return _quota_ledger
+
+
+_client: Optional[VkAdsClient] = None
+
+
+def get_client() -> VkAdsClient:
+    """Общий клиент процесса (один пул соединений на всех)."""
+    global _client
+    if _client is None:
+        _client = VkAdsClient()
+    return _client
+
+
+async def close_client():
+    """Закрывает пул соединений — вызывать в конце main()."""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+vk_bench.py — нагрузочный прогон пути выгрузки в VK против vk_mock_server.py.
+
+Гоняет настоящие upload_files_to_cabinets (fan-out) или vk_upload_scheduler
+из bot_master.py на N кабинетов × M файлов и печатает:
+выгрузок/сек, p50/p99 длительности запросов (с учётом повторов),
+счётчики повторов / 429 / flood / 5xx и ответы заглушки.
+
+Боевые кабинеты, кэш выгрузок и суточный лимит не трогаются — всё
+состояние во временном каталоге, VK_ADS_BASE_URL → локальная заглушка.
+
+Запуск:
+    python3 vk_bench.py --cabinets 30 --files 17 --rows 20000
+    python3 vk_bench.py --p429 0.05 --pflood 0.02 --p5xx 0.02 --backoff-scale 0.05
+    python3 vk_bench.py --mode scheduler      # ждёт ближайшую минуту
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Нагрузочный прогон выгрузки в VK против локальной заглушки")
+    p.add_argument("--cabinets", type=int, default=30)
+    p.add_argument("--files", type=int, default=17)
+    p.add_argument("--rows", type=int, default=20000, help="номеров в каждом файле")
+    p.add_argument("--mode", choices=("fanout", "scheduler"), default="fanout")
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--latency-ms", type=float, default=150)
+    p.add_argument("--jitter-ms", type=float, default=100)
+    p.add_argument("--p429", type=float, default=0.0)
+    p.add_argument("--pflood", type=float, default=0.0)
+    p.add_argument("--p5xx", type=float, default=0.0)
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--backoff-scale", type=float, default=1.0,
+                   help="множитель пауз vk_ads (backoff, flood, cooldown breaker) — ускорить прогон с отказами")
+    return p.parse_args()
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def make_files(workdir: str, count: int, rows: int):
+    paths = []
+    os.makedirs(os.path.join(workdir, "txt"), exist_ok=True)
+    for i in range(count):
+        path = os.path.join(workdir, "txt", f"bench_{i} (1).txt")
+        base = 79000000000 + i * rows
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(str(base + n) for n in range(rows)))
+        paths.append(path)
+    return paths
+
+
+async def run(args, workdir: str):
+    import bot_master
+    import vk_ads
+    import vk_mock_server
+
+    scale = args.backoff_scale
+    vk_ads.VK_BACKOFF_BASE         *= scale
+    vk_ads.VK_BACKOFF_CAP          *= scale
+    vk_ads.VK_FLOOD_BACKOFF        *= scale
+    vk_ads.VK_BREAKER_COOLDOWN     *= scale
+    bot_master.VK_SEGMENT_RETRY_SEC = max(1, int(bot_master.VK_SEGMENT_RETRY_SEC * scale))
+
+    settings = vk_mock_server.MockSettings()
+    settings.latency_ms  = args.latency_ms
+    settings.jitter_ms   = args.jitter_ms
+    settings.p429        = args.p429
+    settings.pflood      = args.pflood
+    settings.p5xx        = args.p5xx
+    settings.retry_after = args.retry_after
+    runner = await vk_mock_server.start(args.port, settings)
+    counters = runner.app["counters"]
+
+    files = make_files(workdir, args.files, args.rows)
+    cabinets = [{"name": f"bench-{i}", "token": f"bench-token-{i}", "bases": []}
+                for i in range(args.cabinets)]
+
+    try:
+        if args.mode == "fanout":
+            t0 = time.monotonic()
+            await bot_master.upload_files_to_cabinets(files, cabinets)
+            elapsed = time.monotonic() - t0
+        else:
+            due = bot_master.now_utc() + timedelta(minutes=1)
+            user_hour = (due.hour + 4) % 24    # в cabinets.json время UTC+4
+            for cab in cabinets:
+                cab["fileSchedules"] = {
+                    bot_master._split_base_name(p)[1]: {"enabled": True, "hour": user_hour, "minute": due.minute}
+                    for p in files
+                }
+            with open(bot_master.CABINETS_JSON, "w", encoding="utf-8") as f:
+                json.dump(cabinets, f, ensure_ascii=False)
+            wait = bot_master.seconds_until_window(due.hour, due.minute)
+            print(f"⏳ Планировщик: выгрузка через {wait:.0f}s")
+            t0 = time.monotonic() + wait
+            await bot_master.vk_upload_scheduler(cabinets, files)
+            elapsed = time.monotonic() - t0
+
+        client = vk_ads.get_client()
+        stats = dict(client.stats)
+        lat = {path: list(v) for path, v in client.latencies.items()}
+    finally:
+        await vk_ads.close_client()
+        await runner.cleanup()
+
+    done = counters.get("segments", 0)
+    jobs = args.cabinets * args.files
+    print()
+    print(f"Режим: {args.mode}   кабинетов: {args.cabinets}   файлов: {args.files}   строк: {args.rows}")
+    print(f"Выгрузок (список + сегмент): {done}/{jobs} за {elapsed:.2f}s → {done / max(elapsed, 1e-9):.2f} выгрузок/с")
+    for path, values in sorted(lat.items()):
+        print(f"  {path}: n={len(values)}  p50={percentile(values, 0.50) * 1000:.0f}ms"
+              f"  p99={percentile(values, 0.99) * 1000:.0f}ms")
+    print("Клиент vk_ads:", json.dumps(stats, ensure_ascii=False))
+    print("Заглушка:     ", json.dumps(dict(counters), ensure_ascii=False))
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="vk_bench_")
+    # Всё состояние — во временном каталоге; окружение до импорта bot_master / vk_ads
+    os.environ.update({
+        "VK_ADS_BASE_URL":          f"http://127.0.0.1:{args.port}",
+        "VK_QUOTA_DB":              os.path.join(workdir, "vk_quota.sqlite3"),
+        "VK_UPLOAD_CACHE":          os.path.join(workdir, "vk_upload_cache.json"),
+        "VK_MAX_UPLOADS_PER_TOKEN": str(args.files * 2),
+        "BOT_VK_DELTA_DIR":         os.path.join(workdir, "vk_delta"),
+        "BOT_VK_DLQ":               os.path.join(workdir, "vk_dead_letter.json"),
+        "CABINETS_JSON":            os.path.join(workdir, "cabinets.json"),
+        "BOT_LOG_PATH":             os.path.join(workdir, "bot_master.log"),
+        "ERROR_BOT_TOKEN":          "",     # ошибки прогона — только в лог, не в Telegram
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    print(f"📁 Рабочий каталог: {workdir}")
+    asyncio.run(run(args, workdir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+vk_mock_server.py — локальная заглушка VK Ads API для нагрузочных прогонов.
+
+Отвечает на те же пути, что использует vk_ads.py:
+    POST /api/v3/remarketing/users_lists.json   → {"id": N}
+    POST /api/v2/remarketing/segments.json      → {"id": N}
+и умеет имитировать задержку, 429 (с Retry-After), flood-ошибки 9/29 и 5xx.
+Боевые кабинеты не трогаются — клиент направляется сюда через
+VK_ADS_BASE_URL=http://127.0.0.1:8090.
+
+Запуск:
+    python3 vk_mock_server.py
+Или из vk_bench.py (поднимается в том же процессе).
+
+Переменные окружения (все опциональны):
+    MOCK_PORT=8090
+    MOCK_LATENCY_MS=150        # базовая задержка ответа
+    MOCK_JITTER_MS=100         # + равномерный разброс 0..JITTER
+    MOCK_BYTES_PER_MS=0        # доп. задержка на размер тела (0 — выкл.)
+    MOCK_P429=0.0              # доля ответов 429
+    MOCK_RETRY_AFTER=1         # Retry-After у 429, сек
+    MOCK_PFLOOD=0.0            # доля ответов 200 + error_code 9/29
+    MOCK_P5XX=0.0              # доля ответов 500/503
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+from collections import defaultdict
+
+from aiohttp import web
+
+logger = logging.getLogger("vk_mock")
+
+MOCK_PORT = int(os.getenv("MOCK_PORT", "8090"))
+
+
+class MockSettings:
+    """Параметры отказов и задержек (из окружения, vk_bench.py переопределяет поля)."""
+
+    def __init__(self):
+        self.latency_ms   = float(os.getenv("MOCK_LATENCY_MS", "150"))
+        self.jitter_ms    = float(os.getenv("MOCK_JITTER_MS", "100"))
+        self.bytes_per_ms = float(os.getenv("MOCK_BYTES_PER_MS", "0"))
+        self.p429         = float(os.getenv("MOCK_P429", "0"))
+        self.retry_after  = int(os.getenv("MOCK_RETRY_AFTER", "1"))
+        self.pflood       = float(os.getenv("MOCK_PFLOOD", "0"))
+        self.p5xx         = float(os.getenv("MOCK_P5XX", "0"))
+
+
+def make_app(settings: MockSettings = None) -> web.Application:
+    settings = settings or MockSettings()
+    counters = defaultdict(int)   # ответы по типам — /stats
+    ids = {"next": 1}
+
+    async def _delay(size: int = 0):
+        ms = settings.latency_ms + random.uniform(0, settings.jitter_ms)
+        if settings.bytes_per_ms > 0:
+            ms += size / settings.bytes_per_ms
+        await asyncio.sleep(ms / 1000)
+
+    def _fault():
+        """Случайный отказ по настройкам или None."""
+        r = random.random()
+        if r < settings.p429:
+            counters["429"] += 1
+            return web.Response(status=429, text="Too Many Requests",
+                                headers={"Retry-After": str(settings.retry_after)})
+        r -= settings.p429
+        if r < settings.pflood:
+            code = random.choice((9, 29))
+            counters[f"flood_{code}"] += 1
+            return web.json_response({"error": {"error_code": code, "error_msg": "Flood control"}})
+        r -= settings.pflood
+        if r < settings.p5xx:
+            status = random.choice((500, 503))
+            counters[str(status)] += 1
+            return web.Response(status=status, text="Internal error")
+        return None
+
+    def _new_id() -> int:
+        ids["next"] += 1
+        return ids["next"] - 1
+
+    async def users_lists(request: web.Request) -> web.Response:
+        form = await request.post()
+        file_field = form.get("file")
+        size = len(file_field.file.read()) if file_field is not None else 0
+        await _delay(size)
+        fault = _fault()
+        if fault is not None:
+            return fault
+        if not form.get("name") or file_field is None:
+            counters["400"] += 1
+            return web.json_response({"error": {"code": "bad_request", "message": "name/file required"}},
+                                     status=400)
+        counters["users_lists"] += 1
+        return web.json_response({"id": _new_id()})
+
+    async def segments(request: web.Request) -> web.Response:
+        payload = await request.json()
+        await _delay()
+        fault = _fault()
+        if fault is not None:
+            return fault
+        if not payload.get("relations"):
+            counters["400"] += 1
+            return web.json_response({"error": {"code": "bad_request", "message": "relations required"}},
+                                     status=400)
+        counters["segments"] += 1
+        return web.json_response({"id": _new_id()})
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.Response(text=json.dumps(counters), content_type="application/json")
+
+    app = web.Application(client_max_size=512 * 1024 * 1024)
+    app["counters"] = counters
+    app.router.add_post("/api/v3/remarketing/users_lists.json", users_lists)
+    app.router.add_post("/api/v2/remarketing/segments.json", segments)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+async def start(port: int = MOCK_PORT, settings: MockSettings = None) -> web.AppRunner:
+    """Поднимает заглушку на 127.0.0.1:port; остановка — await runner.cleanup()."""
+    runner = web.AppRunner(make_app(settings))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def main():
+    await start(MOCK_PORT)
+    logger.info(f"VK mock запущен на 127.0.0.1:{MOCK_PORT}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    asyncio.run(main())